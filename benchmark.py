@@ -0,0 +1,514 @@
+"""Command line program for benchmarking the index calculations on synthetic CMIP6-like data
+
+Synthetic daily input files are generated for a configurable grid size
+and time span. They are split into decades and have CMIP6 style file
+names and global attributes. Each script is then run in a subprocess,
+and its wall time, peak memory (RSS) and bytes read/written are recorded
+and can be compared with a stored baseline.
+
+The default case (a 4 x 5 grid for 2005-2020) is a quick smoke test
+that runs every script in a few minutes; use a larger grid and time span
+(e.g. --nlat 20 --nlon 20 --start_year 1950) to measure performance.
+A case whose script needs a package that isn't installed is skipped,
+and a case that takes longer than --timeout is stopped and counted as failed.
+The outputs of a case that doesn't finish are removed.
+
+The bytes read/written come from the operating system's block I/O counts,
+so reads served from the page cache are not included. The total size of
+the input and output files of each script is recorded as well.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import threading
+import subprocess
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import geopandas as gp
+from shapely.geometry import box
+
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL = 'ACCESS-ESM1-5'
+RUN = 'r1i1p1f1'
+GRID = 'gn'
+HIST_END_YEAR = 2014
+VAR_ATTRS = {
+    'pr': {'standard_name': 'precipitation_flux', 'long_name': 'Precipitation', 'units': 'kg m-2 s-1'},
+    'tasmax': {'standard_name': 'air_temperature', 'long_name': 'Daily Maximum Near-Surface Air Temperature', 'units': 'K'},
+    'tasmin': {'standard_name': 'air_temperature', 'long_name': 'Daily Minimum Near-Surface Air Temperature', 'units': 'K'},
+    'hursmin': {'standard_name': 'relative_humidity', 'long_name': 'Daily Minimum Near-Surface Relative Humidity', 'units': '%'},
+    'sfcWindmax': {'standard_name': 'wind_speed', 'long_name': 'Daily Maximum Near-Surface Wind Speed', 'units': 'm s-1'},
+}
+FFDI_VARS = ['pr', 'tasmax', 'hursmin', 'sfcWindmax']
+METRICS = ['wall_time_s', 'max_rss_mb', 'read_mb', 'written_mb', 'input_mb', 'output_mb']
+NOISE = {'wall_time_s': 1.0, 'max_rss_mb': 20.0, 'read_mb': 1.0, 'written_mb': 1.0, 'input_mb': 0.1, 'output_mb': 0.1}
+
+
+def file_periods(start_year, end_year, years_per_file=10):
+    """Split a time span into file periods (historical files end in 2014).
+
+    Returns
+    -------
+    list
+        (experiment type, first year, last year) for each file
+    """
+
+    periods = []
+    spans = [('historical', start_year, min(end_year, HIST_END_YEAR)), ('ssp', max(start_year, HIST_END_YEAR + 1), end_year)]
+    for experiment, span_start, span_end in spans:
+        for file_start in range(span_start, span_end + 1, years_per_file):
+            periods.append((experiment, file_start, min(file_start + years_per_file - 1, span_end)))
+
+    return periods
+
+
+def synthetic_values(var, time, lats, lons, rng):
+    """Generate realistic looking daily values for a variable.
+
+    Parameters
+    ----------
+    var : str
+        Variable name (pr, tasmax, tasmin, hursmin or sfcWindmax)
+    time : pandas.DatetimeIndex
+        Daily time axis
+    lats : numpy.ndarray
+        Latitudes
+    lons : numpy.ndarray
+        Longitudes
+    rng : numpy.random.Generator
+        Random number generator
+
+    Returns
+    -------
+    numpy.ndarray
+        Values with dimensions (time, lat, lon)
+    """
+
+    shape = (len(time), len(lats), len(lons))
+    season = np.cos(2 * np.pi * (time.dayofyear.values - 15) / 365.25)[:, np.newaxis, np.newaxis]
+    lat_gradient = (lats[np.newaxis, :, np.newaxis] + 30) / 15
+    noise = rng.standard_normal(shape)
+    if var == 'pr':
+        wet = rng.random(shape) < 0.35
+        values = np.where(wet, rng.gamma(0.6, 8.0, shape), 0.0) / 86400
+    elif var == 'tasmax':
+        values = 298 + 7 * season + 5 * lat_gradient + 4 * noise
+    elif var == 'tasmin':
+        values = 285 + 6 * season + 5 * lat_gradient + 3 * noise
+    elif var == 'hursmin':
+        values = np.clip(35 - 10 * season - 5 * lat_gradient + 12 * noise, 1, 100)
+    elif var == 'sfcWindmax':
+        values = np.abs(7 + 3 * noise)
+
+    return values.astype(np.float32)
+
+
+def write_synthetic_file(outfile, var, experiment, start_year, end_year, lats, lons, rng):
+    """Write a synthetic daily CMIP6-like netCDF file."""
+
+    time = pd.date_range(f'{start_year}-01-01', f'{end_year}-12-31', freq='D')
+    ds = xr.Dataset(
+        {var: (('time', 'lat', 'lon'), synthetic_values(var, time, lats, lons, rng), VAR_ATTRS[var])},
+        coords={
+            'time': ('time', time, {'standard_name': 'time', 'axis': 'T'}),
+            'lat': ('lat', lats, {'standard_name': 'latitude', 'units': 'degrees_north', 'axis': 'Y'}),
+            'lon': ('lon', lons, {'standard_name': 'longitude', 'units': 'degrees_east', 'axis': 'X'}),
+        },
+    )
+    ds.attrs = {
+        'Conventions': 'CF-1.7 CMIP-6.2',
+        'activity_id': 'CMIP' if experiment == 'historical' else 'ScenarioMIP',
+        'experiment_id': experiment,
+        'frequency': 'day',
+        'grid_label': GRID,
+        'institution_id': 'CSIRO',
+        'source_id': MODEL,
+        'table_id': 'day',
+        'variable_id': var,
+        'variant_label': RUN,
+        'history': 'synthetic data for benchmarking',
+    }
+    encoding = {
+        var: {'zlib': True, 'complevel': 1, 'shuffle': True, 'chunksizes': (1, len(lats), len(lons))},
+        'time': {'units': 'days since 1850-01-01', 'calendar': 'proleptic_gregorian', 'dtype': 'float64'},
+    }
+    ds.to_netcdf(outfile, encoding=encoding)
+
+
+def make_data(data_dir, nlat, nlon, start_year, end_year, ssp, years_per_file=10, seed=0):
+    """Generate the synthetic input files (unless they already exist for the same settings).
+
+    Returns
+    -------
+    dict
+        Input files (in time order) for each variable
+    """
+
+    config = {
+        'nlat': nlat, 'nlon': nlon, 'start_year': start_year, 'end_year': end_year,
+        'ssp': ssp, 'years_per_file': years_per_file, 'seed': seed,
+    }
+    config_file = os.path.join(data_dir, 'synthetic.json')
+    lats = np.linspace(-43.5, -10.5, nlat)
+    lons = np.linspace(113.5, 153.5, nlon)
+    periods = file_periods(start_year, end_year, years_per_file)
+
+    files = {}
+    for var in VAR_ATTRS:
+        files[var] = []
+        for experiment, file_start, file_end in periods:
+            experiment = experiment if experiment == 'historical' else ssp
+            filename = f'{var}_day_{MODEL}_{experiment}_{RUN}_{GRID}_{file_start}0101-{file_end}1231.nc'
+            files[var].append(os.path.join(data_dir, filename))
+
+    if os.path.isfile(config_file):
+        with open(config_file) as reader:
+            if json.load(reader) == config:
+                return files
+        shutil.rmtree(data_dir)
+    os.makedirs(data_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for var in VAR_ATTRS:
+        for outfile, (experiment, file_start, file_end) in zip(files[var], periods):
+            experiment = experiment if experiment == 'historical' else ssp
+            write_synthetic_file(outfile, var, experiment, file_start, file_end, lats, lons, rng)
+            print(f'Generated {outfile}')
+    with open(config_file, 'w') as writer:
+        json.dump(config, writer)
+
+    return files
+
+
+def write_regions_file(outfile, lats, lons):
+    """Write a shapefile that splits the synthetic grid into two regions."""
+
+    mid_lon = float(np.mean(lons))
+    south, north = float(lats.min()) - 1, float(lats.max()) + 1
+    regions = gp.GeoDataFrame(
+        {'name': ['West', 'East'], 'abbrev': ['W', 'E']},
+        geometry=[box(float(lons.min()) - 1, south, mid_lon, north), box(mid_lon, south, float(lons.max()) + 1, north)],
+        crs='EPSG:4326',
+    )
+    regions.to_file(outfile)
+
+
+def define_cases(files, work_dir, base_start, base_end):
+    """Define the benchmark cases (in the order they must be run).
+
+    Returns
+    -------
+    list
+        Name, command line arguments (script first), inputs and outputs of each case
+    """
+
+    out_dir = os.path.join(work_dir, 'output')
+    clim_file = os.path.join(out_dir, 'pr-annual-clim.nc')
+    kbdi_files = [os.path.join(out_dir, os.path.basename(infile).replace('pr_', 'kbdi_')) for infile in files['pr']]
+    evspsblpot_file = os.path.join(out_dir, 'evspsblpot.nc')
+    spei_file = os.path.join(out_dir, 'spei.nc')
+    wsdi_file = os.path.join(out_dir, 'wsdi.nc')
+    csv_file = os.path.join(out_dir, 'wsdi.csv')
+    regions_file = os.path.join(work_dir, 'data', 'regions.shp')
+    zarr_files = {var: os.path.join(out_dir, f'{var}.zarr') for var in FFDI_VARS}
+
+    cases = [
+        ('pr_climatology', ['pr_climatology.py'] + files['pr'] + [base_start, base_end, clim_file],
+         files['pr'], [clim_file]),
+        ('kbdi', ['kbdi.py', clim_file, '--pr_files'] + files['pr'] + ['--tasmax_files'] + files['tasmax'] + ['--outfiles'] + kbdi_files,
+         [clim_file] + files['pr'] + files['tasmax'], kbdi_files),
+        ('evspsblpot', ['evspsblpot.py', evspsblpot_file, 'hargreaves85', '--tasmin_files'] + files['tasmin'] + ['--tasmax_files'] + files['tasmax'],
+         files['tasmin'] + files['tasmax'], [evspsblpot_file]),
+        ('spei', ['spei.py', spei_file, '--pr_files'] + files['pr'] + ['--evspsblpot_files', evspsblpot_file],
+         files['pr'] + [evspsblpot_file], [spei_file]),
+        ('wsdi', ['wsdi.py'] + files['tasmax'] + [wsdi_file], files['tasmax'], [wsdi_file]),
+        ('nc_to_csv', ['nc_to_csv.py', wsdi_file, 'WSDI', csv_file, '--regions_file', regions_file,
+                       '--region_names', 'name', '--region_abbrevs', 'abbrev'],
+         [wsdi_file], [csv_file]),
+    ]
+    for var in FFDI_VARS:
+        temp_zarr = os.path.join(out_dir, f'{var}-temp.zarr')
+        cases.append((
+            f'nc_to_rechunked_zarr_{var}',
+            ['nc_to_rechunked_zarr.py'] + files[var] + [var, zarr_files[var], temp_zarr, '--max_mem', '1GB'],
+            files[var],
+            [zarr_files[var]],
+        ))
+    ffdi_zarr_outfiles = [os.path.join(out_dir, f'{metric}_zarr.nc') for metric in ['FFDIx', 'FFDIgt99p']]
+    zarr_args = []
+    for var in FFDI_VARS:
+        zarr_args = zarr_args + [f'--{var}_zarr', zarr_files[var]]
+    cases.append((
+        'ffdi_zarr',
+        ['ffdi.py'] + ffdi_zarr_outfiles + zarr_args + ['--kbdi_files'] + kbdi_files,
+        list(zarr_files.values()) + kbdi_files,
+        ffdi_zarr_outfiles,
+    ))
+    ffdi_fused_outfiles = [os.path.join(out_dir, f'{metric}_fused.nc') for metric in ['FFDIx', 'FFDIgt99p']]
+    fused_args = []
+    for var in FFDI_VARS:
+        fused_args = fused_args + [f'--{var}_files'] + files[var]
+    cases.append((
+        'ffdi_fused',
+        ['ffdi.py'] + ffdi_fused_outfiles + fused_args + ['--pr_annual_clim_file', clim_file],
+        [infile for var in FFDI_VARS for infile in files[var]] + [clim_file],
+        ffdi_fused_outfiles,
+    ))
+
+    return cases
+
+
+def path_size(path):
+    """Size of a file or directory (e.g. a Zarr collection) in bytes."""
+
+    if os.path.isdir(path):
+        return sum(
+            os.path.getsize(os.path.join(dirpath, filename))
+            for dirpath, _, filenames in os.walk(path) for filename in filenames
+        )
+
+    return os.path.getsize(path)
+
+
+def remove_outputs(outputs):
+    """Remove the outputs of a previous run of a case."""
+
+    for path in outputs:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def missing_module(log_file):
+    """Find the package a script couldn't import (from its log), if any."""
+
+    with open(log_file) as log:
+        match = re.search(r"ModuleNotFoundError: No module named '([^']+)'", log.read())
+
+    return match.group(1) if match else None
+
+
+def run_case(args, inputs, outputs, log_file, timeout=None):
+    """Run a script in a subprocess and measure its resource use.
+
+    The script is stopped if it runs for longer than timeout seconds,
+    and the outputs of a script that doesn't finish are removed.
+
+    Returns
+    -------
+    dict
+        Measured metrics (plus the exit code and status)
+    """
+
+    remove_outputs(outputs)
+    for path in outputs:
+        os.makedirs(os.path.dirname(path.split('.zarr')[0]), exist_ok=True)
+    command = [sys.executable, os.path.join(CODE_DIR, args[0])] + args[1:]
+    with open(log_file, 'w') as log:
+        start_time = time.perf_counter()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        timed_out = threading.Event()
+
+        def stop():
+            timed_out.set()
+            process.kill()
+
+        timer = threading.Timer(timeout, stop) if timeout else None
+        try:
+            if timer:
+                timer.start()
+            _, status, usage = os.wait4(process.pid, 0)
+        except BaseException:
+            process.kill()
+            process.wait()
+            remove_outputs(outputs)
+            raise
+        finally:
+            if timer:
+                timer.cancel()
+        wall_time = time.perf_counter() - start_time
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS); block counts are in 512 byte units
+    rss_bytes = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    metrics = {
+        'exit_code': process.returncode,
+        'wall_time_s': round(wall_time, 2),
+        'max_rss_mb': round(rss_bytes / 1e6, 1),
+        'read_mb': round(usage.ru_inblock * 512 / 1e6, 1),
+        'written_mb': round(usage.ru_oublock * 512 / 1e6, 1),
+        'input_mb': round(sum(path_size(path) for path in inputs) / 1e6, 2),
+    }
+    if process.returncode == 0:
+        metrics['status'] = 'ok'
+        metrics['output_mb'] = round(sum(path_size(path) for path in outputs) / 1e6, 2)
+        return metrics
+
+    remove_outputs(outputs)
+    module = missing_module(log_file)
+    if timed_out.is_set():
+        metrics['status'] = f'timed out after {timeout} s'
+    elif module:
+        metrics['status'] = f'skipped (no {module} package)'
+    else:
+        metrics['status'] = 'failed'
+
+    return metrics
+
+
+def is_skipped(metrics):
+    """Check if a case was skipped (rather than failed)."""
+
+    return metrics.get('status', '').startswith('skipped')
+
+
+def compare(results, baseline, tolerance):
+    """Compare benchmark results with a baseline.
+
+    A metric has regressed if it is more than tolerance (a fraction) and
+    more than the measurement noise above the baseline.
+
+    Returns
+    -------
+    list
+        Description of each regression
+    """
+
+    regressions = []
+    for case, metrics in results.items():
+        if case not in baseline or is_skipped(metrics):
+            continue
+        if metrics['exit_code'] != 0:
+            regressions.append(f'{case}: failed (exit code {metrics["exit_code"]})')
+            continue
+        for metric in METRICS:
+            if metric not in baseline[case] or metric not in metrics:
+                continue
+            old_value = baseline[case][metric]
+            new_value = metrics[metric]
+            if (new_value > old_value * (1 + tolerance)) and (new_value - old_value > NOISE[metric]):
+                regressions.append(f'{case}: {metric} increased from {old_value} to {new_value}')
+
+    return regressions
+
+
+def print_table(results, baseline=None):
+    """Print the benchmark results (and the change relative to a baseline)."""
+
+    header = f'{"case":30s}' + ''.join(f'{metric:>14s}' for metric in METRICS)
+    print(header)
+    for case, metrics in results.items():
+        line = f'{case:30s}'
+        for metric in METRICS:
+            value = metrics.get(metric)
+            text = '-' if value is None else f'{value}'
+            if baseline and value is not None and baseline.get(case, {}).get(metric):
+                change = 100 * (value - baseline[case][metric]) / baseline[case][metric]
+                text = f'{text} ({change:+.0f}%)'
+            line = line + f'{text:>14s}'
+        if metrics['exit_code'] != 0:
+            line = line + f'  {metrics.get("status", "failed").upper()}'
+        print(line)
+
+
+def main(args):
+    """Run the program."""
+
+    work_dir = os.path.abspath(args.work_dir)
+    data_dir = os.path.join(work_dir, 'data')
+    log_dir = os.path.join(work_dir, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    files = make_data(
+        data_dir, args.nlat, args.nlon, args.start_year, args.end_year, args.ssp,
+        years_per_file=args.years_per_file, seed=args.seed,
+    )
+    regions_file = os.path.join(data_dir, 'regions.shp')
+    if not os.path.isfile(regions_file):
+        with xr.open_dataset(files['pr'][0]) as ds:
+            write_regions_file(regions_file, ds['lat'].values, ds['lon'].values)
+
+    base_start = f'{max(args.start_year, 1950)}-01-01'
+    base_end = f'{min(args.end_year, HIST_END_YEAR)}-12-31'
+    cases = define_cases(files, work_dir, base_start, base_end)
+    if args.cases:
+        unknown_cases = set(args.cases) - set(case[0] for case in cases)
+        assert not unknown_cases, f'Unknown cases: {sorted(unknown_cases)}'
+        cases = [case for case in cases if case[0] in args.cases]
+
+    results = {}
+    for name, case_args, inputs, outputs in cases:
+        missing_inputs = [path for path in inputs if not os.path.exists(path)]
+        if missing_inputs:
+            print(f'Skipping {name} (missing inputs from an earlier case: {missing_inputs[0]})')
+            continue
+        print(f'Running {name}')
+        results[name] = run_case(case_args, inputs, outputs, os.path.join(log_dir, f'{name}.log'), timeout=args.timeout)
+
+    output = {
+        'config': {
+            'nlat': args.nlat, 'nlon': args.nlon, 'start_year': args.start_year, 'end_year': args.end_year,
+            'ssp': args.ssp, 'years_per_file': args.years_per_file, 'seed': args.seed,
+        },
+        'results': results,
+    }
+    if args.outfile:
+        with open(args.outfile, 'w') as writer:
+            json.dump(output, writer, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as reader:
+            baseline_data = json.load(reader)
+        if baseline_data['config'] != output['config']:
+            print(f'Warning: the baseline was run with different settings: {baseline_data["config"]}')
+        baseline = baseline_data['results']
+    print_table(results, baseline)
+
+    skipped = [name for name, metrics in results.items() if is_skipped(metrics)]
+    if skipped:
+        print(f'Skipped cases (see {log_dir}): {skipped}')
+    failed = [name for name, metrics in results.items() if metrics['exit_code'] != 0 and name not in skipped]
+    if failed:
+        print(f'Failed cases (see {log_dir}): {failed}')
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'Regression - {regression}')
+        if regressions:
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("work_dir", type=str, help="directory for the synthetic data, outputs and logs")
+    parser.add_argument("--nlat", type=int, default=4, help="number of latitudes in the synthetic grid [default=4]")
+    parser.add_argument("--nlon", type=int, default=5, help="number of longitudes in the synthetic grid [default=5]")
+    parser.add_argument("--start_year", type=int, default=2005, help="first year of synthetic data [default=2005]")
+    parser.add_argument("--end_year", type=int, default=2020, help="last year of synthetic data [default=2020]")
+    parser.add_argument("--years_per_file", type=int, default=10, help="number of years in each input file [default=10]")
+    parser.add_argument("--ssp", type=str, default='ssp370', help="experiment name for the years after 2014 [default=ssp370]")
+    parser.add_argument("--seed", type=int, default=0, help="random number seed for the synthetic data [default=0]")
+    parser.add_argument("--cases", type=str, nargs='*', default=None,
+                        help="only run these cases (cases that use the outputs of other cases need those outputs to exist)")
+    parser.add_argument("--outfile", type=str, default=None, help="write the results to this JSON file (e.g. to use as a baseline)")
+    parser.add_argument("--baseline", type=str, default=None, help="compare the results with this JSON file from an earlier run")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="stop a case (and count it as failed) after this many seconds [default=600]")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="fractional increase in a metric (above the measurement noise) that counts as a regression [default=0.25]")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,138 @@
+"""Utilities for caching intermediate results on disk"""
+
+import os
+import time
+import hashlib
+
+import numpy as np
+
+
+# Each cache file's last use is recorded in the modification time of a
+# separate (empty) file, because a cache file can be hard linked to an
+# output file whose modification time mustn't change when the cache is read
+USED_SUFFIX = '.used'
+
+
+def hash_items(*items):
+    """Create a short hash from a sequence of items.
+
+    Parameters
+    ----------
+    items : Union[numpy.ndarray, str, int, float, tuple, list, bool, None]
+        Items that define the cache entry
+
+    Returns
+    -------
+    str
+        Hexadecimal hash
+    """
+
+    sha = hashlib.sha256()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            sha.update(str((item.dtype, item.shape)).encode())
+            sha.update(np.ascontiguousarray(item).tobytes())
+        else:
+            sha.update(repr(item).encode())
+
+    return sha.hexdigest()[:16]
+
+
+def grid_hash(ds, lat_dim='lat', lon_dim='lon'):
+    """Create a hash of the horizontal grid of a dataset."""
+
+    return hash_items(ds[lat_dim].values, ds[lon_dim].values)
+
+
+def file_signature(path):
+    """Describe a file by its absolute path, size and modification time."""
+
+    stat = os.stat(path)
+
+    return (os.path.abspath(path), stat.st_size, int(stat.st_mtime))
+
+
+def cache_path(cache_dir, prefix, key, suffix='.nc'):
+    """Define the path of a cache file."""
+
+    return os.path.join(cache_dir, f'{prefix}_{key}{suffix}')
+
+
+def used_path(path):
+    """Define the path of the file that records when a cache file was last used."""
+
+    return path + USED_SUFFIX
+
+
+def read_hit(path):
+    """Check for a cache file and mark it as recently used."""
+
+    if not os.path.exists(path):
+        return False
+    with open(used_path(path), 'a'):
+        os.utime(used_path(path))
+
+    return True
+
+
+def write_atomic(write_func, path):
+    """Write a cache file via a temporary file so partial files are never read.
+
+    Parameters
+    ----------
+    write_func : function
+        Function that writes to the file path it is given
+    path : str
+        Final path of the cache file
+    """
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    write_func(temp_path)
+    os.replace(temp_path, path)
+
+
+def remove_file(path):
+    """Remove a file (unless another process already has)."""
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def evict(cache_dir, max_gb=None, max_days=None):
+    """Remove cache files that are too old or too numerous.
+
+    Files not used (or written) in the last max_days days are removed first,
+    then the least recently used files until the cache is smaller than max_gb.
+    """
+
+    if not os.path.isdir(cache_dir):
+        return
+    mtimes = {}
+    sizes = {}
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and not entry.name.endswith('.tmp'):
+            mtimes[entry.path] = entry.stat().st_mtime
+            if not entry.name.endswith(USED_SUFFIX):
+                sizes[entry.path] = entry.stat().st_size
+    entries = []
+    for path, size in sizes.items():
+        last_used = max(mtimes[path], mtimes.get(used_path(path), 0))
+        entries.append((last_used, size, path))
+    entries.sort()
+    for path in mtimes:
+        if path.endswith(USED_SUFFIX) and path[:-len(USED_SUFFIX)] not in sizes:
+            remove_file(path)
+
+    now = time.time()
+    total_bytes = sum(size for mtime, size, path in entries)
+    for mtime, size, path in entries:
+        too_old = max_days is not None and (now - mtime) > max_days * 86400
+        too_big = max_gb is not None and total_bytes > max_gb * 1e9
+        if not (too_old or too_big):
+            continue
+        remove_file(path)
+        remove_file(used_path(path))
+        total_bytes -= size
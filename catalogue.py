@@ -0,0 +1,267 @@
+"""Command line program for building a catalogue of CMIP6 data files
+
+The CMIP6 directory tree is crawled once and the model, experiment, run,
+variable, grid, version and time range of every file is written to a
+Parquet file, so the files for a task can be found without globbing
+over the file system (see ensemble.py --catalogue).
+
+Optionally, a virtual (kerchunk) reference file is also written for the
+files of each model/experiment/run/variable, so that they can be opened
+as one dataset without reading the header of every file.
+Any program that accepts a list of input files for open_mfdataset
+(e.g. wsdi.py or spei.py) also accepts these reference files
+(and Zarr collections written by output_encoding.py).
+"""
+
+import os
+import glob
+import json
+import fnmatch
+import argparse
+import logging
+
+import pandas as pd
+import xarray as xr
+import fsspec
+
+import output_encoding
+
+
+FACETS = ['activity', 'institution', 'model', 'experiment', 'run', 'table', 'variable', 'grid', 'version']
+REFERENCE_SUFFIX = '.json'
+
+
+def parse_path(path):
+    """Get the CMIP6 facets and time range of a file from its path.
+
+    The path is expected to follow the CMIP6 data reference syntax:
+    .../CMIP6/activity/institution/model/experiment/run/table/variable/grid/version/filename
+
+    Returns
+    -------
+    dict
+        Facets, start date and end date (or None if the path does not follow the syntax)
+    """
+
+    parts = path.split(os.sep)
+    if len(parts) < len(FACETS) + 2 or parts[-len(FACETS) - 2] != 'CMIP6':
+        return None
+    entry = dict(zip(FACETS, parts[-len(FACETS) - 1:-1]))
+    time_range = os.path.splitext(parts[-1])[0].split('_')[-1]
+    start_date, _, end_date = time_range.partition('-')
+    entry['start_date'] = start_date if start_date.isdigit() else None
+    entry['end_date'] = end_date if end_date.isdigit() else None
+    entry['path'] = path
+
+    return entry
+
+
+def build(roots, models=None, experiments=None, tables=None, variables=None):
+    """Crawl the CMIP6 directory trees under one or more root directories.
+
+    Parameters
+    ----------
+    roots : list
+        Directories containing a CMIP6 directory (e.g. /g/data/oi10/replicas)
+    models, experiments, tables, variables : list, optional
+        Only include these models/experiments/tables/variables [default=all]
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per file
+    """
+
+    entries = []
+    for root in roots:
+        for model in models or ['*']:
+            for experiment in experiments or ['*']:
+                for table in tables or ['*']:
+                    for variable in variables or ['*']:
+                        pattern = f'{root}/CMIP6/*/*/{model}/{experiment}/*/{table}/{variable}/*/*/*.nc'
+                        for path in glob.glob(pattern):
+                            entry = parse_path(path)
+                            if entry:
+                                stat = os.stat(path)
+                                entry['size'] = stat.st_size
+                                entry['mtime'] = stat.st_mtime
+                                entries.append(entry)
+    df = pd.DataFrame(entries, columns=FACETS + ['start_date', 'end_date', 'path', 'size', 'mtime'])
+    df = df.sort_values(FACETS + ['start_date'], ignore_index=True)
+
+    return df
+
+
+def read(catalogue_file):
+    """Read a catalogue Parquet file."""
+
+    return pd.read_parquet(catalogue_file)
+
+
+def search(df, **facets):
+    """Select catalogue entries.
+
+    Facet values can contain shell-style wildcards (e.g. version='v*').
+    The version 'latest' selects the most recent version of each
+    model/experiment/run/table/variable/grid.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Selected entries (in time order within each version)
+    """
+
+    latest = facets.get('version') == 'latest'
+    if latest:
+        facets.pop('version')
+    selection = pd.Series(True, index=df.index)
+    for facet, value in facets.items():
+        if value is not None:
+            selection &= df[facet].map(lambda item: fnmatch.fnmatchcase(item, value))
+    df = df[selection]
+    if latest and len(df):
+        group_facets = [facet for facet in FACETS if facet != 'version']
+        latest_versions = df.groupby(group_facets)['version'].transform('max')
+        df = df[df['version'] == latest_versions]
+
+    return df.sort_values(FACETS + ['start_date'])
+
+
+def find_files(df, model, experiment, run, variable, grid, version, table='day'):
+    """Find the files for a model/experiment/run/variable (in time order)."""
+
+    selection = search(
+        df, model=model, experiment=experiment, run=run, table=table, variable=variable, grid=grid, version=version
+    )
+
+    return list(selection['path'])
+
+
+def reference_path(references_dir, model, experiment, run, table, variable, grid, version):
+    """Define the path of the reference file for a model/experiment/run/variable."""
+
+    filename = f'{variable}_{table}_{model}_{experiment}_{run}_{grid}_{version}{REFERENCE_SUFFIX}'
+
+    return os.path.join(references_dir, model, filename)
+
+
+def make_references(infiles, outfile):
+    """Write a kerchunk reference file that combines netCDF files along the time axis.
+
+    Requires the kerchunk package (and h5py), which is only needed for
+    writing reference files (not for reading them).
+    """
+
+    from kerchunk.hdf import SingleHdf5ToZarr
+    from kerchunk.combine import MultiZarrToZarr
+
+    single_references = []
+    for infile in infiles:
+        with fsspec.open(infile, 'rb') as reader:
+            single_references.append(SingleHdf5ToZarr(reader, infile, inline_threshold=300).translate())
+    if len(single_references) == 1:
+        references = single_references[0]
+    else:
+        combiner = MultiZarrToZarr(single_references, concat_dims=['time'], identical_dims=['lat', 'lon'])
+        references = combiner.translate()
+    os.makedirs(os.path.dirname(os.path.abspath(outfile)), exist_ok=True)
+    temp_file = f'{outfile}.{os.getpid()}.tmp'
+    with open(temp_file, 'w') as writer:
+        json.dump(references, writer)
+    os.replace(temp_file, outfile)
+
+
+def is_reference(path):
+    """Check if an input path is a reference file (rather than a netCDF file)."""
+
+    return path.endswith(REFERENCE_SUFFIX)
+
+
+def open_reference(reference_file, chunks=None):
+    """Open a kerchunk reference file as an xarray dataset."""
+
+    mapper = fsspec.get_mapper('reference://', fo=reference_file)
+
+    return xr.open_dataset(mapper, engine='zarr', consolidated=False, chunks=chunks)
+
+
+def open_dataset(path, **kwargs):
+    """Open a netCDF file, Zarr collection or reference file."""
+
+    if is_reference(path):
+        return open_reference(path, chunks=kwargs.pop('chunks', None))
+    if output_encoding.is_zarr(path):
+        kwargs.setdefault('engine', 'zarr')
+
+    return xr.open_dataset(path, **kwargs)
+
+
+def open_mfdataset(paths, attrs_file=None, preprocess=None, **kwargs):
+    """Open netCDF files, Zarr collections or reference files as one dataset.
+
+    Works like xarray.open_mfdataset, which is used for netCDF files and Zarr collections.
+    Reference files are opened without reading the netCDF headers.
+    """
+
+    if all(output_encoding.is_zarr(path) for path in paths):
+        kwargs.setdefault('engine', 'zarr')
+    if not all(is_reference(path) for path in paths):
+        return xr.open_mfdataset(paths, attrs_file=attrs_file, preprocess=preprocess, **kwargs)
+
+    datasets = []
+    for path in paths:
+        ds = open_reference(path, chunks={})
+        if preprocess is not None:
+            ds = preprocess(ds)
+        datasets.append(ds)
+    ds = xr.combine_by_coords(datasets, combine_attrs='override')
+    if attrs_file:
+        ds.attrs = datasets[paths.index(attrs_file)].attrs
+
+    return ds
+
+
+def main(args):
+    """Run the program."""
+
+    df = build(
+        args.roots,
+        models=args.models,
+        experiments=args.experiments,
+        tables=args.tables,
+        variables=args.variables,
+    )
+    temp_file = f'{args.outfile}.{os.getpid()}.tmp'
+    df.to_parquet(temp_file, index=False)
+    os.replace(temp_file, args.outfile)
+    logging.info(f'{len(df)} files written to {args.outfile}')
+
+    if args.references_dir:
+        group_facets = ['model', 'experiment', 'run', 'table', 'variable', 'grid', 'version']
+        for group, group_df in df.groupby(group_facets):
+            outfile = reference_path(args.references_dir, *group)
+            newest_file = group_df['mtime'].max()
+            if os.path.isfile(outfile) and os.path.getmtime(outfile) > newest_file:
+                continue
+            make_references(list(group_df.sort_values('start_date')['path']), outfile)
+            logging.info(f'Written {outfile}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("outfile", type=str, help="output Parquet file name")
+    parser.add_argument("--roots", type=str, nargs='*', required=True,
+                        help="directories containing a CMIP6 directory (e.g. /g/data/oi10/replicas /g/data/fs38/publications)")
+    parser.add_argument("--models", type=str, nargs='*', default=None, help="only include these models [default=all]")
+    parser.add_argument("--experiments", type=str, nargs='*', default=None, help="only include these experiments [default=all]")
+    parser.add_argument("--tables", type=str, nargs='*', default=['day'], help="only include these tables [default=day]")
+    parser.add_argument("--variables", type=str, nargs='*', default=None, help="only include these variables [default=all]")
+    parser.add_argument("--references_dir", type=str, default=None,
+                        help="write a kerchunk reference file for each model/experiment/run/variable to this directory")
+    args = parser.parse_args()
+    # Configured here rather than on import, because the other programs import this module
+    logging.basicConfig(level=logging.INFO)
+    main(args)
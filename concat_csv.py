@@ -1,20 +1,144 @@
-"""Command line program for concatenating CSV files"""
+"""Command line program for concatenating CSV files
 
+The CSV files can also be added to (and later read from) a Parquet
+dataset partitioned by model, ssp and metric, so that new runs can be
+appended without rewriting existing data.
+"""
+
+import os
 import argparse
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.dataset
+
+import profiling
+
+
+PARTITION_KEYS = ['model', 'ssp', 'metric']
+
+
+def parse_filename(infile):
+    """Get the metric, model, ssp and run from a CSV file name.
+
+    e.g. FFDIx_yr_ACCESS-ESM1-5_ssp370_r1i1p1f1_aus-states_1850-2100.csv
+    """
+
+    metric, freq, model, ssp, run = os.path.basename(infile).split('_')[:5]
+
+    return {'metric': metric, 'model': model, 'ssp': ssp, 'run': run}
+
+
+def read_csv(infile):
+    """Read a CSV file into a pyarrow table.
+
+    Each column keeps the type pyarrow reads it as (e.g. integer counts
+    stay integers). The types are made consistent between files when the
+    data for a metric is read back (see metric_schema).
+    """
+
+    return pyarrow.csv.read_csv(infile)
+
+
+def metric_schema(dataset, selection):
+    """Combine the column types of the files selected from the Parquet dataset.
+
+    A column that is missing throughout one file (a null column) takes its
+    type from the other files, and integers are only promoted to floats if
+    another file has floats in that column.
+    """
+
+    schemas = [fragment.physical_schema for fragment in dataset.get_fragments(filter=selection)]
+
+    return pa.unify_schemas(schemas + [dataset.partitioning.schema], promote_options='permissive')
+
+
+def append_to_dataset(infile, parquet_dir):
+    """Add a CSV file to the partitioned Parquet dataset.
+
+    Each run is written to its own file within the model/ssp/metric
+    partition, so adding a run never rewrites existing files
+    (and adding the same run again replaces its file).
+    """
+
+    file_info = parse_filename(infile)
+    table = read_csv(infile)
+    assert set(table['model'].to_pylist()) == {file_info['model']}, f'Model in {infile} does not match file name'
+    nrows = table.num_rows
+    table = table.append_column('ssp', pa.array([file_info['ssp']] * nrows))
+    table = table.append_column('metric', pa.array([file_info['metric']] * nrows))
+
+    pyarrow.dataset.write_dataset(
+        table,
+        parquet_dir,
+        format='parquet',
+        partitioning=PARTITION_KEYS,
+        partitioning_flavor='hive',
+        basename_template=file_info['run'] + '-part{i}.parquet',
+        existing_data_behavior='overwrite_or_ignore',
+    )
+
+
+def dataset_to_csv(parquet_dir, outfile, metric, models=None, ssps=None):
+    """Write the (sorted) data for a metric from the Parquet dataset to CSV."""
+
+    dataset = pyarrow.dataset.dataset(parquet_dir, format='parquet', partitioning='hive')
+    selection = pyarrow.dataset.field('metric') == metric
+    if models:
+        selection = selection & pyarrow.dataset.field('model').isin(models)
+    if ssps:
+        selection = selection & pyarrow.dataset.field('ssp').isin(ssps)
+    assert list(dataset.get_fragments(filter=selection)), f'No data for {metric} in {parquet_dir}'
+    schema = metric_schema(dataset, selection)
+    dataset = pyarrow.dataset.dataset(parquet_dir, format='parquet', partitioning='hive', schema=schema)
+    table = dataset.to_table(filter=selection)
+    assert table.num_rows, f'No data for {metric} in {parquet_dir}'
+
+    # The metric is the same throughout, but a file can hold several ssps
+    columns = [name for name in table.column_names if name not in PARTITION_KEYS]
+    columns.insert(columns.index('run'), 'model')
+    columns.insert(columns.index('run') + 1, 'ssp')
+    sort_keys = [columns[0], 'model', 'run', 'ssp']
+    if 'month' in columns:
+        sort_keys.append('month')
+    table = table.sort_by([(key, 'ascending') for key in sort_keys])
+    # Nullable integers, so integer columns with missing values aren't written as floats
+    df = table.select(columns).to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+    df.to_csv(outfile, index=False)
 
 
 def main(args):
     """Run the program."""
 
-    df_list = []   
-    for infile in args.infiles:
-        df = pd.read_csv(infile)
-        df_list.append(df)
-    df = pd.concat(df_list, ignore_index=True)
-    df = df.sort_values(by=[df.columns[0], 'run'], ignore_index=True)
-    df.to_csv(args.outfile, index=False)
+    profile = profiling.Profile(args.profile)
+    if args.parquet_dir:
+        with profile.stage('append', nfiles=len(args.files)):
+            for infile in args.files:
+                append_to_dataset(infile, args.parquet_dir)
+        if args.csv_outfile:
+            with profile.stage('write'):
+                dataset_to_csv(
+                    args.parquet_dir,
+                    args.csv_outfile,
+                    args.metric,
+                    models=args.model,
+                    ssps=args.ssp,
+                )
+        return
+
+    assert len(args.files) > 1, 'Input and output file names required'
+    infiles = args.files[:-1]
+    outfile = args.files[-1]
+    with profile.stage('read', nfiles=len(infiles)):
+        df_list = []
+        for infile in infiles:
+            df = pd.read_csv(infile)
+            df_list.append(df)
+    with profile.stage('write'):
+        df = pd.concat(df_list, ignore_index=True)
+        df = df.sort_values(by=[df.columns[0], 'run'], ignore_index=True)
+        df.to_csv(outfile, index=False)
 
 
 if __name__ == '__main__':
@@ -22,7 +146,17 @@ if __name__ == '__main__':
         description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
-    parser.add_argument("infiles", type=str, nargs='*', help="input CSV files")
-    parser.add_argument("outfile", type=str, help="output file name")
+    parser.add_argument("files", type=str, nargs='*',
+                        help="input CSV files, followed by the output file name (unless --parquet_dir is used)")
+    parser.add_argument("--parquet_dir", type=str, default=None,
+                        help="add the input CSV files to this partitioned Parquet dataset")
+    parser.add_argument("--csv_outfile", type=str, default=None,
+                        help="write the sorted data for --metric from the Parquet dataset to this CSV file")
+    parser.add_argument("--metric", type=str, default=None, help="metric to write to --csv_outfile (e.g. FFDIx)")
+    parser.add_argument("--model", type=str, nargs='*', default=None, help="models to write to --csv_outfile [default=all]")
+    parser.add_argument("--ssp", type=str, nargs='*', default=None, help="ssps to write to --csv_outfile [default=all]")
+    profiling.add_arguments(parser)
     args = parser.parse_args()
+    if args.csv_outfile and not (args.parquet_dir and args.metric):
+        parser.error('--csv_outfile requires --parquet_dir and --metric')
     main(args)
@@ -0,0 +1,483 @@
+"""Command line program for processing an ensemble of CMIP6 runs
+
+The model x ssp x run x metric matrix is expanded into a graph of tasks
+(e.g. pr_climatology -> kbdi -> zarr -> ffdi -> csv), which is run on a
+local pool of worker processes. Tasks whose outputs are newer than their
+inputs are skipped. With --profile_dir, each task writes a profile
+(see profiling.py) and the profiles are combined into a summary table.
+"""
+
+import os
+import sys
+import shutil
+import glob
+import time
+import argparse
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import profiling
+import catalogue
+
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+OUTPUT_DIR = '/g/data/xv83/dbi599/treasury'
+CACHE_DIR = '/g/data/xv83/dbi599/treasury/cache'
+METRICS = ['ffdi', 'spei', 'wsdi']
+FFDI_VARS = ['pr', 'tasmax', 'hursmin', 'sfcWindmax']
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+# File catalogue (see catalogue.py) used instead of globbing when --catalogue is given
+CATALOGUE = None
+
+
+def get_indir(model):
+    """Get the CMIP6 data directory for a model."""
+
+    if model in ['ACCESS-ESM1-5', 'ACCESS-CM2']:
+        return '/g/data/fs38/publications'
+    else:
+        return '/g/data/oi10/replicas'
+
+
+def find_files(model, experiment, run, var, grid, version):
+    """Find the daily CMIP6 files for a variable (in time order)."""
+
+    if CATALOGUE is not None:
+        return catalogue.find_files(CATALOGUE, model, experiment, run, var, grid, version)
+
+    activity = 'CMIP' if experiment == 'historical' else 'ScenarioMIP'
+    pattern = f'{get_indir(model)}/CMIP6/{activity}/*/{model}/{experiment}/{run}/day/{var}/{grid}/{version}/*.nc'
+
+    return sorted(glob.glob(pattern))
+
+
+def find_runs(model, ssp):
+    """Find all the runs for a model/ssp."""
+
+    if CATALOGUE is not None:
+        return sorted(set(catalogue.search(CATALOGUE, model=model, experiment=ssp)['run']))
+
+    run_dirs = glob.glob(f'{get_indir(model)}/CMIP6/ScenarioMIP/*/{model}/{ssp}/r*')
+
+    return sorted(set(os.path.basename(run_dir) for run_dir in run_dirs))
+
+
+def python_task(name, script, args, inputs, outputs):
+    """Define a task that runs one of the programs in this repository.
+
+    Parameters
+    ----------
+    name : str
+        Unique task name
+    script : str
+        Program file name (e.g. ffdi.py)
+    args : list
+        Command line arguments for the program
+    inputs : list
+        Files read by the task
+    outputs : list
+        Files written by the task
+
+    Returns
+    -------
+    dict
+        Task definition
+    """
+
+    return {
+        'name': name,
+        'command': [sys.executable, os.path.join(CODE_DIR, script)] + [str(arg) for arg in args],
+        'inputs': list(inputs),
+        'outputs': list(outputs),
+    }
+
+
+def zarr_task(name, infiles, var, zarr_path, pencil_size):
+    """Define a task that rechunks netCDF files to a zarr collection.
+
+    The consolidated metadata file is only written once the collection is
+    complete, so it stands in for the collection as the task output.
+    An outdated collection is removed before the task is rerun.
+    """
+
+    temp_zarr = zarr_path.replace('.zarr', '_temp.zarr')
+    args = infiles + [var, zarr_path, temp_zarr, '--pencil_size', pencil_size]
+    task = python_task(name, 'nc_to_rechunked_zarr.py', args, infiles, [os.path.join(zarr_path, '.zmetadata')])
+    task['remove_before_run'] = [zarr_path]
+
+    return task
+
+
+def ffdi_tasks(model, ssp, run, grid, version, region, fused=True, pencil_size=20):
+    """Define the tasks for calculating FFDI for one model/ssp/run."""
+
+    ffdi_dir = f'{OUTPUT_DIR}/FFDI/{model}/{ssp}'
+    label = f'{model}_{ssp}_{run}'
+    files = {}
+    for var in FFDI_VARS:
+        files[var] = find_files(model, 'historical', run, var, grid, version)
+        files[var] = files[var] + find_files(model, ssp, run, var, grid, version)
+    pr_hist_files = find_files(model, 'historical', run, 'pr', grid, version)
+
+    tasks = []
+    pr_clim_path = f'{OUTPUT_DIR}/pr_yr-climatology_{model}_historical_{run}_{grid}_1950-2014.nc'
+    tasks.append(python_task(
+        f'pr_climatology_{model}_{run}',
+        'pr_climatology.py',
+        pr_hist_files + ['1950-01-01', '2014-12-31', pr_clim_path, '--region', region, '--cache_dir', CACHE_DIR],
+        pr_hist_files,
+        [pr_clim_path],
+    ))
+
+    FFDIx_path = f'{ffdi_dir}/FFDIx_yr_{model}_{ssp}_{run}_{grid}_1850-2100.nc'
+    FFDIgt99p_path = f'{ffdi_dir}/FFDIgt99p_yr_{model}_{ssp}_{run}_{grid}_1850-2100.nc'
+    if fused:
+        args = [FFDIx_path, FFDIgt99p_path, '--pr_annual_clim_file', pr_clim_path, '--region', region]
+        inputs = [pr_clim_path]
+        for var in FFDI_VARS:
+            args += [f'--{var}_files'] + files[var]
+            inputs += files[var]
+    else:
+        kbdi_files = [
+            os.path.join(ffdi_dir, os.path.basename(pr_file).replace('pr_day', 'KBDI_day')) for pr_file in files['pr']
+        ]
+        tasks.append(python_task(
+            f'kbdi_{label}',
+            'kbdi.py',
+            [pr_clim_path, '--pr_files'] + files['pr'] + ['--tasmax_files'] + files['tasmax']
+            + ['--outfiles'] + kbdi_files + ['--region', region, '--cache_dir', CACHE_DIR],
+            [pr_clim_path] + files['pr'] + files['tasmax'],
+            kbdi_files,
+        ))
+        args = [FFDIx_path, FFDIgt99p_path, '--kbdi_files'] + kbdi_files + ['--region', region]
+        inputs = list(kbdi_files)
+        for var in FFDI_VARS:
+            zarr_path = f'{ffdi_dir}/{var}_day_{model}_{ssp}_{run}_{grid}_1850-2100.zarr'
+            task = zarr_task(f'zarr_{var}_{label}', files[var], var, zarr_path, pencil_size)
+            tasks.append(task)
+            args += [f'--{var}_zarr', zarr_path]
+            inputs += task['outputs']
+    tasks.append(python_task(f'ffdi_{label}', 'ffdi.py', args, inputs, [FFDIx_path, FFDIgt99p_path]))
+
+    for metric, nc_path in [('FFDIx', FFDIx_path), ('FFDIgt99p', FFDIgt99p_path)]:
+        csv_path = f'{ffdi_dir}/{metric}_yr_{model}_{ssp}_{run}_aus-states_1850-2100.csv'
+        tasks.append(python_task(
+            f'csv_{metric}_{label}',
+            'nc_to_csv.py',
+            [nc_path, metric, csv_path, '--mask_arid', '--cache_dir', CACHE_DIR],
+            [nc_path],
+            [csv_path],
+        ))
+
+    return tasks
+
+
+def spei_tasks(model, ssp, run, grid, version, region):
+    """Define the tasks for calculating SPEI for one model/ssp/run.
+
+    Potential evapotranspiration is calculated in memory by spei.py.
+    The distribution parameters are fitted once per model/run (by the
+    historical task) and applied to each ssp without fitting again.
+    """
+
+    spei_dir = f'{OUTPUT_DIR}/SPEI/{model}/{ssp}'
+    hist_dir = f'{OUTPUT_DIR}/SPEI/{model}/historical'
+    label = f'{model}_{ssp}_{run}'
+    files = {}
+    for experiment in ['historical', ssp]:
+        tasmin_files = find_files(model, experiment, run, 'tasmin', grid, version)
+        files[experiment] = {
+            'pr': find_files(model, experiment, run, 'pr', grid, version),
+            'tasmin': tasmin_files,
+            'tasmax': [tasmin_path.replace('tasmin', 'tasmax') for tasmin_path in tasmin_files],
+        }
+
+    def spei_args(outfile, experiments):
+        """Define the spei.py arguments for a list of experiments."""
+        args = [outfile, '--dist', 'fisk']
+        inputs = []
+        for var in ['pr', 'tasmin', 'tasmax']:
+            var_files = [infile for experiment in experiments for infile in files[experiment][var]]
+            args = args + [f'--{var}_files'] + var_files
+            inputs = inputs + var_files
+        args = args + ['--params_file', params_path, '--region', region, '--cache_dir', CACHE_DIR]
+        return args, inputs
+
+    params_path = f'{OUTPUT_DIR}/SPEI/{model}/spei-params_mon_{model}_{run}_{grid}_fisk_1950-2014.nc'
+    hist_path = f'{hist_dir}/spei_mon_{model}_historical_{run}_{grid}_1850-2014.nc'
+    hist_args, hist_inputs = spei_args(hist_path, ['historical'])
+    spei_path = f'{spei_dir}/spei_mon_{model}_{ssp}_{run}_{grid}_1850-2100.nc'
+    ssp_args, ssp_inputs = spei_args(spei_path, ['historical', ssp])
+    tasks = [
+        python_task(f'spei_{model}_historical_{run}', 'spei.py', hist_args, hist_inputs, [hist_path, params_path]),
+        python_task(f'spei_{label}', 'spei.py', ssp_args, ssp_inputs + [params_path], [spei_path]),
+    ]
+    csv_path = f'{spei_dir}/spei_mon_{model}_{ssp}_{run}_aus-states_1850-2100.csv'
+    tasks.append(python_task(
+        f'csv_SPEI_{label}',
+        'nc_to_csv.py',
+        [spei_path, 'SPEI', csv_path, '--cache_dir', CACHE_DIR],
+        [spei_path],
+        [csv_path],
+    ))
+
+    return tasks
+
+
+def wsdi_tasks(model, ssp, run, grid, version, region):
+    """Define the tasks for calculating WSDI for one model/ssp/run."""
+
+    wsdi_dir = f'{OUTPUT_DIR}/WSDI/{model}/{ssp}'
+    label = f'{model}_{ssp}_{run}'
+    tasmax_files = find_files(model, 'historical', run, 'tasmax', grid, version)
+    tasmax_files = tasmax_files + find_files(model, ssp, run, 'tasmax', grid, version)
+
+    nc_path = f'{wsdi_dir}/wsdi_yr_{model}_{ssp}_{run}_{grid}_1850-2100.nc'
+    csv_path = f'{wsdi_dir}/wsdi_yr_{model}_{ssp}_{run}_aus-states-cities_1850-2100.csv'
+    tasks = [
+        python_task(f'wsdi_{label}', 'wsdi.py', tasmax_files + [nc_path, '--region', region, '--cache_dir', CACHE_DIR], tasmax_files, [nc_path]),
+        python_task(
+            f'csv_WSDI_{label}',
+            'nc_to_csv.py',
+            [nc_path, 'WSDI', csv_path, '--add_cities', '--cache_dir', CACHE_DIR],
+            [nc_path],
+            [csv_path],
+        ),
+    ]
+
+    return tasks
+
+
+def build_graph(task_list):
+    """Remove duplicate tasks and find the upstream tasks of each task.
+
+    Tasks shared between ssps (e.g. the precipitation climatology) are
+    only run once. A task depends on any task that writes one of its inputs.
+    """
+
+    tasks = {}
+    for task in task_list:
+        tasks.setdefault(task['name'], task)
+    producers = {}
+    for task in tasks.values():
+        for outfile in task['outputs']:
+            producers[outfile] = task['name']
+    for task in tasks.values():
+        task['deps'] = sorted(set(producers[infile] for infile in task['inputs'] if infile in producers))
+
+    return tasks
+
+
+def is_outdated(task):
+    """Check if any output of a task is missing or older than its (existing) inputs."""
+
+    if not all(os.path.exists(outfile) for outfile in task['outputs']):
+        return True
+    input_times = [os.path.getmtime(infile) for infile in task['inputs'] if os.path.exists(infile)]
+    if not input_times:
+        return False
+    output_time = min(os.path.getmtime(outfile) for outfile in task['outputs'])
+
+    return output_time < max(input_times)
+
+
+def plan(tasks):
+    """Find the tasks that need to be run.
+
+    A task is run if its inputs will change (an upstream task is run), or
+    if it is outdated and either writes a final product or is needed by a
+    downstream task that is run. Intermediate files that were removed
+    after use are therefore only recreated when something downstream
+    needs them.
+    """
+
+    dependants = {name: [] for name in tasks}
+    for name, task in tasks.items():
+        for dep in task['deps']:
+            dependants[dep].append(name)
+    outdated = {name: is_outdated(task) for name, task in tasks.items()}
+
+    to_run = set()
+    changed = True
+    while changed:
+        changed = False
+        for name, task in tasks.items():
+            if name in to_run:
+                continue
+            upstream_run = any(dep in to_run for dep in task['deps'])
+            needed = not dependants[name] or any(child in to_run for child in dependants[name])
+            if upstream_run or (outdated[name] and needed):
+                to_run.add(name)
+                changed = True
+
+    return to_run
+
+
+def run_task(task, threads, log_dir=None, profile_dir=None):
+    """Run a task in a subprocess.
+
+    Returns
+    -------
+    int
+        Exit code of the task
+    """
+
+    env = os.environ.copy()
+    for var in ['DASK_NUM_WORKERS', 'NUMBA_NUM_THREADS', 'OMP_NUM_THREADS']:
+        env[var] = str(threads)
+    for outfile in task['outputs']:
+        os.makedirs(os.path.dirname(outfile.split('.zarr')[0]), exist_ok=True)
+    for path in task.get('remove_before_run', []):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+    command = task['command']
+    if profile_dir:
+        command = command + ['--profile', os.path.join(profile_dir, f'{task["name"]}.json')]
+
+    start_time = time.time()
+    if log_dir:
+        with open(os.path.join(log_dir, f'{task["name"]}.log'), 'w') as log_file:
+            result = subprocess.run(command, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    else:
+        result = subprocess.run(command, env=env)
+    if result.returncode != 0:
+        for outfile in task['outputs']:
+            if os.path.isfile(outfile) and os.path.getmtime(outfile) >= start_time:
+                os.remove(outfile)
+
+    return result.returncode
+
+
+def run_tasks(tasks, to_run, workers=1, threads=1, log_dir=None, profile_dir=None):
+    """Run tasks once their upstream tasks have finished.
+
+    Returns
+    -------
+    list
+        Names of the tasks that failed or were not run due to an upstream failure
+    """
+
+    for directory in [log_dir, profile_dir]:
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    pending = set(to_run)
+    done = set(tasks) - pending
+    failed = []
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for name in sorted(pending):
+                deps = tasks[name]['deps']
+                if any(dep in failed for dep in deps):
+                    logging.error(f'{name}: not run (upstream task failed)')
+                    failed.append(name)
+                    pending.remove(name)
+                elif all(dep in done for dep in deps):
+                    logging.info(f'{name}: started')
+                    running[executor.submit(run_task, tasks[name], threads, log_dir, profile_dir)] = name
+                    pending.remove(name)
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    returncode = future.result()
+                except Exception as error:
+                    logging.error(f'{name}: {error}')
+                    returncode = 1
+                if returncode == 0:
+                    logging.info(f'{name}: finished')
+                    done.add(name)
+                else:
+                    logging.error(f'{name}: failed (exit code {returncode})')
+                    failed.append(name)
+
+    return failed
+
+
+def summarise_profiles(profile_dir):
+    """Combine the task profiles into a csv file and log the slowest stages.
+
+    Profiles from earlier runs of tasks that were skipped this time are included.
+    """
+
+    profile_files = sorted(glob.glob(os.path.join(profile_dir, '*.json')))
+    if not profile_files:
+        return
+    summary = profiling.aggregate(profile_files)
+    summary_file = os.path.join(profile_dir, 'profile_summary.csv')
+    summary.to_csv(summary_file, index=False)
+    logging.info(f'Profile summary for {len(profile_files)} tasks written to {summary_file}')
+    slowest = summary.sort_values('wall_time_s', ascending=False).head(5)
+    for row in slowest.itertuples():
+        logging.info(f'{row.profile} {row.stage}: {row.wall_time_s:.0f}s, peak memory {row.peak_rss_mb:.0f}MB')
+
+
+def main(args):
+    """Run the program."""
+
+    global CATALOGUE
+    if args.catalogue:
+        CATALOGUE = catalogue.read(args.catalogue)
+
+    task_functions = {'ffdi': ffdi_tasks, 'spei': spei_tasks, 'wsdi': wsdi_tasks}
+    task_list = []
+    for model in args.models:
+        for ssp in args.ssps:
+            runs = args.runs if args.runs else find_runs(model, ssp)
+            for run in runs:
+                for metric in args.metrics:
+                    options = {'fused': not args.ffdi_zarr} if metric == 'ffdi' else {}
+                    task_list += task_functions[metric](
+                        model, ssp, run, args.grid, args.version, args.region, **options
+                    )
+    tasks = build_graph(task_list)
+    to_run = plan(tasks)
+    logging.info(f'{len(tasks)} tasks ({len(to_run)} to run, {len(tasks) - len(to_run)} up to date)')
+
+    if args.dry_run:
+        for name, task in tasks.items():
+            status = 'run' if name in to_run else 'skip'
+            print(f'[{status}] {name}: {" ".join(task["command"])}')
+        return
+
+    workers = args.workers or max(1, len(os.sched_getaffinity(0)) // args.threads_per_task)
+    failed = run_tasks(
+        tasks, to_run, workers=workers, threads=args.threads_per_task, log_dir=args.log_dir, profile_dir=args.profile_dir
+    )
+    if args.profile_dir:
+        summarise_profiles(args.profile_dir)
+    if failed:
+        raise SystemExit(f'{len(failed)} task(s) failed: {", ".join(failed)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--models", type=str, nargs='*', required=True, help="models to process")
+    parser.add_argument("--ssps", type=str, nargs='*', required=True, help="ssps to process")
+    parser.add_argument("--metrics", type=str, nargs='*', choices=METRICS, default=METRICS, help="metrics to calculate [default=all]")
+    parser.add_argument("--runs", type=str, nargs='*', default=None, help="runs to process [default=all available runs]")
+    parser.add_argument("--grid", type=str, default='gn', help="grid label [default=gn]")
+    parser.add_argument("--version", type=str, default='*', help="version (e.g. latest, v20190429 or 'v*') [default=*]")
+    parser.add_argument("--catalogue", type=str, default=None,
+                        help="find the input files in this catalogue (see catalogue.py) instead of searching the file system")
+    parser.add_argument("--region", type=str, default='aus', help="region of interest for the calculations [default=aus]")
+    parser.add_argument("--ffdi_zarr", action="store_true", default=False,
+                        help="calculate FFDI via KBDI files and rechunked zarr collections (rather than in fused mode)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of tasks to run at once [default=available cores / threads_per_task]")
+    parser.add_argument("--threads_per_task", type=int, default=1, help="number of threads used by each task [default=1]")
+    parser.add_argument("--log_dir", type=str, default=None, help="write the output of each task to a log file in this directory")
+    parser.add_argument("--profile_dir", type=str, default=None,
+                        help="write a profile of each task (and a summary of all the profiles) to this directory")
+    parser.add_argument("--dry_run", action="store_true", default=False, help="list the tasks without running them")
+    args = parser.parse_args()
+    main(args)
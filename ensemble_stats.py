@@ -0,0 +1,514 @@
+"""Command line program for calculating ensemble statistics from many runs and models
+
+The annual (or monthly) metric files for every member of the ensemble
+(e.g. the WSDI for 57 EC-Earth3, 50 CanESM5 and 40 ACCESS-ESM1-5 runs)
+are read one member at a time, so the whole ensemble is never held in memory.
+For each grid cell (on a common grid) and for each region (the regional
+means that nc_to_csv.py writes for each member), the weighted ensemble
+mean, standard deviation and selected percentiles are calculated for each
+time step.
+
+By default each model counts equally (model democracy), so each run is
+weighted by one over the number of runs of its model.
+
+The grid cell percentiles are calculated exactly (from the values of every
+member for a block of time steps) or approximately from mergeable
+per-cell histograms (see exceedance.py), which need less memory when
+there are more members than histogram bins.
+"""
+
+import argparse
+import logging
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import xesmf as xe
+import dask.utils
+import cmdline_provenance as cmdprov
+
+import cache_utils
+import profiling
+import catalogue
+import exceedance
+import nc_to_csv
+import output_encoding
+
+
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_PERCENTILES = [10, 50, 90]
+SKETCH_RANGES = {
+    'WSDI': (0, 366),
+    'SPEI': (-5, 5),
+    'FFDIx': (0, 200),
+    'FFDIgt99p': (0, 366),
+}
+
+
+def open_member(infile):
+    """Open the metric file for an ensemble member (with the nc_to_csv.py model fixes)."""
+
+    ds = catalogue.open_dataset(infile, decode_timedelta=False)
+
+    return nc_to_csv.model_fixes(ds)
+
+
+def member_weights(infiles, weighting='model'):
+    """Define the weight of each ensemble member.
+
+    Parameters
+    ----------
+    infiles : list
+        Metric file for each member
+    weighting : {'model', 'member'}, default 'model'
+        Give each model equal weight (shared between its runs)
+        or give each member equal weight
+
+    Returns
+    -------
+    pandas.DataFrame
+        Model, run and weight of each member
+        (the weights add up to the number of members)
+    """
+
+    members = []
+    for infile in infiles:
+        with open_member(infile) as ds:
+            members.append((ds.attrs['source_id'], ds.attrs['variant_label']))
+    df = pd.DataFrame(members, columns=['model', 'run'])
+    if weighting == 'model':
+        runs_per_model = Counter(df['model'])
+        weights = np.array([1 / runs_per_model[model] for model in df['model']])
+    else:
+        weights = np.ones(len(df))
+    df['weight'] = weights * len(df) / weights.sum()
+
+    return df
+
+
+def time_labels(ds):
+    """Label each time step by its date (so members with different calendars line up)."""
+
+    return ds['time'].dt.strftime('%Y-%m-%d').values
+
+
+def weighted_quantiles(values, weights, quantiles):
+    """Weighted quantiles along the first (member) axis of an array.
+
+    Each member is placed at the midpoint of its share of the cumulative
+    weight and the quantiles are interpolated linearly between those
+    positions (below the first position or above the last, the smallest or
+    largest value is used). Because the positions are symmetric, reversing
+    the order of the values mirrors the quantiles, however unequal the
+    weights (with equal weights this is numpy's 'hazen' method).
+    Missing values are skipped.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Values with dimensions (member, cell)
+    weights : numpy.ndarray
+        Weight of each member
+    quantiles : list
+        Quantiles to calculate (between 0 and 1)
+
+    Returns
+    -------
+    numpy.ndarray
+        Quantiles with dimensions (quantile, cell)
+
+    Examples
+    --------
+    One run of one model (at 10) and 50 runs of another model (at 0),
+    with each model counting equally:
+
+    >>> values = np.array([[10.0]] + [[0.0]] * 50)
+    >>> weights = np.array([1.0] + [1 / 50] * 50)
+    >>> weighted_quantiles(values, weights, [0.1, 0.5, 0.9])[:, 0].round(2)
+    array([ 0. ,  0.2, 10. ])
+    >>> weighted_quantiles(10 - values, weights, [0.1, 0.5, 0.9])[:, 0].round(2)
+    array([ 0. ,  9.8, 10. ])
+    """
+
+    order = np.argsort(values, axis=0)
+    sorted_values = np.take_along_axis(values, order, axis=0)
+    valid = ~np.isnan(sorted_values)
+    sorted_weights = np.where(valid, weights[order], 0)
+    cumulative = np.cumsum(sorted_weights, axis=0)
+    nvalid = valid.sum(axis=0)
+    last = np.maximum(nvalid - 1, 0)[np.newaxis, :]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        positions = (cumulative - 0.5 * sorted_weights) / cumulative[-1]
+
+    results = []
+    for q in quantiles:
+        lower = np.clip(((positions <= q) & valid).sum(axis=0) - 1, 0, last[0])
+        upper = np.minimum(lower + 1, last[0])
+        lower_position = np.take_along_axis(positions, lower[np.newaxis, :], axis=0)[0]
+        upper_position = np.take_along_axis(positions, upper[np.newaxis, :], axis=0)[0]
+        lower_value = np.take_along_axis(sorted_values, lower[np.newaxis, :], axis=0)[0]
+        upper_value = np.take_along_axis(sorted_values, upper[np.newaxis, :], axis=0)[0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.where(upper_position > lower_position, (q - lower_position) / (upper_position - lower_position), 0)
+        result = lower_value + np.clip(fraction, 0, 1) * (upper_value - lower_value)
+        results.append(np.where(nvalid > 0, result, np.nan))
+
+    return np.stack(results)
+
+
+class EnsembleAccumulator:
+    """Running weighted ensemble statistics, updated one member at a time.
+
+    The mean and variance are updated with West's weighted algorithm.
+    For the percentiles, the values of every member are kept (exact method)
+    or added to per-cell histograms (sketch method).
+
+    Parameters
+    ----------
+    ncell : int
+        Number of values in each member (e.g. time steps x grid cells)
+    method : {'exact', 'sketch'}, default 'exact'
+        Percentile method
+    nbins : int, default 200
+        Number of histogram bins (sketch method)
+    value_range : tuple, default (0, 200)
+        Range of the histogram (sketch method);
+        values outside this range are counted in the end bins
+    """
+
+    def __init__(self, ncell, method='exact', nbins=200, value_range=(0, 200)):
+        assert method in ['exact', 'sketch'], f'Unrecognised method: {method}'
+        self.method = method
+        self.nbins = nbins
+        self.value_range = value_range
+        self.weight_total = np.zeros(ncell)
+        self.mean = np.zeros(ncell)
+        self.m2 = np.zeros(ncell)
+        self.values = []
+        self.weights = []
+        if method == 'sketch':
+            self.counts = np.zeros((nbins, ncell))
+
+    def add(self, values, weight):
+        """Add the values (with dimension cell) for one member."""
+
+        valid = ~np.isnan(values)
+        member_weight = np.where(valid, weight, 0)
+        self.weight_total += member_weight
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = np.where(valid, values - self.mean, 0)
+            self.mean += np.where(valid, member_weight / self.weight_total * delta, 0)
+        self.m2 += np.where(valid, member_weight * delta * (np.nan_to_num(values) - self.mean), 0)
+        if self.method == 'exact':
+            self.values.append(values)
+            self.weights.append(weight)
+        else:
+            min_value, max_value = self.value_range
+            exceedance.update_histogram(
+                self.counts, values[np.newaxis, :] - min_value, self.nbins, max_value - min_value, weight=weight
+            )
+
+    def result(self, quantiles):
+        """Calculate the ensemble statistics.
+
+        Returns
+        -------
+        mean : numpy.ndarray
+            Weighted mean
+        std : numpy.ndarray
+            Weighted standard deviation
+        percentiles : numpy.ndarray
+            Weighted quantiles with dimensions (quantile, cell)
+        """
+
+        no_data = self.weight_total == 0
+        mean = np.where(no_data, np.nan, self.mean)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.where(no_data, np.nan, np.sqrt(np.maximum(self.m2 / self.weight_total, 0)))
+        if self.method == 'exact':
+            percentiles = weighted_quantiles(np.stack(self.values), np.array(self.weights), quantiles)
+        else:
+            min_value, max_value = self.value_range
+            percentiles = np.stack([
+                exceedance.histogram_quantile(self.counts, q, max_value - min_value) + min_value for q in quantiles
+            ])
+
+        return mean, std, percentiles
+
+
+def get_regridder(ds, ds_grid, regridders, cache_dir=None):
+    """Get the regridder from a member's grid to the common grid.
+
+    Regridders are kept for each model grid (and their weights are cached in cache_dir).
+    """
+
+    key = cache_utils.grid_hash(ds)
+    if key not in regridders:
+        grid_ds = xr.Dataset(coords={'lat': ds['lat'], 'lon': ds['lon']})
+        weights_file = None
+        if cache_dir:
+            grid_key = cache_utils.hash_items(key, cache_utils.grid_hash(ds_grid))
+            weights_file = cache_utils.cache_path(cache_dir, 'regrid-weights', grid_key)
+        if weights_file and cache_utils.read_hit(weights_file):
+            regridders[key] = xe.Regridder(grid_ds, ds_grid, 'nearest_s2d', weights=weights_file)
+        else:
+            regridders[key] = xe.Regridder(grid_ds, ds_grid, 'nearest_s2d')
+            if weights_file:
+                cache_utils.write_atomic(regridders[key].to_netcdf, weights_file)
+
+    return regridders[key]
+
+
+def block_size(nlat, nlon, nvalues, max_bytes):
+    """Choose the number of time steps in each block so the block fits in a memory budget.
+
+    Each block holds nvalues numbers (members or histogram bins)
+    for each time step and grid cell.
+    """
+
+    return max(1, int(max_bytes // (nlat * nlon * nvalues * 8)))
+
+
+def calc_grid_stats(
+    infiles,
+    var,
+    weights_df,
+    dates,
+    ds_grid,
+    quantiles,
+    method='exact',
+    nbins=200,
+    value_range=(0, 200),
+    max_bytes=4e9,
+    cache_dir=None,
+):
+    """Calculate the ensemble statistics for each grid cell.
+
+    The time axis is processed in blocks, and for each block
+    the members are read (and regridded if need be) one at a time.
+
+    Parameters
+    ----------
+    infiles : list
+        Metric file for each member
+    var : str
+        Metric variable
+    weights_df : pandas.DataFrame
+        Weight of each member
+    dates : numpy.ndarray
+        Dates of the time steps (YYYY-MM-DD) of the ensemble
+    ds_grid : xarray.Dataset
+        Common horizontal grid
+    quantiles : list
+        Quantiles to calculate (between 0 and 1)
+    method : {'exact', 'sketch'}, default 'exact'
+        Percentile method
+    nbins : int, default 200
+        Number of histogram bins (sketch method)
+    value_range : tuple, default (0, 200)
+        Range of the histogram (sketch method)
+    max_bytes : float, default 4e9
+        Memory budget for each block (in bytes)
+    cache_dir : str, optional
+        Cache directory for the regridding weights
+
+    Returns
+    -------
+    xarray.Dataset
+    """
+
+    nlat = len(ds_grid['lat'])
+    nlon = len(ds_grid['lon'])
+    # Sorting the member values for the exact percentiles needs about six copies of them
+    nvalues = 6 * len(infiles) if method == 'exact' else nbins + 6
+    steps = block_size(nlat, nlon, nvalues, max_bytes)
+    logging.info(f'Calculating {len(dates)} time steps in blocks of {steps}')
+    regridders = {}
+    grid_key = cache_utils.grid_hash(ds_grid)
+    output_shape = (len(dates), nlat, nlon)
+    mean = np.full(output_shape, np.nan)
+    std = np.full(output_shape, np.nan)
+    percentiles = np.full((len(quantiles),) + output_shape, np.nan)
+    for block_start in range(0, len(dates), steps):
+        block_dates = dates[block_start:block_start + steps]
+        accumulator = EnsembleAccumulator(len(block_dates) * nlat * nlon, method=method, nbins=nbins, value_range=value_range)
+        for infile, weight in zip(infiles, weights_df['weight']):
+            with open_member(infile) as ds:
+                member_dates = time_labels(ds)
+                in_block = np.flatnonzero(np.isin(member_dates, block_dates))
+                block_values = np.full((len(block_dates), nlat, nlon), np.nan)
+                if len(in_block):
+                    da = ds[var].isel(time=slice(in_block[0], in_block[-1] + 1)).transpose('time', 'lat', 'lon')
+                    if cache_utils.grid_hash(ds) != grid_key:
+                        regridder = get_regridder(ds, ds_grid, regridders, cache_dir=cache_dir)
+                        da = regridder(da.to_dataset())[var]
+                    rows = np.searchsorted(block_dates, member_dates[in_block[0]:in_block[-1] + 1])
+                    block_values[rows] = da.values
+            accumulator.add(block_values.ravel(), weight)
+        block_mean, block_std, block_percentiles = accumulator.result(quantiles)
+        block_slice = slice(block_start, block_start + len(block_dates))
+        mean[block_slice] = block_mean.reshape(-1, nlat, nlon)
+        std[block_slice] = block_std.reshape(-1, nlat, nlon)
+        percentiles[:, block_slice] = block_percentiles.reshape(len(quantiles), -1, nlat, nlon)
+
+    coords = {'time': pd.to_datetime(dates), 'lat': ds_grid['lat'], 'lon': ds_grid['lon']}
+    dims = ('time', 'lat', 'lon')
+    ds_stats = xr.Dataset({
+        f'{var}_mean': xr.DataArray(mean, dims=dims, coords=coords),
+        f'{var}_std': xr.DataArray(std, dims=dims, coords=coords),
+        f'{var}_percentile': xr.DataArray(
+            percentiles,
+            dims=('percentile',) + dims,
+            coords={'percentile': [q * 100 for q in quantiles], **coords},
+        ),
+    })
+
+    return ds_stats
+
+
+def calc_region_stats(infiles, var, weights_df, dates, quantiles, region_options):
+    """Calculate the ensemble statistics for each region.
+
+    Each member is averaged over the regions on its own grid
+    (as in the csv files written by nc_to_csv.py).
+
+    Returns
+    -------
+    pandas.DataFrame
+        Statistics for each time step and region
+    """
+
+    accumulator = None
+    for infile, weight in zip(infiles, weights_df['weight']):
+        with open_member(infile) as ds:
+            matrix, abbrevs = nc_to_csv.get_region_matrix(ds, **region_options)
+            spatial_means = nc_to_csv.sparse_spatial_mean(ds[var].load(), matrix, abbrevs)
+            member_dates = time_labels(ds)
+        if accumulator is None:
+            region_abbrevs = abbrevs
+            accumulator = EnsembleAccumulator(len(dates) * len(region_abbrevs))
+        assert list(abbrevs) == list(region_abbrevs), f'Different regions for {infile}'
+        values = np.full((len(dates), len(region_abbrevs)), np.nan)
+        values[np.searchsorted(dates, member_dates)] = spatial_means.values
+        accumulator.add(values.ravel(), weight)
+    mean, std, percentiles = accumulator.result(quantiles)
+
+    time_index = pd.to_datetime(dates)
+    df = pd.DataFrame({
+        'year': np.repeat(time_index.year, len(region_abbrevs)),
+        'month': np.repeat(time_index.month, len(region_abbrevs)),
+        'region': np.tile(region_abbrevs, len(dates)),
+        'mean': mean,
+        'std': std,
+    })
+    for q, values in zip(quantiles, percentiles):
+        df[f'p{q * 100:g}'] = values
+    if var != 'SPEI':
+        df = df.drop(columns='month')
+
+    return df.round(decimals=2)
+
+
+def main(args):
+    """Run the program."""
+
+    profile = profiling.Profile(args.profile)
+    quantiles = [percentile / 100 for percentile in args.percentiles]
+    region_spec = None
+    if args.regions_file:
+        region_spec = {
+            'file': args.regions_file,
+            'names': args.region_names,
+            'abbrevs': args.region_abbrevs,
+        }
+
+    with profile.stage('open'):
+        weights_df = member_weights(args.infiles, weighting=args.weighting)
+        member_dates = []
+        grid_keys = set()
+        for infile in args.infiles:
+            with open_member(infile) as ds:
+                member_dates.append(time_labels(ds))
+                grid_keys.add(cache_utils.grid_hash(ds))
+                attrs = ds[args.var].attrs
+        dates = np.unique(np.concatenate(member_dates))
+        if args.grid_file:
+            with catalogue.open_dataset(args.grid_file) as ds:
+                ds_grid = xr.Dataset(coords={'lat': ds['lat'].load(), 'lon': ds['lon'].load()})
+        else:
+            assert len(grid_keys) == 1, 'The members are on different grids (use --grid_file)'
+            with open_member(args.infiles[0]) as ds:
+                ds_grid = xr.Dataset(coords={'lat': ds['lat'].load(), 'lon': ds['lon'].load()})
+    model_weights = weights_df.groupby('model')['weight'].agg(['count', 'sum'])
+    logging.info(f'Number of members and total weight for each model:\n{model_weights.to_string()}')
+
+    with profile.stage('grid_stats', nmembers=len(args.infiles)):
+        value_range = args.sketch_range or SKETCH_RANGES.get(args.var, (0, 200))
+        ds_stats = calc_grid_stats(
+            args.infiles,
+            args.var,
+            weights_df,
+            dates,
+            ds_grid,
+            quantiles,
+            method=args.method,
+            nbins=args.nbins,
+            value_range=value_range,
+            max_bytes=dask.utils.parse_bytes(args.max_mem),
+            cache_dir=args.cache_dir,
+        )
+    for var in ds_stats.data_vars:
+        ds_stats[var].attrs = attrs
+    ds_stats.attrs = {
+        'ensemble_members': ', '.join(f'{model} {run}' for model, run in zip(weights_df['model'], weights_df['run'])),
+        'ensemble_weighting': args.weighting,
+        'percentile_method': args.method,
+        'history': cmdprov.new_log(),
+    }
+    with profile.stage('write'):
+        output_encoding.write(ds_stats, args.outfile)
+
+    if args.csv_outfile:
+        with profile.stage('region_stats', nmembers=len(args.infiles)):
+            region_options = {
+                'arid_mask': args.mask_arid,
+                'cache_dir': args.cache_dir,
+                'region_spec': region_spec,
+            }
+            df = calc_region_stats(args.infiles, args.var, weights_df, dates, quantiles, region_options)
+            df.to_csv(args.csv_outfile, index=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("infiles", type=str, nargs='*', help="metric file for each ensemble member (e.g. from wsdi.py)")
+    parser.add_argument("var", type=str, help="metric variable (e.g. WSDI)")
+    parser.add_argument("outfile", type=str, help="output file name for the grid cell statistics (.nc or .zarr)")
+    parser.add_argument("--csv_outfile", type=str, default=None,
+                        help="output csv file name for the regional statistics")
+    parser.add_argument("--percentiles", type=float, nargs='*', default=DEFAULT_PERCENTILES,
+                        help="percentiles to calculate [default=10 50 90]")
+    parser.add_argument("--weighting", type=str, choices=('model', 'member'), default='model',
+                        help="give each model equal weight or each member equal weight [default=model]")
+    parser.add_argument("--method", type=str, choices=('exact', 'sketch'), default='exact',
+                        help="method for the grid cell percentiles [default=exact]")
+    parser.add_argument("--nbins", type=int, default=200, help="number of histogram bins for the sketch method [default=200]")
+    parser.add_argument("--sketch_range", type=float, nargs=2, default=None, metavar=('MIN', 'MAX'),
+                        help="range of the histograms for the sketch method [default=depends on var]")
+    parser.add_argument("--grid_file", type=str, default=None,
+                        help="regrid every member to the grid of this file [default=members must share a grid]")
+    parser.add_argument("--max_mem", type=str, default='4GB', help="memory ceiling for each block of time steps [default=4GB]")
+    parser.add_argument("--mask_arid", action="store_true", default=False, help="mask arid areas in the regional statistics")
+    parser.add_argument("--regions_file", type=str, default=None, help="shapefile of regions to use instead of the Australian states")
+    parser.add_argument("--region_names", type=str, default=None, help="column of regions_file holding the region names")
+    parser.add_argument("--region_abbrevs", type=str, default=None, help="column of regions_file holding the region abbreviations")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="directory for caching the region and regridding weights (no caching if not given)")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
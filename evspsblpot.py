@@ -1,4 +1,9 @@
-"""Command line program for calculating potential evapotranspiration (evspsblpot)"""
+"""Command line program for calculating potential evapotranspiration (evspsblpot)
+
+The input files for each variable are combined (lazily) into one dataset
+and the result is written to a single compressed netCDF file or
+Zarr collection (if the output file name ends with .zarr).
+"""
 
 import argparse
 
@@ -7,10 +12,22 @@ import xarray as xr
 import xclim as xc
 import dask.diagnostics
 import cmdline_provenance as cmdprov
+
+import roi
+import profiling
+import cache_utils
+import intermediates
+import catalogue
+import output_encoding
     
 
 dask.diagnostics.ProgressBar().register()
 
+INPUT_VARS = {
+    'hargreaves85': ['tasmin', 'tasmax'],
+    'allen98': ['tasmin', 'tasmax', 'hurs', 'sfcWind', 'rsds', 'rsus', 'rlds', 'rlus'],
+}
+
 
 def fix_metadata(ds, input_ds, method):
     """Fix evspsblpot metadata"""
@@ -34,42 +51,99 @@ def fix_metadata(ds, input_ds, method):
     return ds
 
 
+def open_inputs(input_files, bbox=None, time_chunk=3650):
+    """Open the files for each input variable as lazy (chunked) datasets.
+
+    Parameters
+    ----------
+    input_files : dict
+        Input files (in time order) for each variable
+    bbox : list, optional
+        Bounding box: [south bound, north bound, west bound, east bound]
+    time_chunk : int, default 3650
+        Number of time steps in each chunk
+
+    Returns
+    -------
+    dict
+        Dataset for each variable
+    """
+
+    input_ds = {}
+    for var, infiles in input_files.items():
+        assert infiles, f'No input files for {var}'
+        ds = catalogue.open_mfdataset(infiles, attrs_file=infiles[-1], preprocess=roi.get_preprocess(bbox))
+        input_ds[var] = ds.chunk({'time': time_chunk, 'lat': -1, 'lon': -1})
+
+    return input_ds
+
+
+def calc_evspsblpot(input_ds, method):
+    """Calculate the daily evspsblpot (lazily, one chunk at a time)."""
+
+    if method not in INPUT_VARS:
+        raise ValueError(f'unrecognised method: {method}')
+    kwargs = {var: input_ds[var][var] for var in INPUT_VARS[method]}
+    evspsblpot_da = xc.indices.potential_evapotranspiration(**kwargs, method=method)
+    evspsblpot_ds = evspsblpot_da.to_dataset(name='evspsblpot')
+    evspsblpot_ds = fix_metadata(evspsblpot_ds, input_ds['tasmin'], method)
+
+    return evspsblpot_ds
+
+
+def open_evspsblpot(infiles, bbox=None):
+    """Open evspsblpot netCDF files or a Zarr collection."""
+
+    return catalogue.open_mfdataset(infiles, attrs_file=infiles[-1], preprocess=roi.get_preprocess(bbox))
+
+
+def calc_cached(input_files, method, bbox, cache_dir, time_chunk=3650):
+    """Calculate evspsblpot one input file at a time, reusing cached results.
+
+    The nth file of each input variable are processed together, so the
+    results for the historical files can be shared between ssps
+    (the results for later files aren't cached).
+    """
+
+    nfiles = len(input_files['tasmin'])
+    assert all(len(infiles) == nfiles for infiles in input_files.values()), 'Need the same number of files for each variable'
+    keys = []
+    datasets = []
+    for index in range(nfiles):
+        group_files = {var: [infiles[index]] for var, infiles in input_files.items()}
+        key = intermediates.product_key('evspsblpot', [files[0] for files in group_files.values()], method, bbox)
+        keys.append(key)
+        if not intermediates.is_historical([files[0] for files in group_files.values()]):
+            datasets.append(calc_evspsblpot(open_inputs(group_files, bbox=bbox, time_chunk=time_chunk), method))
+            continue
+        path = intermediates.product_path(cache_dir, 'evspsblpot', key)
+        if not cache_utils.read_hit(path):
+            evspsblpot_ds = calc_evspsblpot(open_inputs(group_files, bbox=bbox, time_chunk=time_chunk), method)
+            intermediates.write(evspsblpot_ds, cache_dir, 'evspsblpot', key)
+        datasets.append(xr.open_dataset(path, chunks={'time': time_chunk}))
+    evspsblpot_ds = xr.concat(datasets, dim='time', combine_attrs='override')
+    evspsblpot_ds.attrs = datasets[-1].attrs
+    evspsblpot_ds.attrs[intermediates.KEY_ATTR] = cache_utils.hash_items(*keys)
+
+    return evspsblpot_ds
+
+
 def main(args):
     """Run the program."""
 
-    tasmax_ds = xr.open_dataset(args.tasmax_file)
-    tasmin_ds = xr.open_dataset(args.tasmin_file)
-
-    if args.method == 'hargreaves85':
-        evspsblpot_da = xc.indices.potential_evapotranspiration(
-            tasmin=tasmin_ds['tasmin'],
-            tasmax=tasmax_ds['tasmax'],
-            method=args.method,
-        )
-    elif args.method == 'allen98':
-        hurs_ds = xr.open_dataset(args.hurs_file)
-        sfcWind_ds = xr.open_dataset(args.sfcWind_file)
-        rsds_ds = xr.open_dataset(args.rsds_file)
-        rsus_ds = xr.open_dataset(args.rsus_file)
-        rlds_ds = xr.open_dataset(args.rlds_file)
-        rlus_ds = xr.open_dataset(args.rlus_file)
-        evspsblpot_da = xc.indices.potential_evapotranspiration(
-            tasmin=tasmin_ds['tasmin'],
-            tasmax=tasmax_ds['tasmax'],
-            hurs=hurs_ds['hurs'],
-            sfcWind=sfcWind_ds['sfcWind'],
-            rsds=rsds_ds['rsds'],
-            rsus=rsus_ds['rsus'],
-            rlds=rlds_ds['rlds'],
-            rlus=rlus_ds['rlus'],
-            method=args.method,
-        )
+    profile = profiling.Profile(args.profile)
+    bbox = roi.get_bbox(args)
+    input_files = {var: getattr(args, f'{var}_files') for var in INPUT_VARS[args.method]}
+    if args.cache_dir:
+        with profile.stage('cached_index'):
+            evspsblpot_ds = calc_cached(input_files, args.method, bbox, args.cache_dir, time_chunk=args.time_chunk)
     else:
-        raise ValueError(f'unrecognised method: {method}')
-
-    evspsblpot_ds = evspsblpot_da.to_dataset(name='evspsblpot')
-    evspsblpot_ds = fix_metadata(evspsblpot_ds, tasmin_ds, args.method)
-    evspsblpot_ds.to_netcdf(args.outfile)
+        with profile.stage('open'):
+            input_ds = open_inputs(input_files, bbox=bbox, time_chunk=args.time_chunk)
+        with profile.stage('index'):
+            evspsblpot_ds = calc_evspsblpot(input_ds, args.method)
+    with profile.stage('write'):
+        output_encoding.write(evspsblpot_ds, args.outfile, time_chunk=args.time_chunk)
 
 
 if __name__ == '__main__':
@@ -77,15 +151,20 @@ if __name__ == '__main__':
         description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
-    parser.add_argument("outfile", type=str, help="output file name")
+    parser.add_argument("outfile", type=str, help="output file name (.nc or .zarr)")
     parser.add_argument("method", type=str, choices=('hargreaves85', 'allen98'), help="method for calculating evspsblpot")
-    parser.add_argument("--tasmin_file", type=str, help="input daily minimum temperature file")
-    parser.add_argument("--tasmax_file", type=str, help="input daily maximum temperature file")
-    parser.add_argument("--hurs_file", type=str, help="input daily relative humidity file")
-    parser.add_argument("--sfcWind_file", type=str, help="input daily surface wind speed file")
-    parser.add_argument("--rsds_file", type=str, help="input daily surface downwelling shortwave file")
-    parser.add_argument("--rsus_file", type=str, help="input daily surface upwelling shortwave file")
-    parser.add_argument("--rlds_file", type=str, help="input daily surface downwelling longwave file")
-    parser.add_argument("--rlus_file", type=str, help="input daily surface upwelling longwave file")
+    parser.add_argument("--tasmin_files", "--tasmin_file", type=str, nargs='*', help="input daily minimum temperature files")
+    parser.add_argument("--tasmax_files", "--tasmax_file", type=str, nargs='*', help="input daily maximum temperature files")
+    parser.add_argument("--hurs_files", "--hurs_file", type=str, nargs='*', help="input daily relative humidity files")
+    parser.add_argument("--sfcWind_files", "--sfcWind_file", type=str, nargs='*', help="input daily surface wind speed files")
+    parser.add_argument("--rsds_files", "--rsds_file", type=str, nargs='*', help="input daily surface downwelling shortwave files")
+    parser.add_argument("--rsus_files", "--rsus_file", type=str, nargs='*', help="input daily surface upwelling shortwave files")
+    parser.add_argument("--rlds_files", "--rlds_file", type=str, nargs='*', help="input daily surface downwelling longwave files")
+    parser.add_argument("--rlus_files", "--rlus_file", type=str, nargs='*', help="input daily surface upwelling longwave files")
+    parser.add_argument("--time_chunk", type=int, default=3650, help="number of time steps in each chunk [default=3650]")
+    roi.add_arguments(parser)
+    profiling.add_arguments(parser)
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="share the output for each input file (e.g. the historical files) between runs via this cache directory")
     args = parser.parse_args()
     main(args)
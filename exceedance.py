@@ -0,0 +1,424 @@
+"""Annual maxima and threshold exceedance counts from daily data read once
+
+The daily data are read in time order. The threshold (a quantile of the
+data over a baseline period) is either calculated exactly from the
+largest baseline values or approximated from mergeable per-cell
+histograms. Only the largest baseline values are kept until the threshold
+is known; the days above the threshold in later years are counted as the
+data are read, and any years before the baseline are read again.
+"""
+
+import warnings
+
+import numpy as np
+import xarray as xr
+
+
+SKETCH_TAIL_FACTOR = 2
+
+def exact_quantile(values, q):
+    """Quantile along the first (time) axis of an array.
+
+    Uses numpy's selection-based (partition) quantile, which gives the
+    same result as the xarray quantile method (linear interpolation,
+    missing values skipped).
+    """
+
+    if np.isnan(values).any():
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            return np.nanquantile(values, q, axis=0)
+
+    return np.quantile(values, q, axis=0)
+
+
+def histogram_bins(values, nbins, max_value):
+    """Find the histogram bin for each value (values outside 0 to max_value go in the end bins)."""
+
+    width = max_value / nbins
+    bins = np.floor(np.nan_to_num(values, nan=0.0) / width)
+
+    return np.clip(bins, 0, nbins - 1).astype(np.int64)
+
+
+def update_histogram(counts, values, nbins, max_value, weight=1):
+    """Add values with dimensions (time, cell) to per-cell histogram counts (bin, cell).
+
+    Each value adds weight to the count for its bin
+    (e.g. for ensemble members that don't all count equally).
+    """
+
+    ncell = values.shape[1]
+    valid = ~np.isnan(values)
+    bins = histogram_bins(values, nbins, max_value)
+    flat_index = (bins * ncell + np.arange(ncell)[np.newaxis, :])[valid]
+    bin_counts = np.bincount(flat_index, minlength=nbins * ncell).reshape(nbins, ncell)
+    counts += (weight * bin_counts).astype(counts.dtype)
+
+
+def histogram_quantile(counts, q, max_value):
+    """Approximate quantile from per-cell histogram counts (bin, cell).
+
+    Values are assumed to be evenly spread within each bin.
+    """
+
+    nbins, ncell = counts.shape
+    width = max_value / nbins
+    total = counts.sum(axis=0)
+    rank = q * (total - 1)
+    cumulative = np.cumsum(counts, axis=0)
+    quantile_bin = np.argmax(cumulative > rank[np.newaxis, :], axis=0)
+    cells = np.arange(ncell)
+    count_before = cumulative[quantile_bin, cells] - counts[quantile_bin, cells]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        position = (rank - count_before + 0.5) / counts[quantile_bin, cells]
+    quantile = (quantile_bin + position) * width
+
+    return np.where(total > 0, quantile, np.nan)
+
+
+def tail_size(base_size, q, method='exact'):
+    """Number of the largest baseline values to keep in each cell.
+
+    The exact quantile (with linear interpolation) only depends on the two
+    values either side of position q * (base_size - 1) in the sorted values.
+    The sketch threshold can be a little lower than the exact quantile,
+    so SKETCH_TAIL_FACTOR times as many values are kept for the sketch method
+    in order to count the exceedances in the baseline years without reading them again.
+    """
+
+    size = base_size - int(np.floor(q * (base_size - 1)))
+    if method == 'sketch':
+        size = min(base_size, SKETCH_TAIL_FACTOR * size)
+
+    return size
+
+
+class LargestValues:
+    """The largest values added for each grid cell, each tagged with the year it came from.
+
+    Parameters
+    ----------
+    ncell : int
+        Number of grid cells
+    size : int, optional
+        Number of values to keep for each cell (all of them if None)
+    """
+
+    def __init__(self, ncell, size=None):
+        self.size = size
+        self.values = None
+        self.years = None
+        self.count = np.zeros(ncell, dtype=np.int64)
+        self.largest_dropped = np.full(ncell, -np.inf)
+
+    def add(self, values, year):
+        """Add values with dimensions (time, cell) for one year."""
+
+        valid = ~np.isnan(values)
+        self.count += valid.sum(axis=0)
+        values = np.where(valid, values, -np.inf).astype(values.dtype)
+        years = np.full(values.shape, year, dtype=np.int16)
+        if self.values is not None:
+            values = np.concatenate([self.values, values], axis=0)
+            years = np.concatenate([self.years, years], axis=0)
+        ndrop = len(values) - self.size if self.size is not None else 0
+        if ndrop > 0:
+            order = np.argpartition(values, ndrop, axis=0)
+            dropped = np.take_along_axis(values, order[:ndrop], axis=0).max(axis=0)
+            self.largest_dropped = np.maximum(self.largest_dropped, dropped)
+            values = np.take_along_axis(values, order[ndrop:], axis=0)
+            years = np.take_along_axis(years, order[ndrop:], axis=0)
+        self.values = values
+        self.years = years
+
+    def quantile(self, q):
+        """Quantile of all the (non-missing) values added, from the values kept.
+
+        Gives the same result as exact_quantile, by interpolating (with numpy)
+        between the same two values.
+        """
+
+        ncell = len(self.count)
+        if self.values is None:
+            return np.full(ncell, np.nan)
+        descending = -np.sort(-self.values, axis=0)
+        quantile = np.full(ncell, np.nan, dtype=self.values.dtype)
+        for count in np.unique(self.count[self.count > 0]):
+            cells = self.count == count
+            position = (count - 1) * q
+            lower = int(np.floor(position))
+            upper = min(lower + 1, count - 1)
+            assert count - 1 - lower < len(descending), 'Not enough values kept for the quantile'
+            bounds = descending[[count - 1 - lower, count - 1 - upper]][:, cells]
+            quantile[cells] = np.quantile(bounds, float(position - lower), axis=0)
+
+        return quantile
+
+    def count_above(self, threshold, year):
+        """Count the values from one year that are above the threshold in each cell."""
+
+        return ((self.years == year) & (self.values > threshold)).sum(axis=0)
+
+    def counts_complete(self, threshold):
+        """Check that no value above the threshold has been dropped (so count_above is exact)."""
+
+        return not np.any(self.largest_dropped > threshold)
+
+
+class AnnualExceedances:
+    """Annual maxima and counts of days above a baseline quantile, from data added one year at a time.
+
+    The years must be added in time order. Until the last day of the
+    baseline period has been added, the largest baseline values are kept
+    (only as many as the exact quantile needs, if base_size is given) and,
+    for the sketch method, the baseline values are added to per-cell
+    histograms. Once the threshold is known the exceedances for the years
+    within the baseline are counted from the values kept, and the
+    exceedances for later years are counted as they are added.
+
+    Nothing is held for years with days outside the baseline that are added
+    before the threshold is known (e.g. years before the baseline), or for
+    any years whose exceedances can't be counted from the values kept (if
+    the sketch threshold is lower than a value that wasn't kept). Those years
+    are listed by pop_recount_years and have to be added again (in time
+    order) once the threshold is known.
+
+    Parameters
+    ----------
+    ncell : int
+        Number of grid cells
+    q : float, default 0.99
+        Quantile of the baseline period used as the threshold
+    base_period : tuple, default ('1950-01-01', '2014-12-31')
+        Start and end date of the baseline period
+    method : {'exact', 'sketch'}, default 'exact'
+        Threshold method
+    nbins : int, default 512
+        Number of histogram bins (sketch method)
+    max_value : float, default 200
+        Upper limit of the histogram (sketch method)
+    threshold : numpy.ndarray, optional
+        Threshold for each cell, if already known (e.g. from a previous run)
+    base_size : int, optional
+        Number of days in the baseline period (to limit the values kept)
+    """
+
+    def __init__(
+        self,
+        ncell,
+        q=0.99,
+        base_period=('1950-01-01', '2014-12-31'),
+        method='exact',
+        nbins=512,
+        max_value=200.0,
+        threshold=None,
+        base_size=None,
+    ):
+        assert method in ['exact', 'sketch'], f'Unrecognised method: {method}'
+        self.q = q
+        self.base_period = base_period
+        self.method = method
+        self.nbins = nbins
+        self.max_value = max_value
+        self.threshold = threshold
+        self.pending = []
+        self.recount_years = []
+        if threshold is None:
+            size = None if base_size is None else tail_size(base_size, q, method=method)
+            self.base_largest = LargestValues(ncell, size=size)
+            if method == 'sketch':
+                self.base_counts = np.zeros((nbins, ncell), dtype=np.int64)
+
+    def add(self, year, dates, values):
+        """Add the daily values for one year.
+
+        Parameters
+        ----------
+        year : int
+            Year
+        dates : numpy.ndarray
+            Date of each day (YYYY-MM-DD)
+        values : numpy.ndarray
+            Values with dimensions (time, cell)
+
+        Returns
+        -------
+        list
+            (year, annual maximum, exceedances) for each year
+            whose exceedances are now known
+        """
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            annual_max = np.nanmax(values, axis=0)
+        if self.threshold is not None:
+            return [(year, annual_max, self.count(values))]
+
+        in_base = (dates >= self.base_period[0]) & (dates <= self.base_period[1])
+        if in_base.any():
+            base_values = values if in_base.all() else values[in_base]
+            self.base_largest.add(base_values, year)
+            if self.method == 'sketch':
+                update_histogram(self.base_counts, base_values, self.nbins, self.max_value)
+        if in_base.all():
+            self.pending.append((year, annual_max))
+        else:
+            self.recount_years.append(year)
+        if dates[-1] >= self.base_period[1]:
+            return self.set_threshold()
+
+        return []
+
+    def finish(self):
+        """Count the exceedances for any years still held (if the data end before the baseline does)."""
+
+        if self.threshold is None:
+            return self.set_threshold()
+
+        return []
+
+    def set_threshold(self):
+        """Calculate the threshold and count the exceedances for the years held until now."""
+
+        if self.method == 'exact':
+            self.threshold = self.base_largest.quantile(self.q)
+        else:
+            self.threshold = histogram_quantile(self.base_counts, self.q, self.max_value)
+            del self.base_counts
+        results = []
+        if self.base_largest.counts_complete(self.threshold):
+            for year, annual_max in self.pending:
+                results.append((year, annual_max, self.base_largest.count_above(self.threshold, year)))
+        else:
+            self.recount_years = sorted(self.recount_years + [year for year, annual_max in self.pending])
+        self.pending = []
+        del self.base_largest
+
+        return results
+
+    def pop_recount_years(self):
+        """Get (and forget) the years that have to be added again now that the threshold is known."""
+
+        assert self.threshold is not None, 'The threshold is not known yet'
+        years = self.recount_years
+        self.recount_years = []
+
+        return years
+
+    def count(self, values):
+        """Count the values above the threshold in each cell."""
+
+        return (values > self.threshold).sum(axis=0)
+
+
+def annual_metrics(
+    da,
+    q=0.99,
+    base_period=('1950-01-01', '2014-12-31'),
+    method='exact',
+    chunk_years=10,
+    nbins=512,
+    max_value=200.0,
+):
+    """Calculate the annual maximum and annual count of days above a baseline quantile.
+
+    The data are read chunk_years at a time (see AnnualExceedances), and
+    any years before the baseline are read again once the threshold is known.
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        Daily data with dimensions time, lat and lon
+    q : float, default 0.99
+        Quantile of the baseline period used as the threshold
+    base_period : tuple, default ('1950-01-01', '2014-12-31')
+        Start and end date of the baseline period
+    method : {'exact', 'sketch'}, default 'exact'
+        Calculate the threshold exactly (by keeping the data for the
+        baseline period in memory) or approximately (from per-cell histograms)
+    chunk_years : int, default 10
+        Number of years of data to read at once
+    nbins : int, default 512
+        Number of histogram bins (sketch method)
+    max_value : float, default 200
+        Upper limit of the histogram (sketch method); larger values are
+        counted in the top bin
+
+    Returns
+    -------
+    annual_max : xarray.DataArray
+        Annual maximum
+    annual_exceedances : xarray.DataArray
+        Annual number of days above the threshold
+    """
+
+    assert method in ['exact', 'sketch'], f'Unrecognised method: {method}'
+    spatial_dims = [dim for dim in da.dims if dim != 'time']
+    da = da.transpose('time', *spatial_dims)
+    spatial_shape = tuple(da.sizes[dim] for dim in spatial_dims)
+    ncell = int(np.prod(spatial_shape))
+
+    years = da['time'].dt.year.values
+    year_labels = da['time'].resample(time='YE').count()['time']
+    unique_years = np.unique(years)
+    assert len(unique_years) == len(year_labels), 'Input data must cover consecutive years'
+    dates = da['time'].dt.strftime('%Y-%m-%d').values
+    in_base = (dates >= base_period[0]) & (dates <= base_period[1])
+
+    def read_chunks(chunk_starts):
+        """Read the data chunk_years at a time."""
+        for chunk_start in chunk_starts:
+            chunk_years_list = unique_years[chunk_start:chunk_start + chunk_years]
+            time_index = np.flatnonzero(np.isin(years, chunk_years_list))
+            values = da.isel(time=slice(time_index[0], time_index[-1] + 1)).values.reshape(len(time_index), ncell)
+            yield chunk_years_list, time_index, values
+
+    chunk_starts = range(0, len(unique_years), chunk_years)
+    exceedance_counter = AnnualExceedances(
+        ncell,
+        q=q,
+        base_period=base_period,
+        method=method,
+        nbins=nbins,
+        max_value=max_value,
+        base_size=int(in_base.sum()),
+    )
+    results = []
+    for chunk_years_list, time_index, values in read_chunks(chunk_starts):
+        chunk_year_values = years[time_index]
+        for year in chunk_years_list:
+            year_index = chunk_year_values == year
+            results += exceedance_counter.add(year, dates[time_index][year_index], values[year_index])
+    results += exceedance_counter.finish()
+    recount_years = exceedance_counter.pop_recount_years()
+    recount_starts = [start for start in chunk_starts if np.isin(unique_years[start:start + chunk_years], recount_years).any()]
+    for chunk_years_list, time_index, values in read_chunks(recount_starts):
+        chunk_year_values = years[time_index]
+        for year in chunk_years_list:
+            if year in recount_years:
+                year_index = chunk_year_values == year
+                results += exceedance_counter.add(year, dates[time_index][year_index], values[year_index])
+    results.sort(key=lambda result: result[0])
+    annual_max = np.stack([year_max for year, year_max, year_exceedances in results])
+    exceedances = np.stack([year_exceedances for year, year_max, year_exceedances in results])
+
+    output_dims = ('time', *spatial_dims)
+    output_coords = {'time': year_labels}
+    for dim in spatial_dims:
+        output_coords[dim] = da[dim]
+    output_shape = (len(unique_years),) + spatial_shape
+    annual_max_da = xr.DataArray(
+        annual_max.reshape(output_shape),
+        dims=output_dims,
+        coords=output_coords,
+        attrs=da.attrs,
+    )
+    annual_exceedances_da = xr.DataArray(
+        exceedances.reshape(output_shape),
+        dims=output_dims,
+        coords=output_coords,
+    )
+    annual_exceedances_da = annual_exceedances_da.assign_coords({'quantile': q})
+
+    return annual_max_da, annual_exceedances_da
@@ -1,15 +1,47 @@
 """Command line program for calculating the Forest Fire Danger Index (FFDI)"""
 
 import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import numpy as np
 import xarray as xr
 import xclim as xc
+import dask.utils
 import dask.diagnostics
 import cmdline_provenance as cmdprov
+
+import kbdi
+import tiling
+import exceedance
+import roi
+import profiling
+import catalogue
+import output_encoding
+import partitions
+import intermediates
+import cache_utils
     
 
 dask.diagnostics.ProgressBar().register()
+# force=True because importing xclim has already configured the root logger
+logging.basicConfig(level=logging.INFO, force=True)
+
+BASE_START = '1950-01-01'
+BASE_END = '2014-12-31'
+THRESHOLD_QUANTILE = 0.99
+# The drought factor depends on the precipitation over the previous 20 days
+DF_WINDOW = 20
+ZARR_VARS = ['pr', 'tasmax', 'hursmin', 'sfcWindmax']
+# The five inputs, the drought factor, FFDI and the threshold calculation
+# hold about twelve copies of each tile in memory
+TILE_COPIES = 12
+# Inputs opened once by each worker in tiled mode (see init_tile_worker)
+TILE_INPUTS = None
+DAYS_PER_YEAR = 366
+# Each baseline value kept for the threshold (see exceedance.LargestValues)
+# has a value and a year
+KEPT_VALUE_BYTES = 10
 
 
 def fix_metadata(ds, input_ds):
@@ -33,45 +65,699 @@ def fix_metadata(ds, input_ds):
     return ds
 
 
-def main(args):
-    """Run the program."""
+def calc_ffdi(pr_da, tasmax_da, hursmin_da, sfcWindmax_da, kbdi_da):
+    """Calculate the daily FFDI."""
 
-    # Drought Factor
-    kbdi_ds = xr.open_mfdataset(args.kbdi_files, attrs_file=args.kbdi_files[-1])
-    ntime = len(kbdi_ds['KBDI'].time)
-    nlat = len(kbdi_ds['KBDI'].lat)
-    nlon = len(kbdi_ds['KBDI'].lon)
-    kbdi_ds = kbdi_ds.chunk({'time': ntime, 'lat': nlat, 'lon': nlon})
-    pr_ds = xr.open_dataset(args.pr_zarr, engine='zarr')
-    pr_ds['pr'] = xc.core.units.convert_units_to(pr_ds['pr'], 'mm/day')
-    df_da = xc.indices.griffiths_drought_factor(pr_ds['pr'], kbdi_ds['KBDI'])
-
-    # FFDI
-    tasmax_ds = xr.open_dataset(args.tasmax_zarr, engine='zarr')
-    #tasmax_ds['tasmax'] = xc.core.units.convert_units_to(tasmax_ds['tasmax'], 'degC')
-    hursmin_ds = xr.open_dataset(args.hursmin_zarr, engine='zarr')
-    sfcWindmax_ds = xr.open_dataset(args.sfcWindmax_zarr, engine='zarr')
+    pr_da = xc.core.units.convert_units_to(pr_da, 'mm/day')
+    df_da = xc.indices.griffiths_drought_factor(pr_da, kbdi_da)
     ffdi_da = xc.indices.mcarthur_forest_fire_danger_index(
         df_da,
-        tasmax_ds['tasmax'],
-        hursmin_ds['hursmin'],
-        sfcWindmax_ds['sfcWindmax']
+        tasmax_da,
+        hursmin_da,
+        sfcWindmax_da
     )
-    ffdi_ds = ffdi_da.to_dataset(name='FFDI')
-    ffdi_ds = fix_metadata(ffdi_ds, tasmax_ds)
 
-    # Metrics
-    FFDIx_da = ffdi_ds['FFDI'].resample({'time': 'YE'}).max('time', keep_attrs=True)
+    return ffdi_da
+
+
+def calc_metrics(ffdi_ds, method='xarray', sketch_bins=512, sketch_max=200.0):
+    """Calculate the annual FFDI metrics.
+
+    The xarray method needs the whole time axis in a single chunk and
+    reads the FFDI data twice. The exact and sketch methods calculate both
+    metrics from a single read of (in-memory) FFDI data
+    (see exceedance.annual_metrics).
+    """
+
+    if method == 'xarray':
+        FFDIx_da = ffdi_ds['FFDI'].resample({'time': 'YE'}).max('time', keep_attrs=True)
+        FFDI99p_da = ffdi_ds['FFDI'].sel(time=slice(BASE_START, BASE_END)).quantile(THRESHOLD_QUANTILE, dim='time')
+        FFDIgt99p_da = ffdi_ds['FFDI'] > FFDI99p_da
+        FFDIgt99p_da = FFDIgt99p_da.resample({'time': 'YE'}).sum('time', keep_attrs=True)
+    else:
+        FFDIx_da, FFDIgt99p_da = exceedance.annual_metrics(
+            ffdi_ds['FFDI'],
+            q=THRESHOLD_QUANTILE,
+            base_period=(BASE_START, BASE_END),
+            method=method,
+            nbins=sketch_bins,
+            max_value=sketch_max,
+        )
+
     FFDIx_ds = FFDIx_da.to_dataset(name='FFDIx')
     FFDIx_ds.attrs = ffdi_ds.attrs
-    FFDIx_ds.to_netcdf(args.FFDIx_outfile)
-
-    FFDI99p_da = ffdi_ds['FFDI'].sel(time=slice('1950-01-01', '2014-12-31')).quantile(0.99, dim='time')
-    FFDIgt99p_da = ffdi_ds['FFDI'] > FFDI99p_da
-    FFDIgt99p_da = FFDIgt99p_da.resample({'time': 'YE'}).sum('time', keep_attrs=True)
     FFDIgt99p_ds = FFDIgt99p_da.to_dataset(name='FFDIgt99p')
     FFDIgt99p_ds.attrs = ffdi_ds.attrs
-    FFDIgt99p_ds.to_netcdf(args.FFDIgt99p_outfile)
+
+    return FFDIx_ds, FFDIgt99p_ds
+
+
+def get_tile_size(args, ntime, nlat, nlon, workers=1, reserved_bytes=0):
+    """Get the largest tile size (from the command line or the memory budget for each worker).
+
+    Any memory reserved for data other than the tiles
+    (e.g. a year of the inputs for the whole grid) is taken out of the budget first.
+    """
+
+    if args.tile_size:
+        return args.tile_size
+
+    max_bytes = dask.utils.parse_bytes(args.max_mem) - reserved_bytes
+    assert max_bytes > 0, f'--max_mem {args.max_mem} is too small (at least {reserved_bytes} bytes are needed)'
+
+    return tiling.tile_size_for_memory(
+        ntime, nlat, nlon, max_bytes / workers, bytes_per_value=8, copies=TILE_COPIES
+    )
+
+
+def calc_ffdi_year(year_ds, pr_annual_clim_da, state=None, pr_tail=None):
+    """Calculate the daily FFDI for one year, carrying on from the end of the previous year.
+
+    Parameters
+    ----------
+    year_ds : dict
+        Input dataset (for one year) for each variable
+    pr_annual_clim_da : xarray.DataArray
+        Annual precipitation climatology
+    state : xarray.Dataset, optional
+        KBDI state at the end of the previous year (see kbdi.initial_state)
+    pr_tail : xarray.DataArray, optional
+        Precipitation (mm/day) for the last DF_WINDOW - 1 days of the previous year
+
+    Returns
+    -------
+    ffdi_ds : xarray.Dataset
+        Daily FFDI
+    state : xarray.Dataset
+        KBDI state at the end of the year
+    pr_tail : xarray.DataArray
+        Precipitation for the last DF_WINDOW - 1 days of the year
+    """
+
+    pr_da = xc.core.units.convert_units_to(year_ds['pr']['pr'], 'mm/day')
+    tasmax_da = year_ds['tasmax']['tasmax']
+    hursmin_da = year_ds['hursmin']['hursmin']
+    sfcWindmax_da = year_ds['sfcWindmax']['sfcWindmax']
+    kbdi_da, state = kbdi.calc_kbdi(pr_da, tasmax_da, pr_annual_clim_da, state=state)
+    if pr_tail is None:
+        ffdi_da = calc_ffdi(pr_da, tasmax_da, hursmin_da, sfcWindmax_da, kbdi_da)
+    else:
+        # Only the precipitation from the previous year is needed (for the drought factor)
+        pr_extended_da = xr.concat([pr_tail, pr_da], dim='time', combine_attrs='override')
+        time = pr_extended_da['time']
+        ffdi_da = calc_ffdi(
+            pr_extended_da,
+            tasmax_da.reindex(time=time),
+            hursmin_da.reindex(time=time),
+            sfcWindmax_da.reindex(time=time),
+            kbdi_da.reindex(time=time),
+        )
+        ffdi_da = ffdi_da.sel(time=pr_da['time'])
+    ffdi_ds = fix_metadata(ffdi_da.to_dataset(name='FFDI'), year_ds['tasmax'])
+    pr_tail = pr_da.isel(time=slice(-(DF_WINDOW - 1), None))
+
+    return ffdi_ds, state, pr_tail
+
+
+def year_partition(FFDIx_ds, FFDIgt99p_ds, state, pr_tail):
+    """Define the partition for one year (annual metrics plus the state carried to the next year)."""
+
+    partition_ds = xr.Dataset({
+        'FFDIx': FFDIx_ds['FFDIx'],
+        'FFDIgt99p': FFDIgt99p_ds['FFDIgt99p'],
+        'KBDI': state['KBDI'],
+        'runoff_remaining': state['runoff_remaining'],
+        'pr_tail': pr_tail.rename({'time': 'tail_time'}),
+    })
+    partition_ds.attrs = FFDIx_ds.attrs
+
+    return partition_ds
+
+
+def read_carried_state(partition_ds):
+    """Read the KBDI state and precipitation carried over from the partition for the previous year."""
+
+    state = partition_ds[['KBDI', 'runoff_remaining']]
+    state.attrs['end_date'] = ''
+    pr_tail = partition_ds['pr_tail'].rename({'tail_time': 'time'})
+
+    return state, pr_tail
+
+
+def fused_input_files(args):
+    """Get the input files for each variable (fused mode)."""
+
+    return {
+        'pr': args.pr_files,
+        'tasmax': args.tasmax_files,
+        'hursmin': args.hursmin_files,
+        'sfcWindmax': args.sfcWindmax_files,
+    }
+
+
+def open_fused_inputs(input_files, pr_annual_clim_file, bbox):
+    """Open the input files and annual precipitation climatology (fused mode).
+
+    Each input file is a single dask chunk, so that selecting one year
+    only reads the storage chunks that overlap that year.
+    """
+
+    input_ds = {}
+    for var, infiles in input_files.items():
+        assert infiles, f'No input files for {var}'
+        input_ds[var] = catalogue.open_mfdataset(
+            infiles, attrs_file=infiles[-1], preprocess=roi.get_preprocess(bbox), chunks={'time': -1}
+        )
+    pr_annual_clim_da = roi.subset(catalogue.open_dataset(pr_annual_clim_file), bbox)['pr'].load()
+
+    return input_ds, pr_annual_clim_da
+
+
+def count_base_days(ds):
+    """Count the days of the baseline period in a dataset."""
+
+    dates = ds['time'].dt.strftime('%Y-%m-%d').values
+
+    return int(((dates >= BASE_START) & (dates <= BASE_END)).sum())
+
+
+def read_year(input_ds, year):
+    """Read one year of the inputs for the whole grid."""
+
+    return {var: ds.sel(time=str(year)).compute() for var, ds in input_ds.items()}
+
+
+class FusedTiles:
+    """Daily FFDI and its annual metrics, calculated one year and one spatial tile at a time.
+
+    Each year of the inputs is read once for the whole grid and split into
+    tiles. The KBDI state and the last few days of precipitation for each
+    tile are carried on to the next year, and the daily FFDI for each tile
+    goes to an exceedance counter (see exceedance.AnnualExceedances), which
+    only keeps the largest baseline values until the threshold is known.
+    The years the counters can't count at that point (e.g. the years before
+    the baseline) are calculated again from the first year (see recount_years).
+
+    Parameters
+    ----------
+    tiles : list
+        Index selection for each spatial tile (see tiling.spatial_tiles)
+    base_size : int, optional
+        Number of days in the baseline period (see exceedance.AnnualExceedances)
+    threshold_da : xarray.DataArray, optional
+        FFDI threshold, if already known (e.g. from a partition directory)
+    method : {'exact', 'sketch'}, default 'exact'
+        Threshold method
+    sketch_bins : int, default 512
+        Number of histogram bins (sketch method)
+    sketch_max : float, default 200
+        Upper limit of the histogram (sketch method)
+    """
+
+    def __init__(self, tiles, base_size=None, threshold_da=None, method='exact', sketch_bins=512, sketch_max=200.0):
+        self.tiles = tiles
+        self.carry = [(None, None)] * len(tiles)
+        self.recount_carry = None
+        self.recount = [[] for tile in tiles]
+        self.counters = []
+        for tile in tiles:
+            threshold = None
+            if threshold_da is not None:
+                threshold = threshold_da.isel(tile).transpose('lat', 'lon').values.reshape(-1)
+            nlat, nlon = self.tile_shape(tile)
+            self.counters.append(exceedance.AnnualExceedances(
+                nlat * nlon,
+                q=THRESHOLD_QUANTILE,
+                base_period=(BASE_START, BASE_END),
+                method=method,
+                nbins=sketch_bins,
+                max_value=sketch_max,
+                threshold=threshold,
+                base_size=base_size,
+            ))
+        self.tile_results = {}
+        self.year_labels = {}
+        self.template_ds = None
+        self.ffdi_attrs = None
+
+    @staticmethod
+    def tile_shape(tile):
+        """Number of grid points in a tile: (lat size, lon size)."""
+
+        return (tile['lat'].stop - tile['lat'].start, tile['lon'].stop - tile['lon'].start)
+
+    def set_carry(self, state, pr_tail):
+        """Carry on from the KBDI state and precipitation at the end of the previous year."""
+
+        self.carry = [(state.isel(tile), pr_tail.isel(tile)) for tile in self.tiles]
+
+    def get_carry(self):
+        """Get the KBDI state and precipitation (for the whole grid) at the end of the last year added."""
+
+        state = xr.combine_by_coords([state for state, pr_tail in self.carry], combine_attrs='override')
+        pr_tail = xr.combine_by_coords(
+            [pr_tail.to_dataset(name='pr') for state, pr_tail in self.carry], combine_attrs='override'
+        )['pr']
+
+        return state, pr_tail
+
+    def add_year(self, year, year_ds, pr_annual_clim_da, recount=False):
+        """Calculate the daily FFDI for one year.
+
+        Parameters
+        ----------
+        year : int
+            Year
+        year_ds : dict
+            Input dataset (for one year and the whole grid) for each variable
+        pr_annual_clim_da : xarray.DataArray
+            Annual precipitation climatology
+        recount : bool, default False
+            Calculate the year again for the tiles that need it (see recount_years)
+
+        Returns
+        -------
+        list
+            (year, FFDIx dataset, FFDIgt99p dataset) for each year
+            whose metrics are now known
+        """
+
+        self.template_ds = year_ds['tasmax']
+        self.year_labels[year] = year_ds['tasmax']['time'].resample(time='YE').count()['time']
+        carry = self.recount_carry if recount else self.carry
+        for index, tile in enumerate(self.tiles):
+            if recount and not self.recount[index]:
+                continue
+            state, pr_tail = carry[index]
+            tile_ds = {var: ds.isel(tile) for var, ds in year_ds.items()}
+            ffdi_ds, state, pr_tail = calc_ffdi_year(
+                tile_ds, pr_annual_clim_da.isel(tile), state=state, pr_tail=pr_tail
+            )
+            carry[index] = (state, pr_tail)
+            if recount:
+                if year not in self.recount[index]:
+                    continue
+                self.recount[index].remove(year)
+            ffdi_da = ffdi_ds['FFDI'].transpose('time', 'lat', 'lon')
+            self.ffdi_attrs = (ffdi_da.attrs, ffdi_ds.attrs)
+            dates = ffdi_da['time'].dt.strftime('%Y-%m-%d').values
+            values = ffdi_da.values.reshape(len(dates), -1)
+            self.add_results(index, self.counters[index].add(year, dates, values))
+
+        return self.metrics()
+
+    def finish(self):
+        """Get the metrics for any years still held (if the inputs end before the baseline does)."""
+
+        for index, counter in enumerate(self.counters):
+            self.add_results(index, counter.finish())
+
+        return self.metrics()
+
+    def threshold_known(self):
+        """Check if the threshold is known (it is found for every tile at once)."""
+
+        return all(counter.threshold is not None for counter in self.counters)
+
+    def recount_years(self):
+        """Get the years that have to be calculated again now that the threshold is known.
+
+        Those years are added again with add_year(..., recount=True),
+        along with every year before them (to carry the KBDI state on),
+        starting from the first year.
+        """
+
+        if not self.threshold_known():
+            return []
+        for index, counter in enumerate(self.counters):
+            self.recount[index] += counter.pop_recount_years()
+        years = sorted(set(year for tile_years in self.recount for year in tile_years))
+        if years:
+            self.recount_carry = [(None, None)] * len(self.tiles)
+
+        return years
+
+    def add_results(self, index, results):
+        """Keep the (year, annual maximum, exceedances) results for one tile until every tile has them."""
+
+        for year, annual_max, exceedances in results:
+            self.tile_results.setdefault(year, {})[index] = (annual_max, exceedances)
+
+    def grid_array(self, tile_values, dtype):
+        """Put the (flattened) values for each tile together on the whole grid."""
+
+        array = np.empty((self.template_ds.sizes['lat'], self.template_ds.sizes['lon']), dtype=dtype)
+        for tile, values in zip(self.tiles, tile_values):
+            array[tile['lat'], tile['lon']] = values.reshape(self.tile_shape(tile))
+
+        return array
+
+    def threshold(self):
+        """Get the FFDI threshold for the whole grid."""
+
+        thresholds = [counter.threshold for counter in self.counters]
+        threshold_da = xr.DataArray(
+            self.grid_array(thresholds, thresholds[0].dtype),
+            dims=('lat', 'lon'),
+            coords={'lat': self.template_ds['lat'], 'lon': self.template_ds['lon']},
+            attrs=self.ffdi_attrs[0],
+        )
+
+        return threshold_da
+
+    def metrics(self):
+        """Define the FFDIx and FFDIgt99p datasets for each year whose metrics are known for every tile."""
+
+        var_attrs, global_attrs = self.ffdi_attrs
+        complete_years = [year for year in sorted(self.tile_results) if len(self.tile_results[year]) == len(self.tiles)]
+        metrics = []
+        for year in complete_years:
+            year_results = self.tile_results.pop(year)
+            year_results = [year_results[index] for index in range(len(self.tiles))]
+            coords = {'time': self.year_labels.pop(year), 'lat': self.template_ds['lat'], 'lon': self.template_ds['lon']}
+            annual_max = [result[0] for result in year_results]
+            FFDIx_da = xr.DataArray(
+                self.grid_array(annual_max, annual_max[0].dtype)[np.newaxis, ...],
+                dims=('time', 'lat', 'lon'),
+                coords=coords,
+                attrs=var_attrs,
+            )
+            FFDIgt99p_da = xr.DataArray(
+                self.grid_array([result[1] for result in year_results], np.int64)[np.newaxis, ...],
+                dims=('time', 'lat', 'lon'),
+                coords=coords,
+            )
+            FFDIx_ds = FFDIx_da.to_dataset(name='FFDIx')
+            FFDIx_ds.attrs = global_attrs
+            FFDIgt99p_ds = FFDIgt99p_da.to_dataset(name='FFDIgt99p')
+            FFDIgt99p_ds.attrs = global_attrs
+            metrics.append((year, FFDIx_ds, FFDIgt99p_ds))
+
+        return metrics
+
+
+def recalculate_years(fused, input_ds, pr_annual_clim_da, years, profile):
+    """Calculate the years again that couldn't be counted before the threshold was known (see FusedTiles)."""
+
+    recount_years = fused.recount_years()
+    metrics = []
+    for year in years:
+        if not recount_years or year > recount_years[-1]:
+            break
+        with profile.stage('reread_year', year=int(year)):
+            year_ds = read_year(input_ds, year)
+        with profile.stage('recount_year', year=int(year)):
+            metrics += fused.add_year(year, year_ds, pr_annual_clim_da, recount=True)
+
+    return metrics
+
+
+def fused_tiles(args, input_ds, base_size=None):
+    """Get the spatial tiles for fused mode.
+
+    The memory budget has to hold a year of the inputs for the whole grid
+    and the largest baseline values kept for the threshold (for every grid
+    cell), and the rest of it sets the tile size.
+    """
+
+    tasmax_ds = input_ds['tasmax']
+    nlat = len(tasmax_ds['lat'])
+    nlon = len(tasmax_ds['lon'])
+    year_bytes = DAYS_PER_YEAR * nlat * nlon * sum(ds[var].dtype.itemsize for var, ds in input_ds.items())
+    kept_size = 0 if base_size is None else exceedance.tail_size(base_size, THRESHOLD_QUANTILE, method=args.threshold_method)
+    kept_bytes = kept_size * nlat * nlon * KEPT_VALUE_BYTES
+    tile_size = get_tile_size(
+        args, DAYS_PER_YEAR + DF_WINDOW + kept_size, nlat, nlon, reserved_bytes=year_bytes + kept_bytes
+    )
+
+    return list(tiling.spatial_tiles(tasmax_ds, tile_size))
+
+
+def main_fused(args, profile):
+    """Run the program in fused mode.
+
+    KBDI, the drought factor and FFDI are calculated in memory,
+    so that only the FFDIx and FFDIgt99p files are written.
+    The inputs are read one year at a time (see FusedTiles), and the
+    calculation for each year is done one spatial tile at a time, with
+    tiles as large as the memory budget allows. Only the largest baseline
+    FFDI values are kept until the threshold is known, and the years before
+    the baseline are then read and calculated again.
+    """
+
+    bbox = roi.get_bbox(args)
+    with profile.stage('open'):
+        input_ds, pr_annual_clim_da = open_fused_inputs(fused_input_files(args), args.pr_annual_clim_file, bbox)
+    years = list(np.unique(input_ds['tasmax']['time'].dt.year.values))
+    base_size = count_base_days(input_ds['tasmax'])
+    tiles = fused_tiles(args, input_ds, base_size=base_size)
+    fused = FusedTiles(
+        tiles,
+        base_size=base_size,
+        method=args.threshold_method,
+        sketch_bins=args.sketch_bins,
+        sketch_max=args.sketch_max,
+    )
+
+    metrics = []
+    for year in years:
+        with profile.stage('read_year', year=int(year)):
+            year_ds = read_year(input_ds, year)
+        with profile.stage('index_year', year=int(year)):
+            metrics += fused.add_year(year, year_ds, pr_annual_clim_da)
+            if year == years[-1]:
+                metrics += fused.finish()
+        metrics += recalculate_years(fused, input_ds, pr_annual_clim_da, years, profile)
+    metrics.sort(key=lambda item: item[0])
+
+    with profile.stage('write'):
+        FFDIx_ds = xr.concat([FFDIx_ds for year, FFDIx_ds, FFDIgt99p_ds in metrics], dim='time')
+        output_encoding.write(FFDIx_ds, args.FFDIx_outfile)
+        FFDIgt99p_ds = xr.concat([FFDIgt99p_ds for year, FFDIx_ds, FFDIgt99p_ds in metrics], dim='time')
+        FFDIgt99p_ds = FFDIgt99p_ds.assign_coords({'quantile': THRESHOLD_QUANTILE})
+        output_encoding.write(FFDIgt99p_ds, args.FFDIgt99p_outfile)
+
+
+def main_partitioned(args, profile):
+    """Run the program in fused mode with an annual partition directory (see partitions.py).
+
+    The FFDIx, FFDIgt99p, KBDI state and last few days of precipitation
+    for each year are kept in the partition directory. Only the years whose
+    inputs (or the inputs for any year before them) have changed are
+    recalculated, carrying on from the saved state of the year before.
+
+    The 99th percentile threshold is kept too, and is only recalculated if
+    the inputs up to the end of the baseline change. Every year is then
+    recalculated in the same way as in fused mode (see FusedTiles), with the
+    KBDI state at the end of each year held until its metrics are known.
+    """
+
+    input_files = fused_input_files(args)
+    bbox = roi.get_bbox(args)
+    with profile.stage('fingerprint'):
+        fingerprints = partitions.year_fingerprints(input_files)
+        clim_signature = intermediates.input_signature(args.pr_annual_clim_file)
+        keys = partitions.chain_keys(fingerprints, clim_signature, bbox)
+        years = sorted(keys)
+        base_years = [year for year in years if int(BASE_START[:4]) <= year <= int(BASE_END[:4])]
+        assert base_years, f'No input data for the baseline period ({BASE_START} to {BASE_END})'
+        baseline_key = cache_utils.hash_items('ffdi-threshold', keys[base_years[-1]], THRESHOLD_QUANTILE)
+        manifest = partitions.read_manifest(args.partition_dir)
+        if partitions.baseline_is_current(args.partition_dir, manifest, baseline_key):
+            threshold_da = partitions.read_baseline(args.partition_dir)['threshold']
+            stale_years = partitions.stale_years(args.partition_dir, manifest, keys)
+        else:
+            threshold_da = None
+            stale_years = years
+    logging.info(f'Calculating FFDI for {len(stale_years)} of {len(years)} years')
+
+    with profile.stage('open'):
+        input_ds, pr_annual_clim_da = open_fused_inputs(input_files, args.pr_annual_clim_file, bbox)
+    base_size = None if threshold_da is not None else count_base_days(input_ds['tasmax'])
+    fused = FusedTiles(fused_tiles(args, input_ds, base_size=base_size), base_size=base_size, threshold_da=threshold_da)
+    carried = {}
+    next_year = None
+    for year in stale_years:
+        if year != next_year and year != years[0]:
+            fused.set_carry(*read_carried_state(partitions.read_partition(args.partition_dir, year - 1)))
+        with profile.stage('read_year', year=year):
+            year_ds = read_year(input_ds, year)
+        with profile.stage('index_year', year=year):
+            metrics = fused.add_year(year, year_ds, pr_annual_clim_da)
+            if year == stale_years[-1]:
+                metrics += fused.finish()
+            carried[year] = fused.get_carry()
+        next_year = year + 1
+        metrics += recalculate_years(fused, input_ds, pr_annual_clim_da, years, profile)
+        if threshold_da is None and fused.threshold_known():
+            threshold_da = fused.threshold()
+            partitions.write_baseline(
+                threshold_da.to_dataset(name='threshold'), args.partition_dir, manifest, baseline_key
+            )
+        for metrics_year, FFDIx_ds, FFDIgt99p_ds in metrics:
+            partition_ds = year_partition(FFDIx_ds, FFDIgt99p_ds, *carried.pop(metrics_year))
+            partitions.write_partition(partition_ds, args.partition_dir, manifest, metrics_year, keys[metrics_year])
+
+    with profile.stage('write'):
+        for var, outfile in [('FFDIx', args.FFDIx_outfile), ('FFDIgt99p', args.FFDIgt99p_outfile)]:
+            ds = partitions.stitch(args.partition_dir, years, [var])
+            if var == 'FFDIgt99p':
+                ds = ds.assign_coords({'quantile': THRESHOLD_QUANTILE})
+            ds.attrs['history'] = cmdprov.new_log()
+            output_encoding.write(ds, outfile)
+
+
+def open_inputs(kbdi_files, zarr_paths, bbox):
+    """Open the KBDI files and the Zarr collection for each other input variable.
+
+    The Zarr collections are opened without dask, so selecting a tile
+    only reads the storage chunks that overlap it.
+    """
+
+    input_ds = {
+        'KBDI': catalogue.open_mfdataset(
+            kbdi_files, attrs_file=kbdi_files[-1], preprocess=roi.get_preprocess(bbox), chunks={'time': -1}
+        )
+    }
+    for var, zarr_path in zarr_paths.items():
+        input_ds[var] = roi.subset(xr.open_dataset(zarr_path, engine='zarr'), bbox)
+
+    return input_ds
+
+
+def chunk_layout(ds, var, bbox):
+    """Find the storage chunk size and chunk starts of an input on the region of interest grid.
+
+    Returns
+    -------
+    chunk_sizes : dict
+        Storage chunk size along each horizontal dimension
+    starts : dict
+        Positions (on the region of interest grid) where the chunks start
+    """
+
+    chunks = tiling.storage_chunks(ds[var])
+    chunk_sizes = {dim: chunks.get(dim, ds.sizes[dim]) for dim in ['lat', 'lon']}
+    ds = ds.assign_coords({f'{dim}_index': (dim, np.arange(ds.sizes[dim])) for dim in ['lat', 'lon']})
+    ds = roi.subset(ds, bbox)
+    starts = {dim: tiling.chunk_starts(ds[f'{dim}_index'].values, chunk_sizes[dim]) for dim in ['lat', 'lon']}
+
+    return chunk_sizes, starts
+
+
+def init_tile_worker(kbdi_files, zarr_paths, bbox):
+    """Open the inputs once for all the tiles calculated by a worker.
+
+    The inputs are opened in each worker (rather than passed to it),
+    so that tiles can be calculated in separate processes.
+    """
+
+    global TILE_INPUTS
+    TILE_INPUTS = open_inputs(kbdi_files, zarr_paths, bbox)
+
+
+def calc_tile_metrics(tile, method, sketch_bins=512, sketch_max=200.0):
+    """Calculate the annual FFDI metrics for one spatial tile (from the inputs opened by init_tile_worker)."""
+
+    tile_ds = {var: ds.isel(tile).compute(scheduler='synchronous') for var, ds in TILE_INPUTS.items()}
+    ffdi_da = calc_ffdi(
+        tile_ds['pr']['pr'],
+        tile_ds['tasmax']['tasmax'],
+        tile_ds['hursmin']['hursmin'],
+        tile_ds['sfcWindmax']['sfcWindmax'],
+        tile_ds['KBDI']['KBDI'],
+    )
+    ffdi_ds = fix_metadata(ffdi_da.to_dataset(name='FFDI'), tile_ds['tasmax'])
+
+    return calc_metrics(ffdi_ds, method=method, sketch_bins=sketch_bins, sketch_max=sketch_max)
+
+
+def main_tiled(args, profile):
+    """Run the program from KBDI files and rechunked Zarr collections.
+
+    The inputs are read one spatial tile at a time. The tiles are as large
+    as the memory budget for each worker allows, with edges that line up
+    with the storage chunks of the inputs (e.g. the pencils written by
+    nc_to_rechunked_zarr.py and kbdi.py), so each chunk is only read once.
+    Tiles are calculated in parallel by a pool of threads or processes,
+    each of which opens the inputs once.
+    """
+
+    bbox = roi.get_bbox(args)
+    zarr_paths = {var: getattr(args, f'{var}_zarr') for var in ZARR_VARS}
+    workers = args.workers or dask.config.get('num_workers', None) or 1
+    tile_args = (args.kbdi_files, zarr_paths, bbox)
+    with profile.stage('open'):
+        layouts = {}
+        with catalogue.open_dataset(args.kbdi_files[0]) as ds:
+            layouts['KBDI'] = chunk_layout(ds, 'KBDI', bbox)
+        for var, zarr_path in zarr_paths.items():
+            assert zarr_path, f'No Zarr collection for {var}'
+            with xr.open_dataset(zarr_path, engine='zarr') as ds:
+                layouts[var] = chunk_layout(ds, var, bbox)
+        init_tile_worker(*tile_args)
+        sizes = {dim: TILE_INPUTS['KBDI'].sizes[dim] for dim in ['lat', 'lon']}
+        tile_size = get_tile_size(args, TILE_INPUTS['KBDI'].sizes['time'], sizes['lat'], sizes['lon'], workers=workers)
+        chunk_sizes = {dim: [layout[0][dim] for layout in layouts.values()] for dim in ['lat', 'lon']}
+        starts = {dim: [layout[1][dim] for layout in layouts.values()] for dim in ['lat', 'lon']}
+        tiles = list(tiling.aligned_tiles(sizes, tile_size, chunk_sizes, starts))
+    large_chunk_vars = [
+        var for var, (var_chunk_sizes, _) in layouts.items()
+        if var_chunk_sizes['lat'] > min(tile_size[0], sizes['lat']) or var_chunk_sizes['lon'] > min(tile_size[1], sizes['lon'])
+    ]
+    if large_chunk_vars:
+        logging.warning(
+            f'The storage chunks of {", ".join(large_chunk_vars)} are larger than the tiles, '
+            'so each chunk is read for every tile it overlaps (rewrite the inputs in smaller pencils to avoid this)'
+        )
+    logging.info(f'Calculating {len(tiles)} tiles (at most {tile_size[0]} x {tile_size[1]}) with {workers} {args.scheduler}')
+
+    tile_options = {
+        'method': args.threshold_method,
+        'sketch_bins': args.sketch_bins,
+        'sketch_max': args.sketch_max,
+    }
+    # Stages can't be recorded from several threads at once,
+    # so parallel tiles are profiled as one stage
+    if workers == 1:
+        tile_results = []
+        for tile in tiles:
+            tile_bounds = {dim: [index.start, index.stop] for dim, index in tile.items()}
+            with profile.stage('tile', tile=tile_bounds):
+                tile_results.append(calc_tile_metrics(tile, **tile_options))
+    else:
+        if args.scheduler == 'processes':
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=init_tile_worker, initargs=tile_args)
+        else:
+            # Threads share the inputs opened above
+            executor = ThreadPoolExecutor(max_workers=workers)
+        with profile.stage('tiles', ntiles=len(tiles), workers=workers, scheduler=args.scheduler):
+            with executor:
+                futures = [executor.submit(calc_tile_metrics, tile, **tile_options) for tile in tiles]
+                tile_results = [future.result() for future in futures]
+
+    with profile.stage('write'):
+        FFDIx_ds = xr.combine_by_coords([results[0] for results in tile_results], combine_attrs='override')
+        output_encoding.write(FFDIx_ds, args.FFDIx_outfile)
+        FFDIgt99p_ds = xr.combine_by_coords([results[1] for results in tile_results], combine_attrs='override')
+        output_encoding.write(FFDIgt99p_ds, args.FFDIgt99p_outfile)
+
+
+def main(args):
+    """Run the program."""
+
+    profile = profiling.Profile(args.profile)
+    if args.threshold_method is None:
+        # Tiled mode keeps the two-pass xarray quantile of the original program
+        args.threshold_method = 'exact' if args.pr_files else 'xarray'
+    if args.pr_files and args.partition_dir:
+        main_partitioned(args, profile)
+        return
+    if args.pr_files:
+        main_fused(args, profile)
+        return
+
+    main_tiled(args, profile)
 
 
 if __name__ == '__main__':
@@ -79,12 +765,36 @@ if __name__ == '__main__':
         description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
-    parser.add_argument("FFDIx_outfile", type=str, help="FFDIx output file name")
-    parser.add_argument("FFDIgt99p_outfile", type=str, help="FFDIgt99p output file name")
+    parser.add_argument("FFDIx_outfile", type=str, help="FFDIx output file name (.nc or .zarr)")
+    parser.add_argument("FFDIgt99p_outfile", type=str, help="FFDIgt99p output file name (.nc or .zarr)")
     parser.add_argument("--pr_zarr", type=str, help="input daily precipitation zarr collection")
     parser.add_argument("--tasmax_zarr", type=str, help="input daily maximum temperature zarr collection")
     parser.add_argument("--hursmin_zarr", type=str, help="input daily minimum relative humidity zarr collection")
     parser.add_argument("--sfcWindmax_zarr", type=str, help="input daily maximum surface wind speed zarr collection")
     parser.add_argument("--kbdi_files", type=str, nargs='*', help="input daily Keetch-Byram Drought Index files")
+    parser.add_argument("--pr_files", type=str, nargs='*', help="input daily precipitation files (fused mode)")
+    parser.add_argument("--tasmax_files", type=str, nargs='*', help="input daily maximum temperature files (fused mode)")
+    parser.add_argument("--hursmin_files", type=str, nargs='*', help="input daily minimum relative humidity files (fused mode)")
+    parser.add_argument("--sfcWindmax_files", type=str, nargs='*', help="input daily maximum surface wind speed files (fused mode)")
+    parser.add_argument("--pr_annual_clim_file", type=str, help="input annual precipitation climatology file (fused mode)")
+    parser.add_argument("--tile_size", type=int, nargs=2, default=None, metavar=('NLAT', 'NLON'),
+                        help="largest number of grid points in each spatial tile [default=as large as --max_mem allows]")
+    parser.add_argument("--max_mem", type=str, default='8GB', help="memory ceiling for the tiles (shared between workers) [default=8GB]")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of tiles to calculate in parallel [default=DASK_NUM_WORKERS or 1]")
+    parser.add_argument("--scheduler", type=str, choices=('threads', 'processes'), default='threads',
+                        help="run the parallel tiles in threads or processes [default=threads]")
+    parser.add_argument("--threshold_method", type=str, choices=('exact', 'sketch', 'xarray'), default=None,
+                        help="method for the FFDIgt99p threshold: exact quantile, approximate histogram sketch or two-pass xarray quantile (not in fused mode) [default=exact in fused mode, otherwise xarray]")
+    parser.add_argument("--sketch_bins", type=int, default=512, help="number of histogram bins for the sketch method [default=512]")
+    parser.add_argument("--sketch_max", type=float, default=200.0, help="upper limit of the histogram for the sketch method [default=200]")
+    parser.add_argument("--partition_dir", type=str, default=None,
+                        help="keep the metrics for each year in this directory and only recalculate years whose inputs have changed (fused mode)")
+    roi.add_arguments(parser)
+    profiling.add_arguments(parser)
     args = parser.parse_args()
+    if args.pr_files and args.threshold_method == 'xarray':
+        parser.error('the xarray threshold method needs the whole FFDI time series, so it is not available in fused mode (use exact)')
+    if args.partition_dir and args.threshold_method not in (None, 'exact'):
+        parser.error('--partition_dir keeps the exact threshold, so it needs --threshold_method exact')
     main(args)
@@ -28,15 +28,16 @@ else
     indir=/g/data/oi10/replicas
 fi
 ffdi_dir=/g/data/xv83/dbi599/treasury/FFDI/${model}/${ssp}
+cache_dir=/g/data/xv83/dbi599/treasury/cache
 
-# Keetch-Byram Drought Index (KBDI)
+# Annual precipitation climatology (for the Keetch-Byram Drought Index)
 
 pr_hist_files=(`ls ${indir}/CMIP6/CMIP/*/${model}/historical/${run}/day/pr/${grid}/${version}/*.nc`)
 pr_ssp_files=(`ls ${indir}/CMIP6/ScenarioMIP/*/${model}/${ssp}/${run}/day/pr/${grid}/${version}/*.nc`)
 pr_files=( "${pr_hist_files[@]}" "${pr_ssp_files[@]}" )
 
 pr_clim_path=/g/data/xv83/dbi599/treasury/pr_yr-climatology_${model}_historical_${run}_${grid}_1950-2014.nc
-pr_clim_command="${python} /home/599/dbi599/treasury/pr_climatology.py ${pr_hist_files[@]} 1950-01-01 2014-12-31 ${pr_clim_path}"
+pr_clim_command="${python} /home/599/dbi599/treasury/pr_climatology.py ${pr_hist_files[@]} 1950-01-01 2014-12-31 ${pr_clim_path} --region aus --cache_dir ${cache_dir}"
 if [[ "${flags}" == "-e" ]] ; then
     mkdir -p ${ffdi_dir}
     echo ${pr_clim_command}
@@ -45,40 +46,10 @@ else
     echo ${pr_clim_command}
 fi
 
-kbdi_files=()
-for pr_path in "${pr_files[@]}"; do
-    tasmax_path=`echo ${pr_path} | sed s:pr:tasmax:g`
-    kbdi_file=`basename ${pr_path} | sed s:pr:kbdi:g`
-    kbdi_path=${ffdi_dir}/${kbdi_file}
-    kbdi_files+=(${kbdi_path})
-    kbdi_command="${python} /home/599/dbi599/treasury/kbdi.py ${pr_path} ${tasmax_path} ${pr_clim_path} ${kbdi_path}"
-    if [[ "${flags}" == "-e" ]] ; then
-        echo ${kbdi_command}
-        ${kbdi_command}
-    else
-        echo ${kbdi_command}
-    fi 
-done
-
-# Zarr
-
-for var in pr tasmax hursmin sfcWindmax; do
+for var in tasmax hursmin sfcWindmax; do
     hist_files=(`ls ${indir}/CMIP6/CMIP/*/${model}/historical/${run}/day/${var}/${grid}/${version}/*.nc`)
     ssp_files=(`ls ${indir}/CMIP6/ScenarioMIP/*/${model}/${ssp}/${run}/day/${var}/${grid}/${version}/*.nc`)
-    hist_dates=`basename "${hist_files[0]}" | cut -d _ -f 7`
-    start_date=`echo ${hist_dates} | cut -d - -f 1`
-    ssp_dates=`basename "${ssp_files[-1]}" | cut -d _ -f 7`
-    end_date=`echo ${ssp_dates} | cut -d - -f 2`
-    end_date=`echo ${end_date} | cut -d . -f 1`
-    zarr_file=${ffdi_dir}/${var}_day_${model}_${ssp}_${run}_${grid}_${start_date}-${end_date}.zarr
-    declare ${var}_zarr_file=${zarr_file}
-    zarr_command="/g/data/xv83/dbi599/miniconda3/envs/agcd/bin/python /home/599/dbi599/treasury/nc_to_rechunked_zarr.py ${hist_files[@]} ${ssp_files[@]} ${var} ${zarr_file} /g/data/xv83/dbi599/treasury/temp.zarr"
-    if [[ "${flags}" == "-e" ]] ; then
-        echo ${zarr_command}
-        ${zarr_command}
-    else
-        echo ${zarr_command}
-    fi
+    eval "${var}_files=( ${hist_files[@]} ${ssp_files[@]} )"
 done
 
 # FFDI
@@ -88,31 +59,27 @@ FFDIgt99p_nc_path=${ffdi_dir}/FFDIgt99p_yr_${model}_${ssp}_${run}_${grid}_1850-2
 FFDIx_csv_path=${ffdi_dir}/FFDIx_yr_${model}_${ssp}_${run}_aus-states_1850-2100.csv
 FFDIgt99p_csv_path=${ffdi_dir}/FFDIgt99p_yr_${model}_${ssp}_${run}_aus-states_1850-2100.csv
 
-ffdi_command="${python} /home/599/dbi599/treasury/ffdi.py ${FFDIx_nc_path} ${FFDIgt99p_nc_path} --pr_zarr ${pr_zarr_file} --tasmax_zarr ${tasmax_zarr_file} --hursmin_zarr ${hursmin_zarr_file} --sfcWindmax_zarr ${sfcWindmax_zarr_file} --kbdi_files ${kbdi_files[@]}"
-FFDIx_csv_command="${python} /home/599/dbi599/treasury/nc_to_csv.py ${FFDIx_nc_path} FFDIx ${FFDIx_csv_path} --mask_arid"
-FFDIgt99p_csv_command="${python} /home/599/dbi599/treasury/nc_to_csv.py ${FFDIgt99p_nc_path} FFDIgt99p ${FFDIgt99p_csv_path} --mask_arid"
+ffdi_command="${python} /home/599/dbi599/treasury/ffdi.py ${FFDIx_nc_path} ${FFDIgt99p_nc_path} --pr_annual_clim_file ${pr_clim_path} --pr_files ${pr_files[@]} --tasmax_files ${tasmax_files[@]} --hursmin_files ${hursmin_files[@]} --sfcWindmax_files ${sfcWindmax_files[@]} --region aus"
+csv_manifest=${ffdi_dir}/csv-manifest_${model}_${ssp}_${run}.csv
+csv_command="${python} /home/599/dbi599/treasury/nc_to_csv.py --manifest ${csv_manifest} --mask_arid --cache_dir ${cache_dir} --workers 2"
 if [[ "${flags}" == "-e" ]] ; then
     echo ${ffdi_command}
     ${ffdi_command}
-    echo ${FFDIx_csv_command}
-    ${FFDIx_csv_command}
-    echo ${FFDIgt99p_csv_command}
-    ${FFDIgt99p_csv_command}
+    echo "infile,var,outfile" > ${csv_manifest}
+    echo "${FFDIx_nc_path},FFDIx,${FFDIx_csv_path}" >> ${csv_manifest}
+    echo "${FFDIgt99p_nc_path},FFDIgt99p,${FFDIgt99p_csv_path}" >> ${csv_manifest}
+    echo ${csv_command}
+    ${csv_command}
 else
     echo ${ffdi_command}
-    echo ${FFDIx_csv_command}
-    echo ${FFDIgt99p_csv_command}
+    echo ${csv_command}
 fi
 
 # Clean up
 
 if [[ "${flags}" == "-c" ]] ; then
     rm ${pr_clim_path}
-    rm ${kbdi_files[@]}
-    rm -r ${pr_zarr_file}
-    rm -r ${tasmax_zarr_file}
-    rm -r ${hursmin_zarr_file}
-    rm -r ${sfcWindmax_zarr_file}
+    rm ${csv_manifest}
 fi
 
 
@@ -0,0 +1,190 @@
+"""Cache of intermediate products that can be shared between experiments
+
+Products calculated from the historical experiment (e.g. the precipitation
+climatology, the KBDI up to 2014 or the SPEI calibration parameters) are the
+same for every ssp, so they are cached under a key made from the input
+files and calculation options rather than the output file name.
+Only products calculated from historical input files are worth caching
+(see is_historical). A cached product that is also an output file is
+stored once, with the cache entry and output file hard linked where possible
+(so the last use of a product is recorded in a separate file, see cache_utils.read_hit).
+Products not used for MAX_DAYS days are removed from the cache, then the least
+recently used products until the cache is smaller than MAX_GB.
+"""
+
+import os
+import shutil
+import logging
+
+import xarray as xr
+
+import cache_utils
+import catalogue
+import output_encoding
+
+
+CACHE_SUBDIR = 'intermediates'
+KEY_ATTR = 'intermediate_cache_key'
+HISTORICAL_END = '2014-12-31'
+MAX_GB = 100
+MAX_DAYS = 90
+
+
+def input_signature(path):
+    """Describe an input file for a cache key.
+
+    Files that came from this cache are described by their cache key (so a
+    copy of a cached product is recognised as the same content), while all
+    other files (including catalogue reference files) are described by
+    their path, size and modification time.
+    """
+
+    if catalogue.is_reference(path):
+        return cache_utils.file_signature(path)
+    with catalogue.open_dataset(path, decode_times=False) as ds:
+        key = ds.attrs.get(KEY_ATTR)
+    if key:
+        return (KEY_ATTR, key)
+
+    return cache_utils.file_signature(path)
+
+
+def files_before(infiles, end_date):
+    """Select the input files that start on or before a date (YYYY-MM-DD)."""
+
+    selected_files = []
+    for infile in infiles:
+        with catalogue.open_dataset(infile) as ds:
+            start_date = ds['time'][0].dt.strftime('%Y-%m-%d').item()
+        if start_date <= end_date:
+            selected_files.append(infile)
+
+    return selected_files
+
+
+def is_historical(infiles):
+    """Check if the input files for a product all start before the end of the historical experiment."""
+
+    return len(files_before(infiles, HISTORICAL_END)) == len(infiles)
+
+
+def product_key(product, infiles, *options):
+    """Create the cache key for a product.
+
+    Parameters
+    ----------
+    product : str
+        Product name (e.g. pr-climatology)
+    infiles : list
+        Input files the product is calculated from
+    options : Union[str, int, float, tuple, list, None]
+        Calculation options (e.g. dates, distribution or bounding box)
+
+    Returns
+    -------
+    str
+        Cache key
+    """
+
+    signatures = [input_signature(infile) for infile in infiles]
+
+    return cache_utils.hash_items(product, *signatures, *options)
+
+
+def product_path(cache_dir, product, key):
+    """Define the path of a cached product."""
+
+    return cache_utils.cache_path(os.path.join(cache_dir, CACHE_SUBDIR), product, key)
+
+
+def read(cache_dir, product, key):
+    """Read a cached product (or return None if it is not in the cache)."""
+
+    path = product_path(cache_dir, product, key)
+    if not cache_utils.read_hit(path):
+        return None
+    with xr.open_dataset(path) as ds:
+        ds = ds.load()
+
+    return ds
+
+
+def evict(cache_dir):
+    """Remove old and least recently used products from the cache."""
+
+    cache_utils.evict(os.path.join(cache_dir, CACHE_SUBDIR), max_gb=MAX_GB, max_days=MAX_DAYS)
+
+
+def write(ds, cache_dir, product, key, exact=False):
+    """Add a product to the cache.
+
+    Products are written with the output encoding policy (see output_encoding.py),
+    unless exact is True (e.g. for model state that must be read back unchanged).
+    """
+
+    ds = ds.copy()
+    ds.attrs[KEY_ATTR] = key
+    path = product_path(cache_dir, product, key)
+    cache_utils.write_atomic(lambda temp_path: output_encoding.write(ds, temp_path, exact=exact), path)
+    evict(cache_dir)
+
+    return path
+
+
+def link_file(path, outfile):
+    """Give a netCDF file a second name (a hard link, or a copy if a link isn't possible)."""
+
+    if os.path.lexists(outfile):
+        os.remove(outfile)
+    try:
+        os.link(path, outfile)
+    except OSError:
+        shutil.copyfile(path, outfile)
+
+
+def copy_file(path, outfile):
+    """Copy a cached product to an output netCDF file or Zarr collection."""
+
+    if output_encoding.is_zarr(outfile):
+        with xr.open_dataset(path) as ds:
+            output_encoding.write(ds, outfile)
+    else:
+        link_file(path, outfile)
+
+
+def copy(cache_dir, product, key, outfile):
+    """Copy a cached product to an output file.
+
+    Returns
+    -------
+    bool
+        True if the product was in the cache
+    """
+
+    path = product_path(cache_dir, product, key)
+    if not cache_utils.read_hit(path):
+        return False
+    copy_file(path, outfile)
+    logging.info(f'Copied {product} from {path}')
+
+    return True
+
+
+def save(ds, outfile, cache_dir=None, product=None, key=None):
+    """Write a product to an output file (and add it to the cache if there is one).
+
+    A netCDF output file is added to the cache without copying it (see link_file).
+    """
+
+    if cache_dir is None:
+        output_encoding.write(ds, outfile)
+    elif output_encoding.is_zarr(outfile):
+        path = write(ds, cache_dir, product, key)
+        copy_file(path, outfile)
+    else:
+        ds = ds.copy()
+        ds.attrs[KEY_ATTR] = key
+        output_encoding.write(ds, outfile)
+        path = product_path(cache_dir, product, key)
+        cache_utils.write_atomic(lambda temp_path: link_file(outfile, temp_path), path)
+        evict(cache_dir)
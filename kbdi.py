@@ -1,15 +1,26 @@
 """Command line program for calculating the Keetch-Byram Drought Index (KBDI)"""
 
+import os
 import argparse
+import logging
 
 import numpy as np
 import xarray as xr
 import xclim as xc
+import numba
 import dask.diagnostics
 import cmdline_provenance as cmdprov
+
+import roi
+import profiling
+import cache_utils
+import intermediates
+import catalogue
     
 
 dask.diagnostics.ProgressBar().register()
+# force=True because importing xclim has already configured the root logger
+logging.basicConfig(level=logging.INFO, force=True)
 
 
 def fix_metadata(ds, input_ds):
@@ -33,26 +44,207 @@ def fix_metadata(ds, input_ds):
     return ds
 
 
+@numba.njit(parallel=True, cache=True)
+def kbdi_kernel(pr, tasmax, pr_annual, kbdi0, rr0):
+    """Daily KBDI recursion for many grid cells at once.
+
+    Follows xclim.indices.keetch_byram_drought_index (Finkele et al, 2006),
+    but the KBDI and remaining runoff at the end of the period are written
+    back into kbdi0 and rr0 so the calculation can be continued.
+
+    Parameters
+    ----------
+    pr : numpy.ndarray
+        Daily precipitation (mm/day) with dimensions (cell, time)
+    tasmax : numpy.ndarray
+        Daily maximum temperature (degC) with dimensions (cell, time)
+    pr_annual : numpy.ndarray
+        Annual precipitation climatology (mm/year) with dimension (cell)
+    kbdi0 : numpy.ndarray
+        KBDI on the day before the first time step, updated in place
+    rr0 : numpy.ndarray
+        Remaining runoff on the day before the first time step, updated in place
+
+    Returns
+    -------
+    numpy.ndarray
+        Daily KBDI with dimensions (cell, time)
+    """
+
+    ncell, ntime = pr.shape
+    kbdi = np.empty((ncell, ntime))
+    for cell in numba.prange(ncell):
+        kbdi_cell = kbdi0[cell]
+        rr = rr0[cell]
+        et_scale = 1e-3 / (1 + 10.88 * np.exp(-0.00173 * pr_annual[cell]))
+        for day in range(ntime):
+            if pr[cell, day] <= 0.0:
+                r = pr[cell, day]
+                rr = 5.0
+            else:
+                r = min(pr[cell, day], rr)
+                rr -= r
+            peff = pr[cell, day] - r
+            et = et_scale * (203.2 - kbdi_cell) * (0.968 * np.exp(0.0875 * tasmax[cell, day] + 1.5552) - 8.3)
+            kbdi_cell = min(max(kbdi_cell + et - peff, 0.0), 203.2)
+            kbdi[cell, day] = kbdi_cell
+        kbdi0[cell] = kbdi_cell
+        rr0[cell] = rr
+
+    return kbdi
+
+
+def initial_state(pr_annual_clim_da):
+    """Define the KBDI state at the start of a calculation."""
+
+    pr_annual_clim_da = pr_annual_clim_da.transpose('lat', 'lon')
+    state = xr.Dataset({
+        'KBDI': xr.zeros_like(pr_annual_clim_da, dtype=np.float64),
+        'runoff_remaining': xr.full_like(pr_annual_clim_da, 5.0, dtype=np.float64),
+    })
+    state['KBDI'].attrs = {'units': 'mm/day'}
+    state['runoff_remaining'].attrs = {'units': 'mm'}
+    state.attrs['end_date'] = ''
+
+    return state
+
+
+def calc_kbdi(pr_da, tasmax_da, pr_annual_clim_da, state=None):
+    """Calculate the daily KBDI.
+
+    Parameters
+    ----------
+    pr_da : xarray.DataArray
+        Daily precipitation
+    tasmax_da : xarray.DataArray
+        Daily maximum temperature
+    pr_annual_clim_da : xarray.DataArray
+        Annual precipitation climatology
+    state : xarray.Dataset, optional
+        KBDI state at the end of the previous time chunk (see initial_state)
+
+    Returns
+    -------
+    kbdi_da : xarray.DataArray
+        Daily KBDI
+    state : xarray.Dataset
+        KBDI state at the end of this time chunk
+    """
+
+    tasmax_da = xc.core.units.convert_units_to(tasmax_da, 'degC')
+    pr_da = xc.core.units.convert_units_to(pr_da, 'mm/day')
+    pr_annual_clim_da = xc.core.units.convert_units_to(pr_annual_clim_da, 'mm/year')
+    if state is None:
+        state = initial_state(pr_annual_clim_da)
+
+    dims = ('lat', 'lon')
+    ncell = pr_da['lat'].size * pr_da['lon'].size
+    kbdi0 = state['KBDI'].transpose(*dims).values.astype(np.float64).reshape(ncell)
+    rr0 = state['runoff_remaining'].transpose(*dims).values.astype(np.float64).reshape(ncell)
+    kbdi = kbdi_kernel(
+        pr_da.transpose(*dims, 'time').values.astype(np.float64).reshape(ncell, -1),
+        tasmax_da.transpose(*dims, 'time').values.astype(np.float64).reshape(ncell, -1),
+        pr_annual_clim_da.transpose(*dims).values.astype(np.float64).reshape(ncell),
+        kbdi0,
+        rr0,
+    )
+
+    ntime = len(pr_da['time'])
+    kbdi_da = xr.DataArray(
+        kbdi.reshape(len(pr_da['lat']), len(pr_da['lon']), ntime).transpose(2, 0, 1),
+        dims=('time',) + dims,
+        coords={'time': pr_da['time'], 'lat': pr_da['lat'], 'lon': pr_da['lon']},
+        attrs={'units': 'mm/day'},
+    )
+    state = state.copy()
+    state['KBDI'] = state['KBDI'].copy(data=kbdi0.reshape(state['KBDI'].shape))
+    state['runoff_remaining'] = state['runoff_remaining'].copy(data=rr0.reshape(state['KBDI'].shape))
+    state.attrs['end_date'] = pr_da['time'].dt.strftime('%Y-%m-%d').values[-1]
+
+    return kbdi_da, state
+
+
+def read_state(state_file):
+    """Read a KBDI state checkpoint file."""
+
+    with xr.open_dataset(state_file) as ds:
+        state = ds.load()
+
+    return state
+
+
+def write_state(state, state_file):
+    """Write a KBDI state checkpoint file."""
+
+    temp_file = state_file + '.tmp'
+    state.to_netcdf(temp_file)
+    os.replace(temp_file, state_file)
+
+
 def main(args):
     """Run the program."""
 
-    tasmax_ds = xr.open_dataset(args.tasmax_file)
-    tasmax_ds['tasmax'] = xc.core.units.convert_units_to(tasmax_ds['tasmax'], 'degC')
+    assert len(args.pr_files) == len(args.tasmax_files), 'Need one tasmax file per pr file'
+    assert len(args.pr_files) == len(args.outfiles), 'Need one outfile per pr file'
 
-    pr_ds = xr.open_dataset(args.pr_file)
-    pr_ds['pr'] = xc.core.units.convert_units_to(pr_ds['pr'], 'mm/day')
-    
-    pr_annual_clim_ds = xr.open_dataset(args.pr_annual_clim_file)
+    profile = profiling.Profile(args.profile)
+    bbox = roi.get_bbox(args)
+    pr_annual_clim_ds = roi.subset(catalogue.open_dataset(args.pr_annual_clim_file), bbox)
+    state = read_state(args.restart_file) if args.restart_file else None
+    key = None
+    if args.cache_dir:
+        # The KBDI for each file depends on all the files before it,
+        # so each cache key builds on the key for the previous file
+        state_hash = None if state is None else cache_utils.hash_items(
+            state['KBDI'].values, state['runoff_remaining'].values, state.attrs['end_date']
+        )
+        key = intermediates.product_key('kbdi', [args.pr_annual_clim_file], bbox, state_hash)
 
-    kbdi_da = xc.indices.keetch_byram_drought_index(
-        pr_ds['pr'],
-        tasmax_ds['tasmax'],
-        pr_annual_clim_ds['pr'],
-    )
+    for pr_file, tasmax_file, outfile in zip(args.pr_files, args.tasmax_files, args.outfiles):
+        pr_ds = roi.subset(xr.open_dataset(pr_file), bbox)
+        tasmax_ds = roi.subset(xr.open_dataset(tasmax_file), bbox)
+        if state is not None and state.attrs['end_date']:
+            dates = pr_ds['time'].dt.strftime('%Y-%m-%d').values
+            if dates[-1] <= state.attrs['end_date']:
+                logging.info(f'Skipping {pr_file} (before restart date {state.attrs["end_date"]})')
+                continue
+            assert dates[0] > state.attrs['end_date'], f'Restart date falls within {pr_file}'
+        # Only the historical files are shared between ssps, so only they are cached
+        cache_dir = None
+        if args.cache_dir:
+            key = intermediates.product_key('kbdi', [pr_file, tasmax_file], key)
+            if intermediates.is_historical([pr_file, tasmax_file]):
+                cache_dir = args.cache_dir
+        if cache_dir:
+            cached_state = intermediates.read(cache_dir, 'kbdi-state', key)
+            if cached_state is not None and intermediates.copy(cache_dir, 'kbdi', key, outfile):
+                state = cached_state
+                if args.checkpoint_file:
+                    write_state(state, args.checkpoint_file)
+                continue
+
+        with profile.stage('index', infile=os.path.basename(pr_file)):
+            kbdi_chunks = []
+            ntime = len(pr_ds['time'])
+            for start in range(0, ntime, args.time_chunk):
+                time_slice = slice(start, start + args.time_chunk)
+                kbdi_da, state = calc_kbdi(
+                    pr_ds['pr'].isel(time=time_slice).load(),
+                    tasmax_ds['tasmax'].isel(time=time_slice).load(),
+                    pr_annual_clim_ds['pr'],
+                    state=state,
+                )
+                kbdi_chunks.append(kbdi_da)
 
-    kbdi_ds = kbdi_da.to_dataset(name='KBDI')
-    kbdi_ds = fix_metadata(kbdi_ds, tasmax_ds)
-    kbdi_ds.to_netcdf(args.outfile)
+        with profile.stage('write', outfile=os.path.basename(outfile)):
+            kbdi_da = xr.concat(kbdi_chunks, dim='time')
+            kbdi_ds = kbdi_da.to_dataset(name='KBDI')
+            kbdi_ds = fix_metadata(kbdi_ds, tasmax_ds)
+            if cache_dir:
+                intermediates.write(state, cache_dir, 'kbdi-state', key, exact=True)
+            intermediates.save(kbdi_ds, outfile, cache_dir=cache_dir, product='kbdi', key=key)
+            if args.checkpoint_file:
+                write_state(state, args.checkpoint_file)
 
 
 if __name__ == '__main__':
@@ -60,9 +252,28 @@ if __name__ == '__main__':
         description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
-    parser.add_argument("pr_file", type=str, help="input daily precipitation file")
-    parser.add_argument("tasmax_file", type=str, help="input daily maximum temperature file")
-    parser.add_argument("pr_annual_clim_file", type=str, help="input annual precipitation climatology file")
-    parser.add_argument("outfile", type=str, help="output file name")
+    parser.add_argument("files", type=str, nargs='+', metavar='pr_annual_clim_file',
+                        help="input annual precipitation climatology file (or the deprecated pr_file tasmax_file pr_annual_clim_file outfile)")
+    parser.add_argument("--pr_files", type=str, nargs='*', default=[], help="input daily precipitation files (in time order)")
+    parser.add_argument("--tasmax_files", type=str, nargs='*', default=[], help="input daily maximum temperature files (in time order)")
+    parser.add_argument("--outfiles", type=str, nargs='*', default=[], help="output file names (.nc or .zarr, one per input precipitation file)")
+    parser.add_argument("--time_chunk", type=int, default=3650, help="number of time steps to process at once [default=3650]")
+    parser.add_argument("--restart_file", type=str, default=None, help="KBDI state file to start from (input files before its end date are skipped)")
+    parser.add_argument("--checkpoint_file", type=str, default=None, help="KBDI state file to write after each input file")
+    roi.add_arguments(parser)
+    profiling.add_arguments(parser)
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="share the KBDI for input files (e.g. historical files) between runs via this cache directory")
     args = parser.parse_args()
+    if len(args.files) == 4 and not (args.pr_files or args.tasmax_files or args.outfiles):
+        logging.warning(
+            'kbdi.py pr_file tasmax_file pr_annual_clim_file outfile is deprecated, '
+            'use kbdi.py pr_annual_clim_file --pr_files pr_file --tasmax_files tasmax_file --outfiles outfile'
+        )
+        pr_file, tasmax_file, args.pr_annual_clim_file, outfile = args.files
+        args.pr_files, args.tasmax_files, args.outfiles = [pr_file], [tasmax_file], [outfile]
+    elif len(args.files) == 1 and args.pr_files and args.tasmax_files and args.outfiles:
+        args.pr_annual_clim_file = args.files[0]
+    else:
+        parser.error('give pr_annual_clim_file --pr_files ... --tasmax_files ... --outfiles ...')
     main(args)
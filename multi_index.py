@@ -0,0 +1,272 @@
+"""Command line program for calculating several indices from one read of the input data
+
+WSDI, SPEI and FFDI share daily input variables (tasmax is used by all
+three and pr by both SPEI and FFDI), so running wsdi.py, spei.py and
+ffdi.py for the same model/experiment/run reads those files several times.
+This program works out the input variables needed for the requested
+indices, reads each of them once (one spatial tile at a time) and calculates
+every index from the tile in memory. Each index is written to the same kind
+of output file as the program that usually calculates it.
+
+Each tile reads the full time series from every input file, and the
+tiles only share a process (--workers runs them in threads), so when the
+input files are chunked by time (as the CMIP6 files are) every compressed
+chunk is read and decompressed once per tile. Give --max_mem enough memory
+for the whole grid to be calculated as a single tile, so that each chunk is
+only read once. (ffdi.py in fused mode reads the inputs a year at a time
+instead, if the FFDI metrics are needed for a grid too large for one tile.)
+"""
+
+import os
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import xarray as xr
+import xclim as xc
+import dask.utils
+import cmdline_provenance as cmdprov
+
+import roi
+import profiling
+import tiling
+import catalogue
+import output_encoding
+import wsdi
+import spei
+import evspsblpot
+import kbdi
+import ffdi
+import pr_climatology
+
+
+# force=True because importing xclim has already configured the root logger
+logging.basicConfig(level=logging.INFO, force=True)
+
+INDEX_VARS = {
+    'wsdi': ['tasmax'],
+    'spei': ['pr', 'tasmin', 'tasmax'],
+    'ffdi': ['pr', 'tasmax', 'hursmin', 'sfcWindmax'],
+}
+INPUT_VARS = ['pr', 'tasmax', 'tasmin', 'hursmin', 'sfcWindmax', 'hurs', 'sfcWind', 'rsds', 'rsus', 'rlds', 'rlus']
+BASE_START = '1950-01-01'
+BASE_END = '2014-12-31'
+
+
+def required_vars(indices, evspsblpot_method='hargreaves85'):
+    """Find the input variables needed for a list of indices (each variable once)."""
+
+    index_vars = dict(INDEX_VARS, spei=['pr'] + evspsblpot.INPUT_VARS[evspsblpot_method])
+
+    return [var for var in INPUT_VARS if any(var in index_vars[index] for index in indices)]
+
+
+def calc_wsdi(tile_ds):
+    """Calculate the WSDI for a tile."""
+
+    tasmax_da = xc.core.units.convert_units_to(tile_ds['tasmax']['tasmax'], 'degC')
+    tx90 = wsdi.calc_tx90_tile(tasmax_da.sel(time=slice(BASE_START, BASE_END)))
+    wsdi_da = xc.indicators.icclim.WSDI(tasmax=tasmax_da, tasmax_per=tx90, freq='YS')
+
+    return {'wsdi': wsdi_da.to_dataset()}
+
+
+def calc_spei(tile_ds, windows, dist, params=None, evspsblpot_method='hargreaves85'):
+    """Calculate the SPEI for a tile.
+
+    Parameters
+    ----------
+    tile_ds : dict
+        Input dataset for each variable
+    windows : list
+        Accumulation windows (in months)
+    dist : str
+        Distribution fitted to the water balance
+    params : dict, optional
+        Distribution parameters for the tile for each window
+        (the parameters for any other window are fitted here)
+    evspsblpot_method : {'hargreaves85', 'allen98'}, default 'hargreaves85'
+        Method for calculating evspsblpot (see evspsblpot.py)
+
+    Returns
+    -------
+    dict
+        SPEI dataset and the distribution parameters for each window
+    """
+
+    evspsblpot_ds = evspsblpot.calc_evspsblpot(tile_ds, evspsblpot_method)
+    wb = tile_ds['pr']['pr'] - evspsblpot_ds['evspsblpot']
+    wb.attrs['units'] = tile_ds['pr']['pr'].attrs['units']
+    wb_monthly = wb.resample(time='MS').mean(keep_attrs=True)
+    params = dict(params) if params else {}
+    for window in windows:
+        if window not in params:
+            params[window] = spei.calc_params(wb_monthly, window, dist)
+    spei_ds = spei.calc_spei(wb_monthly, windows, params)
+
+    return {'spei': spei_ds, 'spei-params': xr.Dataset({spei.params_var(window): params[window] for window in windows})}
+
+
+def calc_ffdi(tile_ds, pr_annual_clim_da, threshold_method):
+    """Calculate the annual FFDI metrics for a tile.
+
+    The precipitation climatology for KBDI is calculated from the tile
+    if it isn't given.
+    """
+
+    if pr_annual_clim_da is None:
+        pr_annual_clim_da = pr_climatology.calc_climatology(tile_ds['pr'], BASE_START, BASE_END)['pr']
+    kbdi_da, _ = kbdi.calc_kbdi(tile_ds['pr']['pr'], tile_ds['tasmax']['tasmax'], pr_annual_clim_da)
+    ffdi_da = ffdi.calc_ffdi(
+        tile_ds['pr']['pr'],
+        tile_ds['tasmax']['tasmax'],
+        tile_ds['hursmin']['hursmin'],
+        tile_ds['sfcWindmax']['sfcWindmax'],
+        kbdi_da,
+    )
+    ffdi_ds = ffdi.fix_metadata(ffdi_da.to_dataset(name='FFDI'), tile_ds['tasmax'])
+    FFDIx_ds, FFDIgt99p_ds = ffdi.calc_metrics(ffdi_ds, method=threshold_method)
+
+    return {'FFDIx': FFDIx_ds, 'FFDIgt99p': FFDIgt99p_ds}
+
+
+def main(args):
+    """Run the program."""
+
+    profile = profiling.Profile(args.profile)
+    windows = [int(window) for window in args.windows.split(',')]
+    bbox = roi.get_bbox(args)
+    outfiles = {
+        'wsdi': args.wsdi_outfile,
+        'spei': args.spei_outfile,
+        'FFDIx': args.FFDIx_outfile,
+        'FFDIgt99p': args.FFDIgt99p_outfile,
+    }
+    for index in args.indices:
+        products = ['FFDIx', 'FFDIgt99p'] if index == 'ffdi' else [index]
+        for product in products:
+            assert outfiles[product], f'No output file for {product}'
+    input_vars = required_vars(args.indices, args.evspsblpot_method)
+    logging.info(f'Reading {", ".join(input_vars)} for {", ".join(args.indices)}')
+
+    with profile.stage('open'):
+        input_ds = {}
+        for var in input_vars:
+            infiles = getattr(args, f'{var}_files')
+            assert infiles, f'No input files for {var}'
+            # One dask chunk per file (rather than per netCDF chunk)
+            # keeps the task graph for reading each tile small
+            input_ds[var] = catalogue.open_mfdataset(
+                infiles, attrs_file=infiles[-1], preprocess=roi.get_preprocess(bbox), chunks={'time': -1}
+            )
+        pr_annual_clim_da = None
+        if 'ffdi' in args.indices and args.pr_annual_clim_file:
+            pr_annual_clim_da = roi.subset(catalogue.open_dataset(args.pr_annual_clim_file), bbox)['pr']
+        params = {}
+        if 'spei' in args.indices and args.params_file and os.path.isfile(args.params_file):
+            params = spei.read_params_file(args.params_file, args.dist, args.evspsblpot_method)
+
+    # The percentile and distribution fitting calculations
+    # hold about ten copies of each variable in memory
+    tile_size = tiling.tile_size_for_memory(
+        len(input_ds['tasmax']['time']),
+        len(input_ds['tasmax']['lat']),
+        len(input_ds['tasmax']['lon']),
+        dask.utils.parse_bytes(args.max_mem) / args.workers,
+        bytes_per_value=8,
+        copies=len(input_vars) + 10,
+    )
+    tiles = list(tiling.spatial_tiles(input_ds['tasmax'], tile_size))
+    logging.info(f'Calculating {len(tiles)} tiles of size {tile_size}')
+    if len(tiles) > 1:
+        logging.warning(
+            f'Each of the {len(tiles)} tiles reads every time chunk of the input files '
+            '(increase --max_mem so the whole grid fits in one tile to read each chunk once)'
+        )
+
+    def calc_tile(tile, profile):
+        """Read one tile of every input variable and calculate each index."""
+        tile_bounds = {dim: [index.start, index.stop] for dim, index in tile.items()}
+        with profile.stage('read_tile', tile=tile_bounds):
+            tile_ds = {var: ds.isel(tile).compute(scheduler='synchronous') for var, ds in input_ds.items()}
+        results = {}
+        if 'wsdi' in args.indices:
+            with profile.stage('wsdi_tile', tile=tile_bounds):
+                results.update(calc_wsdi(tile_ds))
+        if 'spei' in args.indices:
+            with profile.stage('spei_tile', tile=tile_bounds):
+                tile_params = {window: params[window].isel(tile) for window in params}
+                results.update(calc_spei(
+                    tile_ds, windows, args.dist, params=tile_params, evspsblpot_method=args.evspsblpot_method
+                ))
+        if 'ffdi' in args.indices:
+            with profile.stage('ffdi_tile', tile=tile_bounds):
+                tile_clim = None if pr_annual_clim_da is None else pr_annual_clim_da.isel(tile).load()
+                results.update(calc_ffdi(tile_ds, tile_clim, args.threshold_method))
+        return results
+
+    # Stages can't be recorded from several threads at once,
+    # so parallel tiles are profiled as one stage
+    if args.workers == 1:
+        tile_results = [calc_tile(tile, profile) for tile in tiles]
+    else:
+        with profile.stage('tiles', ntiles=len(tiles)):
+            with ThreadPoolExecutor(max_workers=args.workers) as executor:
+                tile_results = list(executor.map(lambda tile: calc_tile(tile, profiling.Profile()), tiles))
+
+    with profile.stage('write'):
+        attrs_vars = {'wsdi': 'tasmax', 'spei': 'pr'}
+        for product, outfile in outfiles.items():
+            if product not in tile_results[0]:
+                continue
+            ds = xr.combine_by_coords([results[product] for results in tile_results], combine_attrs='override')
+            if product in attrs_vars:
+                ds.attrs = input_ds[attrs_vars[product]].attrs
+            ds.attrs['history'] = cmdprov.new_log()
+            output_encoding.write(ds, outfile)
+        if 'spei' in args.indices and args.params_file and set(windows) - set(params):
+            params_ds = xr.combine_by_coords([results['spei-params'] for results in tile_results])
+            for window in windows:
+                params[window] = params_ds[spei.params_var(window)]
+            spei.write_params_file(params, args.params_file, args.dist, args.evspsblpot_method)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--indices", type=str, nargs='*', choices=list(INDEX_VARS), default=list(INDEX_VARS),
+                        help="indices to calculate [default=all]")
+    parser.add_argument("--pr_files", type=str, nargs='*', help="input daily precipitation files")
+    parser.add_argument("--tasmax_files", type=str, nargs='*', help="input daily maximum temperature files")
+    parser.add_argument("--tasmin_files", type=str, nargs='*', help="input daily minimum temperature files")
+    parser.add_argument("--hursmin_files", type=str, nargs='*', help="input daily minimum relative humidity files")
+    parser.add_argument("--sfcWindmax_files", type=str, nargs='*', help="input daily maximum surface wind speed files")
+    parser.add_argument("--hurs_files", type=str, nargs='*', help="input daily relative humidity files (SPEI with allen98 only)")
+    parser.add_argument("--sfcWind_files", type=str, nargs='*', help="input daily surface wind speed files (SPEI with allen98 only)")
+    parser.add_argument("--rsds_files", type=str, nargs='*', help="input daily surface downwelling shortwave files (SPEI with allen98 only)")
+    parser.add_argument("--rsus_files", type=str, nargs='*', help="input daily surface upwelling shortwave files (SPEI with allen98 only)")
+    parser.add_argument("--rlds_files", type=str, nargs='*', help="input daily surface downwelling longwave files (SPEI with allen98 only)")
+    parser.add_argument("--rlus_files", type=str, nargs='*', help="input daily surface upwelling longwave files (SPEI with allen98 only)")
+    parser.add_argument("--wsdi_outfile", type=str, default=None, help="WSDI output file name (.nc or .zarr)")
+    parser.add_argument("--spei_outfile", type=str, default=None, help="SPEI output file name (.nc or .zarr)")
+    parser.add_argument("--FFDIx_outfile", type=str, default=None, help="FFDIx output file name (.nc or .zarr)")
+    parser.add_argument("--FFDIgt99p_outfile", type=str, default=None, help="FFDIgt99p output file name (.nc or .zarr)")
+    parser.add_argument("--dist", type=str, choices=('gamma', 'fisk'), default='fisk', help="distribution for SPEI calculation")
+    parser.add_argument("--evspsblpot_method", type=str, choices=('hargreaves85', 'allen98'), default='hargreaves85',
+                        help="method for calculating evspsblpot for the SPEI (see evspsblpot.py) [default=hargreaves85]")
+    parser.add_argument("--windows", type=str, default='12',
+                        help="comma separated SPEI accumulation windows in months (e.g. 3,6,12) [default=12]")
+    parser.add_argument("--params_file", type=str, default=None,
+                        help="read the SPEI distribution parameters from (or save them to) this file")
+    parser.add_argument("--pr_annual_clim_file", type=str, default=None,
+                        help="annual precipitation climatology for KBDI [default=calculate from the pr files for 1950-2014]")
+    parser.add_argument("--threshold_method", type=str, choices=('exact', 'sketch'), default='exact',
+                        help="method for the FFDIgt99p threshold [default=exact]")
+    parser.add_argument("--max_mem", type=str, default='8GB', help="memory ceiling for the tiles [default=8GB]")
+    parser.add_argument("--workers", type=int, default=1, help="number of tiles to process in parallel [default=1]")
+    roi.add_arguments(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
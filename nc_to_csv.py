@@ -1,77 +1,43 @@
 """Command line program for converting from netCDF to csv with spatial aggregation"""
 
+import os
+import csv
 import argparse
+import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import xarray as xr
 import pandas as pd
 import geopandas as gp
 import regionmask
+import scipy.sparse
 import xesmf as xe
 
+import cache_utils
+import roi
+import profiling
+import catalogue
 
-def subset_lat(ds, lat_bnds, lat_dim="lat"):
-    """Select grid points that fall within latitude bounds.
 
-    Parameters
-    ----------
-    ds : Union[xarray.DataArray, xarray.Dataset]
-        Input data
-    lat_bnds : list
-        Latitude bounds: [south bound, north bound]
-    lat_dim: str, default 'lat'
-        Name of the latitude dimension in ds
-
-    Returns
-    -------
-    Union[xarray.DataArray, xarray.Dataset]
-        Subsetted xarray.DataArray or xarray.Dataset
-    """
-
-    south_bound, north_bound = lat_bnds
-    assert -90 <= south_bound <= 90, "Valid latitude range is [-90, 90]"
-    assert -90 <= north_bound <= 90, "Valid latitude range is [-90, 90]"
-
-    selection = (ds[lat_dim] <= north_bound) & (ds[lat_dim] >= south_bound)
-    ds = ds.where(selection, drop=True)
-
-    return ds
+logging.basicConfig(level=logging.INFO)
 
+CITY_COORDS = {
+    'Melbourne': (-37.81, 144.96),
+    'Sydney': (-33.87, 151.21),
+    'Brisbane': (-27.47, 153.03),
+    'Darwin': (-12.44, 130.84),
+    'Perth': (-31.95, 115.86),
+    'Adelaide': (-34.93, 138.60),
+    'Hobart': (-42.88, 147.33)
+}
+STATES_SHAPEFILE = '/g/data/ia39/aus-ref-clim-data-nci/shapefiles/data/aus_states_territories/aus_states_territories.shp'
+KOPPEN_FILE = '/g/data/xv83/dbi599/treasury/koppen/koppen_geiger_1p0_1991-2020.nc'
+REGION_CACHE_VERSION = 2
 
-def subset_lon(ds, lon_bnds, lon_dim="lon"):
-    """Select grid points that fall within longitude bounds.
-
-    Parameters
-    ----------
-    ds : Union[xarray.DataArray, xarray.Dataset]
-        Input data
-    lon_bnds : list
-        Longitude bounds: [west bound, east bound]
-    lon_dim: str, default 'lon'
-        Name of the longitude dimension in ds
 
-    Returns
-    -------
-    Union[xarray.DataArray, xarray.Dataset]
-        Subsetted xarray.DataArray or xarray.Dataset
-    """
-
-    west_bound, east_bound = lon_bnds
-    assert west_bound >= ds[lon_dim].values.min()
-    assert west_bound <= ds[lon_dim].values.max()
-    assert east_bound >= ds[lon_dim].values.min()
-    assert east_bound <= ds[lon_dim].values.max()
-
-    if east_bound > west_bound:
-        selection = (ds[lon_dim] <= east_bound) & (ds[lon_dim] >= west_bound)
-    else:
-        selection = (ds[lon_dim] <= east_bound) | (ds[lon_dim] >= west_bound)
-    ds = ds.where(selection, drop=True)
-
-    return ds
-
-
-def xesmf_regrid(ds, ds_grid, variable):
+def xesmf_regrid(ds, ds_grid, variable, weights_file=None):
     """Regrid data using xesmf.
     
     Parameters
@@ -82,6 +48,8 @@ def xesmf_regrid(ds, ds_grid, variable):
         Dataset containing target horizontal grid
     variable : str
         Variable to restore attributes for
+    weights_file : str, optional
+        Regridding weights file (read if it exists, otherwise written)
     
     Returns
     -------
@@ -91,7 +59,12 @@ def xesmf_regrid(ds, ds_grid, variable):
     
     global_attrs = ds.attrs
     var_attrs = ds[variable].attrs
-    regridder = xe.Regridder(ds, ds_grid, 'nearest_s2d')
+    if weights_file and os.path.exists(weights_file):
+        regridder = xe.Regridder(ds, ds_grid, 'nearest_s2d', weights=weights_file)
+    else:
+        regridder = xe.Regridder(ds, ds_grid, 'nearest_s2d')
+        if weights_file:
+            cache_utils.write_atomic(regridder.to_netcdf, weights_file)
     ds = regridder(ds)
     ds.attrs = global_attrs
     ds[variable].attrs = var_attrs
@@ -99,10 +72,31 @@ def xesmf_regrid(ds, ds_grid, variable):
     return ds
 
 
-def get_regions():
-    """Define the regions of interest."""
+def get_regions(region_spec=None):
+    """Define the regions of interest.
+
+    Parameters
+    ----------
+    region_spec : dict, optional
+        Shapefile ('file') and the columns holding the region names ('names')
+        and abbreviations ('abbrevs'). Defaults to the Australian states.
+
+    Returns
+    -------
+    regionmask.Regions
+    """
 
-    states_gp = gp.read_file('/g/data/ia39/aus-ref-clim-data-nci/shapefiles/data/aus_states_territories/aus_states_territories.shp')
+    if region_spec:
+        regions_gp = gp.read_file(region_spec['file'])
+        regions_rm = regionmask.from_geopandas(
+            regions_gp,
+            names=region_spec['names'],
+            abbrevs=region_spec['abbrevs'],
+            name=os.path.basename(region_spec['file']),
+        )
+        return regions_rm
+
+    states_gp = gp.read_file(STATES_SHAPEFILE)
     states_gp = states_gp.drop(columns=['AREASQKM21', 'LOCI_URI21'])
     states_gp = states_gp[:-2]  # remove ACT and other territories
    
@@ -122,88 +116,502 @@ def get_regions():
     return regions_rm
 
 
-def mask_arid(frac):
-    """Mask arid areas."""
+def get_arid_mask(ds_grid, cache_dir=None):
+    """Get the arid areas (Koppen-Geiger classes 4-7) on a target grid.
+
+    If a cache directory is given, the regridding weights and the arid
+    mask for the target grid are stored there and reused.
+    """
 
-    ds_koppen_1p0 = xr.open_dataset('/g/data/xv83/dbi599/treasury/koppen/koppen_geiger_1p0_1991-2020.nc')
-    ds_koppen = xesmf_regrid(ds_koppen_1p0, frac, variable='kg_class')
+    weights_file = None
+    if cache_dir:
+        key = cache_utils.hash_items(
+            cache_utils.grid_hash(ds_grid),
+            cache_utils.file_signature(KOPPEN_FILE),
+            REGION_CACHE_VERSION,
+        )
+        weights_file = cache_utils.cache_path(cache_dir, 'koppen-regrid-weights', key)
+        mask_file = cache_utils.cache_path(cache_dir, 'arid-mask', key)
+        if cache_utils.read_hit(mask_file):
+            with xr.open_dataset(mask_file) as mask_ds:
+                arid = mask_ds['arid'].load()
+            return arid.assign_coords({'lat': ds_grid['lat'], 'lon': ds_grid['lon']})
+
+    ds_koppen_1p0 = xr.open_dataset(KOPPEN_FILE)
+    ds_koppen = xesmf_regrid(ds_koppen_1p0, ds_grid, variable='kg_class', weights_file=weights_file)
     ds_koppen = ds_koppen.compute()
     arid = (ds_koppen['kg_class'] > 3.5) & (ds_koppen['kg_class'] < 7.5)
+    if cache_dir:
+        cache_utils.write_atomic(arid.to_dataset(name='arid').to_netcdf, mask_file)
+
+    return arid
+
+
+def mask_arid(frac, cache_dir=None):
+    """Mask arid areas."""
+
+    arid = get_arid_mask(frac, cache_dir=cache_dir)
     frac_masked = ~arid * frac    
 
     return frac_masked
 
 
-def add_cities(da, df, index):
-    """Add city values to a dataframe"""
+def region_cache_key(ds, region_spec, arid_mask, aggregation):
+    """Define the cache key for the region weights of a grid."""
+
+    if region_spec:
+        region_items = (
+            cache_utils.file_signature(region_spec['file']),
+            region_spec['names'],
+            region_spec['abbrevs'],
+        )
+    else:
+        region_items = cache_utils.file_signature(STATES_SHAPEFILE)
+
+    return cache_utils.hash_items(
+        cache_utils.grid_hash(ds),
+        region_items,
+        arid_mask,
+        aggregation,
+        REGION_CACHE_VERSION,
+    )
+
+
+def calc_region_weights(ds, arid_mask=False, cache_dir=None, region_spec=None):
+    """Calculate the area weight of each grid cell in each region."""
+
+    regions = get_regions(region_spec)
+    frac = regions.mask_3D_frac_approx(ds)
+    if arid_mask:
+        frac = mask_arid(frac, cache_dir=cache_dir)
+    weights = np.cos(np.deg2rad(ds['lat']))
+
+    return frac * weights
+
+
+def get_region_weights(
+    ds,
+    arid_mask=False,
+    cache_dir=None,
+    cache_max_gb=None,
+    cache_max_days=None,
+    region_spec=None,
+):
+    """Get the region weights from the cache or calculate them.
 
-    city_coords = {
-        'Melbourne': (-37.81, 144.96),
-        'Sydney': (-33.87, 151.21),
-        'Brisbane': (-27.47, 153.03),
-        'Darwin': (-12.44, 130.84),
-        'Perth': (-31.95, 115.86),
-        'Adelaide': (-34.93, 138.60),
-        'Hobart': (-42.88, 147.33)
+    The cache key is a hash of the grid coordinates and region definition
+    (shapefile and arid mask), so every file on a given model grid
+    shares the same cache entry.
+    """
+
+    if not cache_dir:
+        return calc_region_weights(ds, arid_mask=arid_mask, region_spec=region_spec)
+
+    key = region_cache_key(ds, region_spec, arid_mask, 'dense')
+    cache_file = cache_utils.cache_path(cache_dir, 'region-weights', key)
+    if cache_utils.read_hit(cache_file):
+        with xr.open_dataset(cache_file) as cache_ds:
+            region_weights = cache_ds['weights'].load()
+        region_weights = region_weights.assign_coords({'lat': ds['lat'], 'lon': ds['lon']})
+    else:
+        region_weights = calc_region_weights(ds, arid_mask=arid_mask, cache_dir=cache_dir, region_spec=region_spec)
+        cache_utils.write_atomic(region_weights.to_dataset(name='weights').to_netcdf, cache_file)
+        cache_utils.evict(cache_dir, max_gb=cache_max_gb, max_days=cache_max_days)
+
+    return region_weights
+
+
+def calc_region_matrix(ds, arid_mask=False, cache_dir=None, region_spec=None, batch_size=100):
+    """Calculate the region weights as a sparse (region, grid cell) matrix.
+
+    The fractional region masks are calculated for batches of regions,
+    so the full dense (region, lat, lon) mask is never held in memory.
+    Regions that do not overlap the grid are dropped (as for the dense
+    region weights), but regions that are entirely masked as arid are kept
+    (with no weights, so their mean is missing).
+
+    Returns
+    -------
+    matrix : scipy.sparse.csr_matrix
+        Area weight of each grid cell (flattened lat, lon) in each region
+    abbrevs : numpy.ndarray
+        Region abbreviations
+    """
+
+    regions = get_regions(region_spec)
+    weights = np.cos(np.deg2rad(ds['lat']))
+    if arid_mask:
+        ds_grid = xr.Dataset(coords={'lat': ds['lat'], 'lon': ds['lon']})
+        weights = ~get_arid_mask(ds_grid, cache_dir=cache_dir) * weights
+
+    rows = []
+    overlaps = []
+    numbers = np.array(regions.numbers)
+    for start in range(0, len(numbers), batch_size):
+        batch_numbers = numbers[start:start + batch_size]
+        frac = regions[batch_numbers].mask_3D_frac_approx(ds, drop=False).fillna(0)
+        overlaps.append((frac > 0).any(dim=['lat', 'lon']).values)
+        region_weights = (frac * weights).transpose('region', 'lat', 'lon')
+        rows.append(scipy.sparse.csr_matrix(region_weights.values.reshape(len(batch_numbers), -1)))
+    matrix = scipy.sparse.vstack(rows, format='csr')
+
+    overlap = np.concatenate(overlaps)
+    abbrevs = np.array(regions.abbrevs)[overlap]
+
+    return matrix[overlap], abbrevs
+
+
+def write_region_matrix(matrix, abbrevs, outfile):
+    """Write a sparse region weights matrix to an npz file."""
+
+    with open(outfile, 'wb') as outf:
+        np.savez(
+            outf,
+            data=matrix.data,
+            indices=matrix.indices,
+            indptr=matrix.indptr,
+            shape=matrix.shape,
+            abbrevs=abbrevs,
+        )
+
+
+def read_region_matrix(infile):
+    """Read a sparse region weights matrix from an npz file."""
+
+    with np.load(infile) as npz:
+        matrix = scipy.sparse.csr_matrix(
+            (npz['data'], npz['indices'], npz['indptr']),
+            shape=tuple(npz['shape']),
+        )
+        abbrevs = npz['abbrevs']
+
+    return matrix, abbrevs
+
+
+def get_region_matrix(
+    ds,
+    arid_mask=False,
+    cache_dir=None,
+    cache_max_gb=None,
+    cache_max_days=None,
+    region_spec=None,
+):
+    """Get the sparse region weights matrix from the cache or calculate it."""
+
+    if not cache_dir:
+        return calc_region_matrix(ds, arid_mask=arid_mask, region_spec=region_spec)
+
+    key = region_cache_key(ds, region_spec, arid_mask, 'sparse')
+    cache_file = cache_utils.cache_path(cache_dir, 'region-matrix', key, suffix='.npz')
+    if cache_utils.read_hit(cache_file):
+        matrix, abbrevs = read_region_matrix(cache_file)
+    else:
+        matrix, abbrevs = calc_region_matrix(ds, arid_mask=arid_mask, cache_dir=cache_dir, region_spec=region_spec)
+        cache_utils.write_atomic(lambda path: write_region_matrix(matrix, abbrevs, path), cache_file)
+        cache_utils.evict(cache_dir, max_gb=cache_max_gb, max_days=cache_max_days)
+
+    return matrix, abbrevs
+
+
+def sparse_spatial_mean(da, matrix, abbrevs):
+    """Calculate the weighted mean over each region with a sparse matrix.
+
+    Missing values are excluded (with their weight) in the same way as
+    xarray's weighted mean.
+    """
+
+    da = da.transpose('time', 'lat', 'lon')
+    data = da.values.reshape(len(da['time']), -1)
+    valid = ~np.isnan(data)
+    totals = (matrix @ np.where(valid, data, 0).T).T
+    weight_totals = (matrix @ valid.T.astype(np.float64)).T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(weight_totals != 0, totals / weight_totals, np.nan)
+
+    spatial_means = xr.DataArray(
+        means,
+        dims=('time', 'region'),
+        coords={'time': da['time'], 'abbrevs': ('region', abbrevs)},
+    )
+
+    return spatial_means
+
+
+def read_points(points_file):
+    """Read point locations from a csv file with columns name, lat and lon."""
+
+    points_df = pd.read_csv(points_file)
+    duplicates = sorted(set(points_df['name'][points_df['name'].duplicated()]))
+    assert not duplicates, f'Duplicate point names in {points_file}: {", ".join(duplicates)}'
+    points = {
+        name: (lat, lon) for name, lat, lon in zip(points_df['name'], points_df['lat'], points_df['lon'])
     }
 
-    for city, coords in city_coords.items():
-        lat, lon = coords
-        city_da = da.sel({'lat': lat, 'lon': lon}, method='nearest')
-        city_series = city_da.to_pandas()
-        city_series.index = index
-        city_series = city_series.round(decimals=2)
-        city_series.name = city
-        df[city] = city_series
+    return points
+
+
+def nearest_indices(ds, lats, lons):
+    """Find the nearest grid point (lat, lon index) for many points at once.
+
+    Gives the same result as selecting each point with
+    ds.sel({'lat': lat, 'lon': lon}, method='nearest'),
+    because it uses the same (pandas) index lookup, which breaks ties
+    between two equally near grid points by taking the larger index.
+    """
+
+    lat_index = ds.indexes['lat'].get_indexer(lats, method='nearest')
+    lon_index = ds.indexes['lon'].get_indexer(lons, method='nearest')
+
+    return lat_index, lon_index
+
+
+def get_point_indices(ds, points, cache_dir=None):
+    """Get the nearest grid point indices from the cache or calculate them."""
+
+    lats = np.array([lat for lat, lon in points.values()], dtype=np.float64)
+    lons = np.array([lon for lat, lon in points.values()], dtype=np.float64)
+    if not cache_dir:
+        return nearest_indices(ds, lats, lons)
+
+    key = cache_utils.hash_items(cache_utils.grid_hash(ds), lats, lons, REGION_CACHE_VERSION, 'pandas-nearest')
+    cache_file = cache_utils.cache_path(cache_dir, 'point-indices', key, suffix='.npz')
+    if cache_utils.read_hit(cache_file):
+        with np.load(cache_file) as npz:
+            lat_index = npz['lat_index']
+            lon_index = npz['lon_index']
+    else:
+        lat_index, lon_index = nearest_indices(ds, lats, lons)
+
+        def write_indices(path):
+            with open(path, 'wb') as outf:
+                np.savez(outf, lat_index=lat_index, lon_index=lon_index)
+
+        cache_utils.write_atomic(write_indices, cache_file)
+
+    return lat_index, lon_index
+
+
+def add_points(da, df, points, cache_dir=None):
+    """Add point values to a dataframe.
+
+    The values at all points are extracted with a single vectorised
+    (nearest grid point) indexing operation.
+    """
+
+    lat_index, lon_index = get_point_indices(da, points, cache_dir=cache_dir)
+    points_da = da.isel({
+        'lat': xr.DataArray(lat_index, dims='point'),
+        'lon': xr.DataArray(lon_index, dims='point'),
+    })
+    points_df = points_da.transpose('time', 'point').to_pandas()
+    points_df.index = df.index
+    points_df.columns = list(points.keys())
+    points_df = points_df.round(decimals=2)
+    df = pd.concat([df, points_df], axis=1)
 
     return df
 
 
 def model_fixes(ds):
-    """Model specific fixes to input data."""
+    """Model specific fixes to input data.
 
+    Data that were subset to a region of interest when calculated
+    already have these fixes (see roi.subset).
+    """
+
+    if roi.ROI_ATTR in ds.attrs:
+        return ds
+
+    south_bound, north_bound, west_bound, east_bound = roi.REGIONS['aus']
     model = ds.attrs['source_id']
     if model == 'CanESM5':
-        ds = subset_lat(ds, [-48, -5])
-        ds = subset_lon(ds, [105, 160])
-        ds['lat'] = np.round(ds['lat'], 2)
+        ds = roi.subset_lat(ds, [south_bound, north_bound])
+        ds = roi.subset_lon(ds, [west_bound, east_bound])
+        ds = roi.fix_coords(ds)
     elif model == 'MPI-ESM1-2-LR':
-        ds = subset_lat(ds, [-48, -5])
-        lat_start = np.round(ds.lat.values[0], 2)
-        lat_end = np.round(ds.lat.values[-1], 2)
-        nlats = len(ds.lat)
-        new_lat = np.linspace(lat_start, lat_end, nlats)
-        ds['lat'] = new_lat
+        ds = roi.subset_lat(ds, [south_bound, north_bound])
+        ds = roi.fix_coords(ds)
 
     return ds
 
 
-def main(args):
-    """Run the program."""
-
-    regions = get_regions()
-    ds = xr.open_dataset(args.infile, decode_timedelta=False)
+def process_file(
+    infile,
+    var,
+    outfile,
+    arid_mask=False,
+    cities=False,
+    cache_dir=None,
+    cache_max_gb=None,
+    cache_max_days=None,
+    region_spec=None,
+    aggregation='dense',
+    points_file=None,
+):
+    """Convert one netCDF file to csv."""
+
+    ds = catalogue.open_dataset(infile, decode_timedelta=False)
     ds = model_fixes(ds)
 
-    frac = regions.mask_3D_frac_approx(ds)
-    if args.mask_arid:
-        frac = mask_arid(frac)
-    weights = np.cos(np.deg2rad(ds['lat']))
-
-    spatial_means = ds[args.var].weighted(frac * weights).mean(dim=("lat", "lon"))
+    region_options = {
+        'arid_mask': arid_mask,
+        'cache_dir': cache_dir,
+        'cache_max_gb': cache_max_gb,
+        'cache_max_days': cache_max_days,
+        'region_spec': region_spec,
+    }
+    if aggregation == 'sparse':
+        matrix, abbrevs = get_region_matrix(ds, **region_options)
+        spatial_means = sparse_spatial_mean(ds[var], matrix, abbrevs)
+    else:
+        region_weights = get_region_weights(ds, **region_options)
+        spatial_means = ds[var].weighted(region_weights).mean(dim=("lat", "lon"))
     df = spatial_means.to_pandas()
     df.columns = spatial_means['abbrevs']
     df = df.round(decimals=2)
-    if args.add_cities:
-        df = add_cities(ds[args.var], df, index)
+    points = CITY_COORDS.copy() if cities else {}
+    if points_file:
+        file_points = read_points(points_file)
+        duplicates = sorted(set(points) & set(file_points))
+        assert not duplicates, f'Point names in {points_file} already used for cities: {", ".join(duplicates)}'
+        points.update(file_points)
+    if points:
+        df = add_points(ds[var], df, points, cache_dir=cache_dir)
     df.insert(loc=0, column='experiment', value=np.where(df.index >= '2015-01-01', ds.attrs['experiment_id'], 'historical'))
     df.insert(loc=0, column='run', value=ds.attrs['variant_label'])
     df.insert(loc=0, column='model', value=ds.attrs['source_id'])
     year = df.index.strftime('%Y-%m')
-    if args.var == 'SPEI':
+    if var == 'SPEI':
         df.insert(loc=0, column='month', value=df.index.month)
     df.insert(loc=0, column='year', value=df.index.year)
-    df.to_csv(args.outfile, index=False)
+    df.to_csv(outfile, index=False)
+
+
+def read_manifest(manifest_file, arid_mask=False, cities=False):
+    """Read a batch manifest.
+
+    The manifest is a csv file with columns infile, var and outfile,
+    and optional true/false columns mask_arid and add_cities
+    (which default to the arid_mask and cities arguments).
+    """
+
+    defaults = {'arid_mask': arid_mask, 'cities': cities}
+    tasks = []
+    with open(manifest_file, newline='') as manifest:
+        for row in csv.DictReader(manifest):
+            task = {'infile': row['infile'], 'var': row['var'], 'outfile': row['outfile']}
+            for column, option in [('mask_arid', 'arid_mask'), ('add_cities', 'cities')]:
+                value = (row.get(column) or str(defaults[option])).strip().lower()
+                assert value in ['true', 'false'], f'Invalid {column} value in manifest: {value}'
+                task[option] = value == 'true'
+            tasks.append(task)
+
+    return tasks
+
+
+def run_batch(
+    tasks,
+    cache_dir,
+    workers=1,
+    cache_max_gb=None,
+    cache_max_days=None,
+    region_spec=None,
+    aggregation='dense',
+    points_file=None,
+):
+    """Convert many netCDF files to csv.
+
+    The region weights for each grid are calculated once up front and
+    written to the cache, so that each file (which can be processed by
+    a pool of worker processes) only needs to read them.
+    """
+
+    options = {
+        'cache_dir': cache_dir,
+        'cache_max_gb': cache_max_gb,
+        'cache_max_days': cache_max_days,
+        'region_spec': region_spec,
+    }
+    get_weights = get_region_matrix if aggregation == 'sparse' else get_region_weights
+    grids = set()
+    for task in tasks:
+        with catalogue.open_dataset(task['infile'], decode_timedelta=False) as ds:
+            ds = model_fixes(ds)
+            grid = (cache_utils.grid_hash(ds), task['arid_mask'])
+            if grid not in grids:
+                get_weights(ds, arid_mask=task['arid_mask'], **options)
+                grids.add(grid)
+    options['aggregation'] = aggregation
+    options['points_file'] = points_file
+    logging.info(f'{len(tasks)} files on {len(grids)} grid(s)')
+
+    failures = []
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(process_file, **task, **options): task for task in tasks}
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    future.result()
+                    logging.info(task['outfile'])
+                except Exception as error:
+                    logging.error(f'{task["infile"]}: {error}')
+                    failures.append(task)
+    else:
+        for task in tasks:
+            try:
+                process_file(**task, **options)
+                logging.info(task['outfile'])
+            except Exception as error:
+                logging.error(f'{task["infile"]}: {error}')
+                failures.append(task)
+
+    return failures
+
+
+def main(args):
+    """Run the program."""
+
+    profile = profiling.Profile(args.profile)
+    region_spec = None
+    if args.regions_file:
+        region_spec = {
+            'file': args.regions_file,
+            'names': args.region_names,
+            'abbrevs': args.region_abbrevs,
+        }
+
+    if not args.manifest:
+        with profile.stage('convert', infile=os.path.basename(args.infile)):
+            process_file(
+                args.infile,
+                args.var,
+                args.outfile,
+                arid_mask=args.mask_arid,
+                cities=args.add_cities,
+                cache_dir=args.cache_dir,
+                cache_max_gb=args.cache_max_gb,
+                cache_max_days=args.cache_max_days,
+                region_spec=region_spec,
+                aggregation=args.aggregation,
+                points_file=args.points_file,
+            )
+        return
+
+    tasks = read_manifest(args.manifest, arid_mask=args.mask_arid, cities=args.add_cities)
+    with profile.stage('batch', nfiles=len(tasks)), tempfile.TemporaryDirectory() as temp_dir:
+        failures = run_batch(
+            tasks,
+            args.cache_dir or temp_dir,
+            workers=args.workers,
+            cache_max_gb=args.cache_max_gb,
+            cache_max_days=args.cache_max_days,
+            region_spec=region_spec,
+            aggregation=args.aggregation,
+            points_file=args.points_file,
+        )
+    if failures:
+        raise SystemExit(f'{len(failures)} of {len(tasks)} files failed')
 
 
 if __name__ == '__main__':
@@ -211,10 +619,26 @@ if __name__ == '__main__':
         description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
-    parser.add_argument("infile", type=str, help="input file name")
-    parser.add_argument("var", type=str, help="input file name")
-    parser.add_argument("outfile", type=str, help="output file name")
+    parser.add_argument("infile", type=str, nargs='?', help="input file name")
+    parser.add_argument("var", type=str, nargs='?', help="input file name")
+    parser.add_argument("outfile", type=str, nargs='?', help="output file name")
     parser.add_argument("--mask_arid", action="store_true", default=False, help="mask arid areas")
     parser.add_argument("--add_cities", action="store_true", default=False, help="add cities to the output file")
+    parser.add_argument("--points_file", type=str, default=None,
+                        help="add the values at the points in this csv file (columns name, lat, lon) to the output file")
+    parser.add_argument("--cache_dir", type=str, default=None, help="directory for caching region weights (no caching if not given)")
+    parser.add_argument("--cache_max_gb", type=float, default=10, help="maximum size of the cache directory in GB [default=10]")
+    parser.add_argument("--cache_max_days", type=float, default=90, help="remove cache files not used for this many days [default=90]")
+    parser.add_argument("--aggregation", type=str, choices=('dense', 'sparse'), default='dense',
+                        help="regional mean with a dense 3D region mask or a sparse region weights matrix [default=dense]")
+    parser.add_argument("--regions_file", type=str, default=None, help="shapefile of regions to use instead of the Australian states")
+    parser.add_argument("--region_names", type=str, default=None, help="column of regions_file holding the region names")
+    parser.add_argument("--region_abbrevs", type=str, default=None, help="column of regions_file holding the region abbreviations")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="batch mode: csv file with columns infile, var, outfile (and optionally mask_arid, add_cities)")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes in batch mode [default=1]")
+    profiling.add_arguments(parser)
     args = parser.parse_args()
+    if not args.manifest and not (args.infile and args.var and args.outfile):
+        parser.error('infile, var and outfile are required unless --manifest is given')
     main(args)
@@ -1,24 +1,65 @@
 """Take a dataset and produce a chunked zarr collection."""
 
 import os
+import shutil
 import argparse
 import logging
 
-import xarray as xr
+import numpy as np
 from rechunker import rechunk
 import dask.diagnostics
 import zarr
+import numcodecs
 import cmdline_provenance as cmdprov
 
+import tiling
+import profiling
+import catalogue
+
 
 dask.diagnostics.ProgressBar().register()
 logging.basicConfig(level=logging.INFO)
 
 
-def define_target_chunks(ds, var):
+def pencil_chunks(ds, var, target_chunk_mb=100, pencil_size=1):
+    """Choose chunks that hold the full time series for a block of grid cells.
+
+    The number of grid cells in each chunk is chosen so the chunk is close
+    to (but not larger than) target_chunk_mb, and the lat/lon chunk sizes
+    are a multiple of pencil_size (the block of grid cells that downstream
+    programs read at once).
+    """
+
+    ntime = len(ds['time'])
+    nlat = len(ds['lat'])
+    nlon = len(ds['lon'])
+    lat_size, lon_size = tiling.tile_size_for_memory(
+        ntime,
+        nlat,
+        nlon,
+        target_chunk_mb * 1e6,
+        bytes_per_value=np.dtype(ds[var].dtype).itemsize,
+    )
+    lat_size = min(max(pencil_size, lat_size - lat_size % pencil_size), nlat)
+    lon_size = min(max(pencil_size, lon_size - lon_size % pencil_size), nlon)
+
+    return {'time': ntime, 'lat': lat_size, 'lon': lon_size}
+
+
+def get_compressor(name, level):
+    """Define the Zarr compressor."""
+
+    if name == 'none':
+        return None
+
+    return numcodecs.Blosc(cname=name, clevel=level, shuffle=numcodecs.Blosc.SHUFFLE)
+
+
+def define_target_chunks(ds, var, target_chunk_mb=100, pencil_size=1):
     """Create a target chunks dictionary."""
 
-    chunks = {'time': len(ds['time']), 'lat': 1, 'lon': 1}
+    chunks = pencil_chunks(ds, var, target_chunk_mb=target_chunk_mb, pencil_size=pencil_size)
+    logging.info(f'Target chunks: {chunks}')
     target_chunks_dict = {var: chunks}
     variables = list(ds.keys())
     variables.remove(var)
@@ -41,36 +82,66 @@ def drop_vars(ds):
     return ds
 
 
+def is_complete(zarr_path):
+    """Check whether a zarr collection was written in full (i.e. it has consolidated metadata)."""
+
+    return os.path.isfile(os.path.join(zarr_path, '.zmetadata'))
+
+
+def clean_up(path):
+    """Remove a zarr collection (if it exists)."""
+
+    if os.path.isdir(path):
+        logging.info(f'Removing {path}')
+        shutil.rmtree(path)
+
+
 def main(args):
     """Run the command line program."""
 
-    assert not os.path.isdir(args.output_zarr), f"Output Zarr collection already exists: {args.output_zarr}"
-    ds = xr.open_mfdataset(args.infiles, preprocess=drop_vars, attrs_file=args.infiles[-1])
-    coords = list(ds.coords)
-    chunks = ds[args.var].encoding['chunksizes']
-    input_chunks = {}
-    for coord, chunk in zip(coords, chunks):
-        input_chunks[coord] = chunk
-    ds = ds.chunk(input_chunks)
-    ds.attrs['history'] = cmdprov.new_log(
-        infile_logs={args.infiles[0]: ds.attrs['history']}
-    )
-    for var in ds.variables:
-        ds[var].encoding = {}
-    target_chunks_dict = define_target_chunks(ds, args.var)
-    group_plan = rechunk(
-        ds,
-        target_chunks_dict,
-        args.max_mem,
-        args.output_zarr,
-        temp_store=args.temp_zarr
-    )
-    group_plan.execute()
-    zarr.consolidate_metadata(args.output_zarr)
-
-    clean_up_command = f'rm -r {args.temp_zarr}'
-    logging.info(clean_up_command)
-    os.system(clean_up_command)
+    profile = profiling.Profile(args.profile)
+    if is_complete(args.output_zarr):
+        logging.info(f'Output Zarr collection already complete: {args.output_zarr}')
+        clean_up(args.temp_zarr)
+        return
+    clean_up(args.output_zarr)
+    clean_up(args.temp_zarr)
+
+    with profile.stage('open'):
+        ds = catalogue.open_mfdataset(args.infiles, preprocess=drop_vars, attrs_file=args.infiles[-1])
+        coords = list(ds.coords)
+        encoding = ds[args.var].encoding
+        chunks = encoding['chunksizes'] if 'chunksizes' in encoding else encoding['chunks']
+        input_chunks = {}
+        for coord, chunk in zip(coords, chunks):
+            input_chunks[coord] = chunk
+        ds = ds.chunk(input_chunks)
+        ds.attrs['history'] = cmdprov.new_log(
+            infile_logs={args.infiles[0]: ds.attrs['history']}
+        )
+        for var in ds.variables:
+            ds[var].encoding = {}
+    with profile.stage('plan'):
+        target_chunks_dict = define_target_chunks(
+            ds,
+            args.var,
+            target_chunk_mb=args.target_chunk_mb,
+            pencil_size=args.pencil_size,
+        )
+        compressor = get_compressor(args.compressor, args.compression_level)
+        group_plan = rechunk(
+            ds,
+            target_chunks_dict,
+            args.max_mem,
+            args.output_zarr,
+            target_options={args.var: {'compressor': compressor}},
+            temp_store=args.temp_zarr
+        )
+    with profile.stage('rechunk'):
+        group_plan.execute(scheduler=args.scheduler, num_workers=args.workers)
+        zarr.consolidate_metadata(args.output_zarr)
+
+    clean_up(args.temp_zarr)
 
 
 if __name__ == '__main__':
@@ -81,6 +152,16 @@ if __name__ == '__main__':
     parser.add_argument("output_zarr", type=str, help="Path to output chunked zarr collection")
     parser.add_argument("temp_zarr", type=str, help="Temporary zarr collection")
     parser.add_argument("--max_mem", type=str, default='5GB', help="Maximum memory that workers can use")
+    parser.add_argument("--target_chunk_mb", type=float, default=100, help="Target size of each output chunk in MB [default=100]")
+    parser.add_argument("--pencil_size", type=int, default=1,
+                        help="Output lat/lon chunk sizes are a multiple of this number of grid cells [default=1]")
+    parser.add_argument("--compressor", type=str, choices=('zstd', 'lz4', 'zlib', 'blosclz', 'none'), default='zstd',
+                        help="Blosc compressor for the output variable [default=zstd]")
+    parser.add_argument("--compression_level", type=int, default=3, help="Compression level [default=3]")
+    parser.add_argument("--scheduler", type=str, choices=('threads', 'processes', 'synchronous'), default='threads',
+                        help="Dask scheduler used to run the rechunk plan [default=threads]")
+    parser.add_argument("--workers", type=int, default=None, help="Number of workers [default=number of cores]")
+    profiling.add_arguments(parser)
     args = parser.parse_args()
     main(args)
     
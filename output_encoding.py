@@ -0,0 +1,188 @@
+"""Data type, compression and chunking of the files written by each program
+
+Without an encoding, xarray writes every variable uncompressed as float64
+(or whatever data type the calculation produced) with the chunk shape
+left over from dask. The policy here sets the data type, compression and
+chunk shape of each output variable to suit the program that reads it next:
+- daily evspsblpot is read a whole map at a time over many days
+  (spei.py), so its chunks cover the whole grid and a block of days
+- daily KBDI is read one spatial tile at a time (ffdi.py), so its chunks
+  are pencils of grid points (that tiles can line up with) over a block of days
+- metrics (WSDI, SPEI, FFDIx, FFDIgt99p) are read whole by nc_to_csv.py,
+  so they are written as one chunk (up to MAX_CHUNK_MB), as are the
+  ensemble statistics of the metrics
+
+An output file name ending in .zarr is written as a Zarr collection instead
+of a netCDF file, with the chunks compressed and written in parallel by dask.
+"""
+
+import os
+import fnmatch
+
+import numpy as np
+import numcodecs
+import zarr
+
+
+MAX_CHUNK_MB = 64
+DEFAULT_POLICY = {'dtype': None, 'complevel': 4, 'shuffle': True, 'time_chunk': 365, 'spatial_chunk': None}
+VARIABLE_POLICIES = {
+    # Pencils the same size as the Zarr pencils written by ensemble.py
+    'KBDI': {'dtype': 'float32', 'time_chunk': 365, 'spatial_chunk': 20},
+    # The SPEI distribution fit is sensitive to rounding evspsblpot to float32
+    'evspsblpot': {'dtype': None, 'time_chunk': 3650},
+    'WSDI': {'dtype': 'float32', 'time_chunk': None},
+    'SPEI*': {'dtype': 'float32', 'time_chunk': None},
+    'FFDIx': {'dtype': 'float32', 'time_chunk': None},
+    'FFDIgt99p': {'dtype': 'float32', 'time_chunk': None},
+    # Ensemble statistics (ensemble_stats.py)
+    '*_mean': {'dtype': 'float32', 'time_chunk': None},
+    '*_std': {'dtype': 'float32', 'time_chunk': None},
+    '*_percentile': {'dtype': 'float32', 'time_chunk': None},
+}
+ZARR_COMPRESSION = {'cname': 'zstd', 'clevel': 3}
+COORD_ENCODING_KEYS = ['units', 'calendar', 'dtype']
+
+
+def is_zarr(path):
+    """Check if an output path is a Zarr collection (rather than a netCDF file)."""
+
+    return path.rstrip('/').endswith('.zarr')
+
+
+def get_policy(var):
+    """Get the encoding policy for a variable.
+
+    Parameters
+    ----------
+    var : str
+        Variable name (matched against the VARIABLE_POLICIES patterns)
+
+    Returns
+    -------
+    dict
+        dtype (None to keep the data type), complevel, shuffle,
+        time_chunk (None for the whole time axis) and
+        spatial_chunk (None for the whole of the lat and lon axes)
+    """
+
+    policy = dict(DEFAULT_POLICY)
+    for pattern, overrides in VARIABLE_POLICIES.items():
+        if fnmatch.fnmatchcase(var, pattern):
+            policy.update(overrides)
+
+    return policy
+
+
+def chunk_sizes(da, time_chunk, max_chunk_mb=MAX_CHUNK_MB, spatial_chunk=None):
+    """Define the chunk size along each dimension of a variable.
+
+    Chunks cover the whole of every dimension except time,
+    which is split into blocks of time_chunk steps (or fewer if a chunk
+    would be larger than max_chunk_mb), and, if spatial_chunk is given,
+    lat and lon, which are split into blocks of spatial_chunk grid points.
+    """
+
+    sizes = dict(da.sizes)
+    if spatial_chunk:
+        for dim in ['lat', 'lon']:
+            if dim in sizes:
+                sizes[dim] = min(spatial_chunk, sizes[dim])
+    if 'time' in sizes:
+        other_size = int(np.prod([size for dim, size in sizes.items() if dim != 'time']))
+        max_steps = max(1, int(max_chunk_mb * 1e6 // (other_size * da.dtype.itemsize)))
+        steps = sizes['time'] if time_chunk is None else min(time_chunk, sizes['time'])
+        sizes['time'] = min(steps, max_steps)
+
+    return sizes
+
+
+def compressor_encoding():
+    """Define the compressor encoding for a Zarr variable."""
+
+    if int(zarr.__version__.split('.')[0]) >= 3:
+        compressor = zarr.codecs.BloscCodec(shuffle='shuffle', **ZARR_COMPRESSION)
+        return {'compressors': [compressor]}
+    else:
+        compressor = numcodecs.Blosc(shuffle=numcodecs.Blosc.SHUFFLE, **ZARR_COMPRESSION)
+        return {'compressor': compressor}
+
+
+def apply_policy(ds, zarr_output=False, exact=False, time_chunk=None):
+    """Cast, rechunk and set the encoding of each variable in a dataset.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        Dataset to be written
+    zarr_output : bool, default False
+        Set the encoding for a Zarr collection (rather than a netCDF file)
+    exact : bool, default False
+        Keep the data type of every variable (e.g. for model state)
+    time_chunk : int, optional
+        Number of time steps in each chunk [default=variable policy]
+
+    Returns
+    -------
+    xarray.Dataset
+    """
+
+    ds = ds.copy()
+    for var in ds.coords:
+        encoding = ds[var].encoding
+        ds[var].encoding = {key: encoding[key] for key in COORD_ENCODING_KEYS if key in encoding}
+        ds[var].encoding['_FillValue'] = None
+    chunks = {}
+    for var in ds.data_vars:
+        policy = get_policy(var)
+        if policy['dtype'] and not exact and ds[var].dtype.kind == 'f':
+            ds[var] = ds[var].astype(policy['dtype'])
+        ds[var].encoding = {}
+        if ds[var].ndim == 0 or ds[var].dtype.kind not in 'iuf':
+            continue
+        sizes = chunk_sizes(ds[var], time_chunk or policy['time_chunk'], spatial_chunk=policy['spatial_chunk'])
+        for dim, size in sizes.items():
+            chunks[dim] = min(chunks.get(dim, size), size)
+        shape = tuple(sizes[dim] for dim in ds[var].dims)
+        if zarr_output:
+            ds[var].encoding = {'chunks': shape, **compressor_encoding()}
+        else:
+            ds[var].encoding = {
+                'zlib': True,
+                'complevel': policy['complevel'],
+                'shuffle': policy['shuffle'],
+                'chunksizes': shape,
+            }
+    if zarr_output:
+        # Zarr chunks must line up with the dask chunks that write them
+        for var in ds.data_vars:
+            if 'chunks' in ds[var].encoding:
+                ds[var].encoding['chunks'] = tuple(chunks[dim] for dim in ds[var].dims)
+
+    return ds.chunk(chunks)
+
+
+def write(ds, outfile, exact=False, time_chunk=None):
+    """Write a dataset to a compressed netCDF file or Zarr collection.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        Dataset to write
+    outfile : str
+        Output file name (a name ending in .zarr is written as a Zarr collection)
+    exact : bool, default False
+        Keep the data type of every variable (e.g. for model state)
+    time_chunk : int, optional
+        Number of time steps in each chunk [default=variable policy]
+    """
+
+    zarr_output = is_zarr(outfile)
+    ds = apply_policy(ds, zarr_output=zarr_output, exact=exact, time_chunk=time_chunk)
+    if zarr_output:
+        ds.to_zarr(outfile, mode='w', consolidated=True)
+    else:
+        if os.path.lexists(outfile):
+            # Replace rather than overwrite, in case the file is linked to a cached product
+            os.remove(outfile)
+        ds.to_netcdf(outfile)
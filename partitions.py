@@ -0,0 +1,211 @@
+"""Annual output partitions that are only recalculated when their inputs change
+
+The annual metrics (WSDI, FFDIx and FFDIgt99p) are kept in a partition
+directory with one file per year, alongside a manifest that records the
+key (a hash of the input fingerprints) each year was calculated from.
+When the input data are extended (e.g. to 2300) or a new dataset version
+replaces some of the files, only the years whose key has changed are
+recalculated, and the partitions are stitched back together into the
+usual output file.
+
+Each input file is fingerprinted by its CMIP6 tracking_id (which stays
+the same when an unchanged file is republished in a new version) or,
+failing that, by its path, size and modification time.
+"""
+
+import os
+import json
+from collections import defaultdict
+
+import numpy as np
+import xarray as xr
+
+import cache_utils
+import catalogue
+import output_encoding
+
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def file_fingerprint(path, ds):
+    """Describe an (open) input file for a partition key."""
+
+    tracking_id = ds.attrs.get('tracking_id')
+    if tracking_id and not catalogue.is_reference(path):
+        return tracking_id
+
+    return cache_utils.file_signature(path)
+
+
+def year_fingerprints(input_files):
+    """Fingerprint the input data for each year.
+
+    Parameters
+    ----------
+    input_files : dict
+        List of input files for each variable
+
+    Returns
+    -------
+    dict
+        Fingerprint (hash of the files that cover the year) for each year
+    """
+
+    items = defaultdict(list)
+    for var in sorted(input_files):
+        for infile in input_files[var]:
+            with catalogue.open_dataset(infile) as ds:
+                years = np.unique(ds['time'].dt.year.values)
+                fingerprint = file_fingerprint(infile, ds)
+            for year in years:
+                items[int(year)].append((var, fingerprint))
+
+    return {year: cache_utils.hash_items(*items[year]) for year in sorted(items)}
+
+
+def chain_keys(fingerprints, *options):
+    """Define keys for years that depend on every year before them (e.g. via the KBDI state).
+
+    The key for each year is made from its own fingerprint and the key for
+    the year before, so a change to the inputs for one year changes the
+    keys for every year after it.
+    """
+
+    keys = {}
+    previous_key = None
+    for year in sorted(fingerprints):
+        keys[year] = cache_utils.hash_items(previous_key, fingerprints[year], *options)
+        previous_key = keys[year]
+
+    return keys
+
+
+def year_runs(years):
+    """Group years into runs of consecutive years.
+
+    Returns
+    -------
+    list
+        First and last year of each run
+    """
+
+    runs = []
+    for year in sorted(years):
+        if runs and year == runs[-1][1] + 1:
+            runs[-1][1] = year
+        else:
+            runs.append([year, year])
+
+    return runs
+
+
+def read_manifest(partition_dir):
+    """Read the partition manifest (or an empty one if there isn't one yet)."""
+
+    manifest_file = os.path.join(partition_dir, MANIFEST_FILE)
+    if not os.path.isfile(manifest_file):
+        return {'baseline': None, 'years': {}}
+    with open(manifest_file) as reader:
+        return json.load(reader)
+
+
+def write_manifest(partition_dir, manifest):
+    """Write the partition manifest."""
+
+    def write_json(path):
+        with open(path, 'w') as writer:
+            json.dump(manifest, writer, indent=2)
+
+    cache_utils.write_atomic(write_json, os.path.join(partition_dir, MANIFEST_FILE))
+
+
+def partition_path(partition_dir, year):
+    """Define the path of the partition for a year."""
+
+    return os.path.join(partition_dir, f'{year}.nc')
+
+
+def baseline_path(partition_dir):
+    """Define the path of the baseline (e.g. tx90 or the FFDI threshold) file."""
+
+    return os.path.join(partition_dir, 'baseline.nc')
+
+
+def stale_years(partition_dir, manifest, keys):
+    """Find the years whose partition is missing or was calculated from different inputs."""
+
+    stale = []
+    for year, key in keys.items():
+        if manifest['years'].get(str(year)) != key or not os.path.isfile(partition_path(partition_dir, year)):
+            stale.append(year)
+
+    return stale
+
+
+def baseline_is_current(partition_dir, manifest, key):
+    """Check if the baseline file was calculated from the current inputs."""
+
+    return manifest['baseline'] == key and os.path.isfile(baseline_path(partition_dir))
+
+
+def write_baseline(ds, partition_dir, manifest, key):
+    """Write the baseline file and record its key in the manifest.
+
+    The partitions for every year depend on the baseline,
+    so they are all removed from the manifest.
+    """
+
+    cache_utils.write_atomic(lambda path: output_encoding.write(ds, path, exact=True), baseline_path(partition_dir))
+    manifest['baseline'] = key
+    manifest['years'] = {}
+    write_manifest(partition_dir, manifest)
+
+
+def read_baseline(partition_dir):
+    """Read the baseline file."""
+
+    with xr.open_dataset(baseline_path(partition_dir)) as ds:
+        return ds.load()
+
+
+def write_partition(ds, partition_dir, manifest, year, key):
+    """Write the partition for a year and record its key in the manifest.
+
+    The manifest is written after every partition,
+    so an interrupted calculation can carry on from where it stopped.
+    """
+
+    cache_utils.write_atomic(lambda path: output_encoding.write(ds, path, exact=True), partition_path(partition_dir, year))
+    manifest['years'][str(year)] = key
+    write_manifest(partition_dir, manifest)
+
+
+def read_partition(partition_dir, year):
+    """Read the partition for a year."""
+
+    with xr.open_dataset(partition_path(partition_dir, year)) as ds:
+        return ds.load()
+
+
+def stitch(partition_dir, years, variables):
+    """Combine the partitions for a list of years into one dataset.
+
+    Parameters
+    ----------
+    partition_dir : str
+        Partition directory
+    years : list
+        Years to combine
+    variables : list
+        Variables (with a time dimension) to take from each partition
+
+    Returns
+    -------
+    xarray.Dataset
+    """
+
+    datasets = [read_partition(partition_dir, year)[variables] for year in sorted(years)]
+    ds = xr.concat(datasets, dim='time', combine_attrs='override')
+
+    return ds
@@ -1,29 +1,211 @@
-"""Command line program for calculating the annual precipitation climatology"""
+"""Command line program for calculating the annual precipitation climatology
+
+The input files are read one year at a time (in time order) and only the
+running precipitation totals for each climatology period are kept in
+memory, so the memory needed doesn't grow with the number of input files.
+Several periods (e.g. 1950-2014, 1961-1990 and 1991-2020) can be
+calculated from one read of the files (see --period).
+"""
 
 import argparse
+import logging
 
 import numpy as np
 import xarray as xr
 import xclim as xc
 import dask.diagnostics
 import cmdline_provenance as cmdprov
-    
+
+import roi
+import profiling
+import intermediates
+import catalogue
+
 
 dask.diagnostics.ProgressBar().register()
+# force=True because importing xclim has already configured the root logger
+logging.basicConfig(level=logging.INFO, force=True)
 
 
-def main(args):
-    """Run the program."""
+def calc_climatology(ds, start_date, end_date):
+    """Calculate the annual precipitation climatology (mm/year) over a period."""
 
-    ds = xr.open_mfdataset(args.infiles)
+    ds = ds.copy()
     ds['pr'] = xc.core.units.convert_units_to(ds['pr'], 'mm/day')
-    ds = ds.sel(time=slice(args.start_date, args.end_date))
+    ds = ds.sel(time=slice(start_date, end_date))
     ds_annual = ds.resample(time='YE').sum('time').mean('time')
     ds_annual['pr'].attrs['units'] = 'mm/year'
     ds_annual['pr'].attrs['long_name'] = 'Precipitation'
     ds_annual['pr'].attrs['standard_name'] = 'precipitation_flux'
     ds_annual.attrs = ds.attrs
-    ds_annual.to_netcdf(args.outfile)
+
+    return ds_annual
+
+
+class ClimatologyPeriod:
+    """Running precipitation totals for one climatology period.
+
+    Gives the same climatology as calc_climatology (the mean of the annual
+    totals), calculated as the total over the period divided by the
+    number of years (and for the monthly climatology, the total for each
+    month of the year divided by the number of those months).
+
+    Parameters
+    ----------
+    start_date : str
+        Start date in YYYY-MM-DD format
+    end_date : str
+        End date in YYYY-MM-DD format
+    monthly : bool, default False
+        Also calculate the monthly climatology
+    """
+
+    def __init__(self, start_date, end_date, monthly=False):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.monthly = monthly
+        self.total = None
+        self.years = set()
+        self.month_totals = {}
+        self.month_years = {}
+        self.dtype = None
+
+    def covers(self, year):
+        """Check if any of a year is within the period."""
+
+        return int(self.start_date[:4]) <= year <= int(self.end_date[:4])
+
+    def add(self, year_da, year):
+        """Add daily precipitation (mm/day) for one year (or part of a year)."""
+
+        period_da = year_da.sel(time=slice(self.start_date, self.end_date))
+        if not len(period_da['time']):
+            return
+        self.dtype = period_da.dtype
+        year_total = period_da.sum('time').astype(np.float64)
+        self.total = year_total if self.total is None else self.total + year_total
+        self.years.add(year)
+        if self.monthly:
+            for month, month_da in period_da.groupby('time.month'):
+                month_total = month_da.sum('time').astype(np.float64)
+                if month in self.month_totals:
+                    self.month_totals[month] = self.month_totals[month] + month_total
+                else:
+                    self.month_totals[month] = month_total
+                    self.month_years[month] = set()
+                self.month_years[month].add(year)
+
+    def result(self, attrs):
+        """Calculate the climatology from the running totals.
+
+        Returns
+        -------
+        xarray.Dataset
+            Annual climatology (pr, mm/year) and, if requested,
+            monthly climatology (pr_monthly, mm/month)
+        """
+
+        assert self.years, f'No input data for {self.start_date} to {self.end_date}'
+        ds = xr.Dataset({'pr': (self.total / len(self.years)).astype(self.dtype)})
+        ds['pr'].attrs['units'] = 'mm/year'
+        ds['pr'].attrs['long_name'] = 'Precipitation'
+        ds['pr'].attrs['standard_name'] = 'precipitation_flux'
+        if self.monthly:
+            months = sorted(self.month_totals)
+            monthly_da = xr.concat(
+                [self.month_totals[month] / len(self.month_years[month]) for month in months],
+                dim=xr.DataArray(months, dims='month', name='month'),
+            )
+            ds['pr_monthly'] = monthly_da.astype(self.dtype)
+            ds['pr_monthly'].attrs['units'] = 'mm/month'
+            ds['pr_monthly'].attrs['long_name'] = 'Monthly precipitation'
+            ds['pr_monthly'].attrs['standard_name'] = 'precipitation_flux'
+        ds.attrs = attrs
+
+        return ds
+
+
+def sort_files(infiles):
+    """Sort input files into time order (by their first time step)."""
+
+    start_times = {}
+    for infile in infiles:
+        with catalogue.open_dataset(infile) as ds:
+            start_times[infile] = ds['time'].values[0]
+
+    return sorted(infiles, key=lambda infile: start_times[infile])
+
+
+def accumulate(infiles, periods, bbox=None):
+    """Add the daily precipitation to the running totals for each period.
+
+    The input files are read in time order, one year at a time,
+    skipping any year that isn't in one of the periods.
+
+    Parameters
+    ----------
+    infiles : list
+        Input daily precipitation files
+    periods : list
+        ClimatologyPeriod for each climatology period
+    bbox : list, optional
+        Bounding box: [south bound, north bound, west bound, east bound]
+
+    Returns
+    -------
+    dict
+        Global attributes of the first input file
+    """
+
+    attrs = None
+    for infile in sort_files(infiles):
+        with catalogue.open_dataset(infile) as ds:
+            if bbox is not None:
+                ds = roi.subset(ds, bbox)
+            if attrs is None:
+                attrs = dict(ds.attrs)
+            file_years = ds['time'].dt.year.values
+            for year in np.unique(file_years):
+                year_periods = [period for period in periods if period.covers(year)]
+                if not year_periods:
+                    continue
+                year_index = np.nonzero(file_years == year)[0]
+                year_da = ds['pr'].isel(time=slice(year_index[0], year_index[-1] + 1)).load()
+                year_da = xc.core.units.convert_units_to(year_da, 'mm/day')
+                for period in year_periods:
+                    period.add(year_da, int(year))
+
+    return attrs
+
+
+def main(args):
+    """Run the program."""
+
+    profile = profiling.Profile(args.profile)
+    bbox = roi.get_bbox(args)
+    monthly_option = ['monthly'] if args.monthly else []
+    pending = []
+    for start_date, end_date, outfile in [(args.start_date, args.end_date, args.outfile)] + (args.period or []):
+        if args.cache_dir:
+            with profile.stage('cache_lookup'):
+                key = intermediates.product_key(
+                    'pr-climatology', args.infiles, start_date, end_date, bbox, *monthly_option
+                )
+                cache_hit = intermediates.copy(args.cache_dir, 'pr-climatology', key, outfile)
+            if cache_hit:
+                continue
+        else:
+            key = None
+        pending.append((ClimatologyPeriod(start_date, end_date, monthly=args.monthly), outfile, key))
+    if not pending:
+        return
+
+    with profile.stage('climatology'):
+        attrs = accumulate(args.infiles, [period for period, _, _ in pending], bbox=bbox)
+    with profile.stage('write'):
+        for period, outfile, key in pending:
+            ds_clim = period.result(attrs)
+            intermediates.save(ds_clim, outfile, cache_dir=args.cache_dir, product='pr-climatology', key=key)
 
 
 if __name__ == '__main__':
@@ -34,6 +216,15 @@ if __name__ == '__main__':
     parser.add_argument("infiles", type=str, nargs='*', help="input daily precipitation files")
     parser.add_argument("start_date", type=str, help="start date in YYYY-MM-DD format")
     parser.add_argument("end_date", type=str, help="end date in YYYY-MM-DD format")
-    parser.add_argument("outfile", type=str, help="output file name")
+    parser.add_argument("outfile", type=str, help="output file name (.nc or .zarr)")
+    parser.add_argument("--period", type=str, nargs=3, action='append', default=None,
+                        metavar=('START_DATE', 'END_DATE', 'OUTFILE'),
+                        help="calculate the climatology for another period in the same read of the files (can be repeated)")
+    parser.add_argument("--monthly", action="store_true", default=False,
+                        help="also calculate the monthly climatology (pr_monthly in mm/month)")
+    roi.add_arguments(parser)
+    profiling.add_arguments(parser)
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="share the climatology between runs via this cache directory")
     args = parser.parse_args()
     main(args)
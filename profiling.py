@@ -0,0 +1,254 @@
+"""Utilities for recording the time, memory and I/O used by each stage of a calculation
+
+Most of the work in these scripts is done lazily by dask, so the stage
+that triggers the computation (usually writing the output) does the
+work of the stages before it. The dask task summary for each stage
+shows which operations (e.g. open_dataset, convert_units_to or quantile)
+that time was spent on.
+
+The profile is written after every stage, so if a job is killed
+(e.g. at its walltime or memory limit), the last stage in the file shows
+where it was.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import threading
+import contextlib
+from collections import defaultdict
+
+import psutil
+import pandas as pd
+import dask.diagnostics
+from dask.utils import key_split
+
+
+IO_FIELDS = ['rchar', 'wchar', 'read_bytes', 'write_bytes']
+TOP_TASKS = 10
+STAGE_KEYS = ['name', 'status', 'dask', 'sampled_mean_cpu_percent']
+
+
+def read_io():
+    """Read the I/O counters of this process (Linux only; empty on other systems).
+
+    rchar/wchar count all bytes passed to read/write calls,
+    while read_bytes/write_bytes only count bytes that went to or from disk.
+    """
+
+    counters = {}
+    try:
+        with open('/proc/self/io') as reader:
+            for line in reader:
+                field, value = line.split(':')
+                if field in IO_FIELDS:
+                    counters[field] = int(value)
+    except OSError:
+        pass
+
+    return counters
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far (in MB)."""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak = peak * 1024
+
+    return peak / 1e6
+
+
+def summarise_tasks(results):
+    """Summarise the dask tasks recorded by a dask.diagnostics.Profiler.
+
+    Returns
+    -------
+    dict
+        Number of tasks, total task time and the task types that took the most time
+    """
+
+    task_time = defaultdict(float)
+    task_count = defaultdict(int)
+    for result in results:
+        name = key_split(result.key)
+        task_time[name] += result.end_time - result.start_time
+        task_count[name] += 1
+    top_names = sorted(task_time, key=task_time.get, reverse=True)[:TOP_TASKS]
+
+    return {
+        'ntasks': sum(task_count.values()),
+        'task_time_s': round(sum(task_time.values()), 3),
+        'top_tasks': [
+            {'name': name, 'count': task_count[name], 'time_s': round(task_time[name], 3)} for name in top_names
+        ],
+    }
+
+
+class ResourceSampler:
+    """Sample the memory and CPU use of this process during a stage.
+
+    This does the same job as dask.diagnostics.ResourceProfiler, but from a
+    thread rather than a separate process, so there is nothing left running
+    that could stop a script from exiting.
+
+    Parameters
+    ----------
+    interval : float, default 0.5
+        Time between samples (in seconds)
+    """
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.samples = []
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        """Record samples until the sampler is stopped."""
+
+        self.process.cpu_percent()
+        while not self.stop_event.wait(self.interval):
+            self.samples.append((self.process.memory_info().rss / 1e6, self.process.cpu_percent()))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop_event.set()
+        self.thread.join()
+
+    def summary(self):
+        """Peak memory and mean CPU use over the samples."""
+
+        if not self.samples:
+            return {}
+
+        return {
+            'sampled_peak_memory_mb': round(max(memory for memory, _ in self.samples), 1),
+            'sampled_mean_cpu_percent': round(sum(cpu for _, cpu in self.samples) / len(self.samples), 1),
+        }
+
+
+class Profile:
+    """Record the time, memory, I/O and dask tasks of each stage of a script.
+
+    Parameters
+    ----------
+    outfile : str, optional
+        JSON file to write the profile to (nothing is recorded if None)
+    """
+
+    def __init__(self, outfile=None):
+        self.outfile = outfile
+        self.start_time = time.perf_counter()
+        self.stages = []
+        self.info = {
+            'script': os.path.basename(sys.argv[0]),
+            'argv': sys.argv[1:],
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'pbs_jobid': os.environ.get('PBS_JOBID'),
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+
+    @contextlib.contextmanager
+    def stage(self, name, **details):
+        """Record a stage of the calculation (used as a context manager).
+
+        Any details (e.g. the input file for a stage that is repeated
+        for each file) are added to the stage record.
+        """
+
+        if self.outfile is None:
+            yield
+            return
+
+        record = {'name': name, 'status': 'running', **details}
+        self.stages.append(record)
+        self.write()
+        io_start = read_io()
+        stage_start = time.perf_counter()
+        cpu_start = time.process_time()
+        with dask.diagnostics.Profiler() as task_profiler, ResourceSampler() as resource_sampler:
+            try:
+                yield
+                record['status'] = 'done'
+            except BaseException:
+                record['status'] = 'failed'
+                raise
+            finally:
+                record['wall_time_s'] = round(time.perf_counter() - stage_start, 3)
+                record['cpu_time_s'] = round(time.process_time() - cpu_start, 3)
+                record['peak_rss_mb'] = round(peak_rss_mb(), 1)
+                io_end = read_io()
+                for field in io_end:
+                    record[field] = io_end[field] - io_start.get(field, 0)
+                record.update(resource_sampler.summary())
+                record['dask'] = summarise_tasks(task_profiler.results)
+                self.write()
+
+    def write(self):
+        """Write the profile to its JSON file."""
+
+        if self.outfile is None:
+            return
+
+        profile = dict(self.info)
+        profile['wall_time_s'] = round(time.perf_counter() - self.start_time, 3)
+        profile['peak_rss_mb'] = round(peak_rss_mb(), 1)
+        profile['io'] = read_io()
+        profile['stages'] = self.stages
+        temp_file = f'{self.outfile}.{os.getpid()}.tmp'
+        with open(temp_file, 'w') as writer:
+            json.dump(profile, writer, indent=2)
+        os.replace(temp_file, self.outfile)
+
+
+def add_arguments(parser):
+    """Add the profiling option to a command line parser."""
+
+    parser.add_argument("--profile", type=str, default=None,
+                        help="write the time, memory and I/O used by each stage to this JSON file")
+
+
+def aggregate(profile_files):
+    """Combine profile files into a table with one row per stage.
+
+    Parameters
+    ----------
+    profile_files : list
+        Profile JSON files (e.g. one per task of an ensemble)
+
+    Returns
+    -------
+    pandas.DataFrame
+        Time, memory, I/O and slowest dask task type for each stage
+    """
+
+    rows = []
+    for profile_file in profile_files:
+        with open(profile_file) as reader:
+            profile = json.load(reader)
+        for stage in profile['stages']:
+            row = {
+                'profile': os.path.basename(profile_file),
+                'script': profile['script'],
+                'stage': stage['name'],
+                'status': stage['status'],
+            }
+            fields = ['wall_time_s', 'cpu_time_s', 'peak_rss_mb', 'sampled_peak_memory_mb'] + IO_FIELDS
+            for field in fields:
+                row[field] = stage.get(field)
+            details = {key: value for key, value in stage.items() if key not in fields + STAGE_KEYS}
+            row['details'] = json.dumps(details) if details else None
+            top_tasks = stage.get('dask', {}).get('top_tasks')
+            row['slowest_task'] = top_tasks[0]['name'] if top_tasks else None
+            rows.append(row)
+
+    return pd.DataFrame(rows)
@@ -0,0 +1,175 @@
+"""Utilities for restricting calculations to a region of interest"""
+
+import numpy as np
+
+
+REGIONS = {
+    'aus': [-48, -5, 105, 160],
+}
+ROI_ATTR = 'region_of_interest'
+
+
+def bounds_index(selection):
+    """Convert a boolean selection to a slice (if contiguous) or integer index."""
+
+    index = np.flatnonzero(selection)
+    assert len(index), 'No grid points in the region of interest'
+    if np.all(np.diff(index) == 1):
+        return slice(int(index[0]), int(index[-1]) + 1)
+
+    return index
+
+
+def subset_lat(ds, lat_bnds, lat_dim="lat"):
+    """Select grid points that fall within latitude bounds.
+
+    Parameters
+    ----------
+    ds : Union[xarray.DataArray, xarray.Dataset]
+        Input data
+    lat_bnds : list
+        Latitude bounds: [south bound, north bound]
+    lat_dim: str, default 'lat'
+        Name of the latitude dimension in ds
+
+    Returns
+    -------
+    Union[xarray.DataArray, xarray.Dataset]
+        Subsetted xarray.DataArray or xarray.Dataset
+    """
+
+    south_bound, north_bound = lat_bnds
+    assert -90 <= south_bound <= 90, "Valid latitude range is [-90, 90]"
+    assert -90 <= north_bound <= 90, "Valid latitude range is [-90, 90]"
+
+    lats = ds[lat_dim].values
+    selection = (lats <= north_bound) & (lats >= south_bound)
+    ds = ds.isel({lat_dim: bounds_index(selection)})
+
+    return ds
+
+
+def subset_lon(ds, lon_bnds, lon_dim="lon"):
+    """Select grid points that fall within longitude bounds.
+
+    Parameters
+    ----------
+    ds : Union[xarray.DataArray, xarray.Dataset]
+        Input data
+    lon_bnds : list
+        Longitude bounds: [west bound, east bound]
+    lon_dim: str, default 'lon'
+        Name of the longitude dimension in ds
+
+    Returns
+    -------
+    Union[xarray.DataArray, xarray.Dataset]
+        Subsetted xarray.DataArray or xarray.Dataset
+    """
+
+    west_bound, east_bound = lon_bnds
+    assert -180 <= west_bound <= 360, "Valid longitude range is [-180, 360]"
+    assert -180 <= east_bound <= 360, "Valid longitude range is [-180, 360]"
+
+    lons = ds[lon_dim].values
+
+    if east_bound > west_bound:
+        selection = (lons <= east_bound) & (lons >= west_bound)
+    else:
+        selection = (lons <= east_bound) | (lons >= west_bound)
+    ds = ds.isel({lon_dim: bounds_index(selection)})
+
+    return ds
+
+
+def fix_coords(ds):
+    """Model specific fixes to the (subsetted) horizontal coordinates.
+
+    Latitude values differ slightly between the files (and variables) of
+    some models, which stops them being combined.
+    """
+
+    model = ds.attrs.get('source_id')
+    if model == 'CanESM5':
+        ds['lat'] = np.round(ds['lat'], 2)
+    elif model == 'MPI-ESM1-2-LR':
+        lat_start = np.round(ds.lat.values[0], 2)
+        lat_end = np.round(ds.lat.values[-1], 2)
+        nlats = len(ds.lat)
+        new_lat = np.linspace(lat_start, lat_end, nlats)
+        ds['lat'] = new_lat
+
+    return ds
+
+
+def subset(ds, bbox):
+    """Subset a dataset to a bounding box.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        Input data
+    bbox : list
+        Bounding box: [south bound, north bound, west bound, east bound]
+        (None means no subsetting)
+
+    Returns
+    -------
+    xarray.Dataset
+        Subsetted dataset (with the bounding box recorded in its attributes,
+        so data already subset to the same box are left unchanged)
+    """
+
+    if bbox is None:
+        return ds
+    south_bound, north_bound, west_bound, east_bound = bbox
+    description = f'lat: {south_bound} to {north_bound}, lon: {west_bound} to {east_bound}'
+    if ds.attrs.get(ROI_ATTR) == description:
+        return ds
+    lat_attrs = ds['lat'].attrs
+    ds = subset_lat(ds, [south_bound, north_bound])
+    ds = subset_lon(ds, [west_bound, east_bound])
+    ds = fix_coords(ds)
+    ds['lat'].attrs = lat_attrs
+    ds.attrs[ROI_ATTR] = description
+
+    return ds
+
+
+def get_preprocess(bbox):
+    """Create an xarray.open_mfdataset preprocess function that subsets each file.
+
+    Parameters
+    ----------
+    bbox : list
+        Bounding box: [south bound, north bound, west bound, east bound]
+        (None means no subsetting)
+    """
+
+    if bbox is None:
+        return None
+
+    def subset_file(ds):
+        """Subset one input file."""
+        return subset(ds, bbox)
+
+    return subset_file
+
+
+def add_arguments(parser):
+    """Add the region of interest options to a command line parser."""
+
+    parser.add_argument("--bbox", type=float, nargs=4, default=None, metavar=('SOUTH', 'NORTH', 'WEST', 'EAST'),
+                        help="only calculate for grid points within this bounding box")
+    parser.add_argument("--region", type=str, choices=tuple(REGIONS.keys()), default=None,
+                        help="only calculate for grid points within this region (alternative to --bbox)")
+
+
+def get_bbox(args):
+    """Get the bounding box from the parsed command line arguments."""
+
+    assert not (args.bbox and args.region), 'Use either --bbox or --region (not both)'
+    if args.region:
+        return REGIONS[args.region]
+
+    return args.bbox
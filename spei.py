@@ -1,34 +1,207 @@
-"""Command line program for calculating the Standardised Precipitation Evaporation Index (SPEI)"""
+"""Command line program for calculating the Standardised Precipitation Evaporation Index (SPEI)
 
+The daily water balance is resampled to monthly values once,
+and the SPEI for each accumulation window (--windows) is calculated from those.
+The fitted distribution parameters for each window can be saved to (and
+read back from) a parameters file, so the SPEI for another period or
+experiment can be calculated without fitting the distribution again.
+"""
+
+import os
 import argparse
+import logging
 
 import numpy as np
 import xarray as xr
 import xclim as xc
 import dask.diagnostics
 import cmdline_provenance as cmdprov
+
+import roi
+import profiling
+import cache_utils
+import intermediates
+import evspsblpot
+import catalogue
+import output_encoding
     
 
 dask.diagnostics.ProgressBar().register()
+# force=True because importing xclim has already configured the root logger
+logging.basicConfig(level=logging.INFO, force=True)
+
+
+CAL_START = '1950-01-01'
+CAL_END = '2014-12-31'
+
+
+def calc_params(wb, window, dist, cal_start=CAL_START, cal_end=CAL_END):
+    """Fit the SPEI distribution parameters over the calibration period.
+
+    Gives the same parameters as fitting within
+    xclim.indices.standardized_precipitation_evapotranspiration_index
+    (i.e. the rolling sum is calculated before the calibration period is selected),
+    but they can be saved and passed back in via its params argument.
+    """
+
+    wb_monthly, _ = xc.indices.stats.preprocess_standardized_index(wb, freq='MS', window=window)
+    params = xc.indices.stats.standardized_index_fit_params(
+        wb_monthly.sel(time=slice(cal_start, cal_end)),
+        freq=None,
+        window=1,
+        dist=dist,
+        method='ML',
+    )
+    params.attrs['freq'] = 'MS'
+    params.attrs['window'] = window
+
+    return params
+
+
+def monthly_water_balance(wb):
+    """Resample the daily water balance to monthly means.
+
+    The SPEI for every window is calculated from the result,
+    so the daily data only has to be read once.
+    """
+
+    wb_monthly = wb.resample(time='MS').mean(keep_attrs=True)
+    wb_monthly = wb_monthly.chunk({'time': -1}).persist()
+
+    return wb_monthly
+
+
+def params_var(window):
+    """Name of the variable holding the parameters for a window in a parameters file."""
+
+    return f'params_window{window}'
+
+
+def read_params_file(params_file, dist, evspsblpot_method=None):
+    """Read the distribution parameters for each window from a parameters file.
+
+    The parameters must have been fitted for the same distribution and (if
+    known for both the file and the current run) the same evspsblpot method.
+
+    Returns
+    -------
+    dict
+        Parameters (xarray.DataArray) for each window
+    """
+
+    with xr.open_dataset(params_file) as ds:
+        ds = ds.load()
+    assert ds.attrs['dist'] == dist, f'{params_file} has parameters for the {ds.attrs["dist"]} distribution'
+    file_method = ds.attrs.get('evspsblpot_method')
+    if file_method and evspsblpot_method:
+        assert file_method == evspsblpot_method, f'{params_file} has parameters for {file_method} evspsblpot'
+    params = {}
+    for var in ds.data_vars:
+        window = int(ds[var].attrs['window'])
+        params[window] = ds[var]
+    logging.info(f'Read parameters for windows {sorted(params)} from {params_file}')
+
+    return params
+
+
+def write_params_file(params, params_file, dist, evspsblpot_method=None):
+    """Write the distribution parameters for each window to a parameters file."""
+
+    params_ds = xr.Dataset({params_var(window): params[window] for window in sorted(params)})
+    params_ds.attrs['dist'] = dist
+    if evspsblpot_method:
+        params_ds.attrs['evspsblpot_method'] = evspsblpot_method
+    params_ds.attrs['calibration_period'] = f'{CAL_START} to {CAL_END}'
+    params_ds.attrs['history'] = cmdprov.new_log()
+    cache_utils.write_atomic(params_ds.to_netcdf, params_file)
+
+
+def get_params(wb_monthly, window, dist, cal_files=None, cache_dir=None, bbox=None, evspsblpot_method=None):
+    """Get the distribution parameters for a window (from the cache if possible)."""
+
+    if cache_dir is None:
+        return calc_params(wb_monthly, window, dist).compute()
+
+    key = intermediates.product_key(
+        'spei-params', cal_files, window, dist, CAL_START, CAL_END, bbox, evspsblpot_method
+    )
+    params_ds = intermediates.read(cache_dir, 'spei-params', key)
+    if params_ds is None:
+        params_ds = calc_params(wb_monthly, window, dist).compute().to_dataset(name='params')
+        intermediates.write(params_ds, cache_dir, 'spei-params', key)
+
+    return params_ds['params']
+
+
+def calc_spei(wb_monthly, windows, params):
+    """Calculate the SPEI for each window from the monthly water balance.
+
+    The SPEI variable is named SPEI if there is only one window,
+    otherwise SPEI{window} (e.g. SPEI3, SPEI12).
+    """
+
+    spei_ds = xr.Dataset()
+    for window in windows:
+        spei_da = xc.indices.standardized_precipitation_evapotranspiration_index(wb_monthly, params=params[window])
+        spei_da.attrs['window'] = window
+        var = 'SPEI' if len(windows) == 1 else f'SPEI{window}'
+        spei_ds[var] = spei_da
+
+    return spei_ds
 
 
 def main(args):
     """Run the program."""
 
-    pr_ds = xr.open_mfdataset(args.pr_files, attrs_file=args.pr_files[-1])
-    evspsblpot_ds = xr.open_mfdataset(args.evspsblpot_files, attrs_file=args.evspsblpot_files[-1])
-    
-    wb = pr_ds['pr'] - evspsblpot_ds['evspsblpot']
-    wb.attrs['units'] = pr_ds['pr'].attrs['units']
+    profile = profiling.Profile(args.profile)
+    windows = [int(window) for window in args.windows.split(',')]
+    bbox = roi.get_bbox(args)
+    preprocess = roi.get_preprocess(bbox)
+    with profile.stage('open'):
+        pr_ds = catalogue.open_mfdataset(args.pr_files, attrs_file=args.pr_files[-1], preprocess=preprocess)
+        if args.evspsblpot_files:
+            evspsblpot_ds = evspsblpot.open_evspsblpot(args.evspsblpot_files, bbox=bbox)
+            evspsblpot_inputs = args.evspsblpot_files
+            evspsblpot_method = evspsblpot_ds['evspsblpot'].attrs.get('method')
+        else:
+            evspsblpot_method = args.evspsblpot_method
+            input_files = {
+                var: getattr(args, f'{var}_files') for var in evspsblpot.INPUT_VARS[evspsblpot_method]
+            }
+            evspsblpot_ds = evspsblpot.calc_evspsblpot(
+                evspsblpot.open_inputs(input_files, bbox=bbox), evspsblpot_method
+            )
+            evspsblpot_inputs = [infile for infiles in input_files.values() for infile in infiles]
+
+    with profile.stage('water_balance'):
+        wb = pr_ds['pr'] - evspsblpot_ds['evspsblpot']
+        wb.attrs['units'] = pr_ds['pr'].attrs['units']
+        wb_monthly = monthly_water_balance(wb)
 
-    spei_da = xc.indices.standardized_precipitation_evapotranspiration_index(
-        wb, freq='MS', window=12, cal_start='1950-01-01', cal_end='2014-12-31', dist=args.dist,
-    )   
+    with profile.stage('fit'):
+        if args.params_file and os.path.isfile(args.params_file):
+            params = read_params_file(args.params_file, args.dist, evspsblpot_method)
+        else:
+            params = {}
+        new_windows = [window for window in windows if window not in params]
+        if new_windows:
+            cal_files = None
+            if args.cache_dir:
+                cal_files = intermediates.files_before(args.pr_files, CAL_END)
+                cal_files += intermediates.files_before(evspsblpot_inputs, CAL_END)
+            for window in new_windows:
+                params[window] = get_params(
+                    wb_monthly, window, args.dist, cal_files, args.cache_dir, bbox, evspsblpot_method
+                )
+            if args.params_file:
+                write_params_file(params, args.params_file, args.dist, evspsblpot_method)
 
-    spei_ds = spei_da.to_dataset(name='SPEI')
-    spei_ds.attrs = pr_ds.attrs
-    spei_ds.attrs['history'] = cmdprov.new_log()
-    spei_ds.to_netcdf(args.outfile)
+    with profile.stage('index'):
+        spei_ds = calc_spei(wb_monthly, windows, params)
+        spei_ds.attrs = pr_ds.attrs
+        spei_ds.attrs['history'] = cmdprov.new_log()
+    with profile.stage('write'):
+        output_encoding.write(spei_ds, args.outfile)
 
 
 if __name__ == '__main__':
@@ -36,10 +209,31 @@ if __name__ == '__main__':
         description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
-    parser.add_argument("outfile", type=str, help="output file name")
+    parser.add_argument("outfile", type=str, help="output file name (.nc or .zarr)")
     parser.add_argument("--pr_files", type=str, nargs='*', help="input daily precipitation files")
-    parser.add_argument("--evspsblpot_files", type=str, nargs='*', help="input daily potential evapotranspiration files")
+    parser.add_argument("--evspsblpot_files", type=str, nargs='*',
+                        help="input daily potential evapotranspiration files (or Zarr collection)")
+    parser.add_argument("--tasmin_files", type=str, nargs='*',
+                        help="input daily minimum temperature files (to calculate evspsblpot in memory instead of using --evspsblpot_files)")
+    parser.add_argument("--tasmax_files", type=str, nargs='*',
+                        help="input daily maximum temperature files (to calculate evspsblpot in memory instead of using --evspsblpot_files)")
+    parser.add_argument("--hurs_files", type=str, nargs='*', help="input daily relative humidity files (allen98 only)")
+    parser.add_argument("--sfcWind_files", type=str, nargs='*', help="input daily surface wind speed files (allen98 only)")
+    parser.add_argument("--rsds_files", type=str, nargs='*', help="input daily surface downwelling shortwave files (allen98 only)")
+    parser.add_argument("--rsus_files", type=str, nargs='*', help="input daily surface upwelling shortwave files (allen98 only)")
+    parser.add_argument("--rlds_files", type=str, nargs='*', help="input daily surface downwelling longwave files (allen98 only)")
+    parser.add_argument("--rlus_files", type=str, nargs='*', help="input daily surface upwelling longwave files (allen98 only)")
+    parser.add_argument("--evspsblpot_method", type=str, choices=('hargreaves85', 'allen98'), default='hargreaves85',
+                        help="method for calculating evspsblpot in memory (see evspsblpot.py) [default=hargreaves85]")
     parser.add_argument("--dist", type=str, choices=('gamma', 'fisk'), default='fisk', help="distribution for SPEI calculation")
+    parser.add_argument("--windows", type=str, default='12',
+                        help="comma separated accumulation windows in months (e.g. 1,3,6,12,24); if more than one, the output variables are named SPEI{window}")
+    parser.add_argument("--params_file", type=str, default=None,
+                        help="read the fitted distribution parameters from this file (and write any newly fitted windows to it)")
+    roi.add_arguments(parser)
+    profiling.add_arguments(parser)
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="share the calibration parameters between runs via this cache directory")
 
     args = parser.parse_args()
     main(args)
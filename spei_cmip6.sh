@@ -28,39 +28,28 @@ else
     indir=/g/data/oi10/replicas
 fi
 spei_dir=/g/data/xv83/dbi599/treasury/SPEI/${model}/${ssp}
+cache_dir=/g/data/xv83/dbi599/treasury/cache
 
-# Potential evapotranspiration (evspsblpot)
+# SPEI (with potential evapotranspiration calculated in memory by the hargreaves85 method)
 
 tasmin_hist_files=(`ls ${indir}/CMIP6/CMIP/*/${model}/historical/${run}/day/tasmin/${grid}/${version}/*.nc`)
 tasmin_ssp_files=(`ls ${indir}/CMIP6/ScenarioMIP/*/${model}/${ssp}/${run}/day/tasmin/${grid}/${version}/*.nc`)
 tasmin_files=( "${tasmin_hist_files[@]}" "${tasmin_ssp_files[@]}" )
-method=hargreaves85
-evspsblpot_files=()
+tasmax_files=()
 for tasmin_path in "${tasmin_files[@]}"; do
-    tasmax_path=`echo ${tasmin_path} | sed s:tasmin:tasmax:g`
-    evspsblpot_file=`basename ${tasmin_path} | sed s:tasmin:evspsblpot-${method}:g`
-    evspsblpot_path=${spei_dir}/${evspsblpot_file}
-    evspsblpot_files+=(${evspsblpot_path})
-    command="${python} /home/599/dbi599/treasury/evspsblpot.py ${evspsblpot_path} ${method} --tasmin_file ${tasmin_path} --tasmax_file ${tasmax_path}"
-    if [[ "${flags}" == "-e" ]] ; then
-        mkdir -p ${spei_dir}
-        echo ${command}
-        ${command}
-    else
-        echo ${command}
-    fi 
+    tasmax_files+=(`echo ${tasmin_path} | sed s:tasmin:tasmax:g`)
 done
 
-# SPEI
-
 pr_hist_files=(`ls ${indir}/CMIP6/CMIP/*/${model}/historical/${run}/day/pr/${grid}/${version}/*.nc`)
 pr_ssp_files=(`ls ${indir}/CMIP6/ScenarioMIP/*/${model}/${ssp}/${run}/day/pr/${grid}/${version}/*.nc`)
 spei_path=${spei_dir}/spei_mon_${model}_${ssp}_${run}_${grid}_1850-2100.nc
+params_path=/g/data/xv83/dbi599/treasury/SPEI/${model}/spei-params_mon_${model}_${run}_${grid}_fisk_1950-2014.nc
 csv_path=${spei_dir}/spei_mon_${model}_${ssp}_${run}_aus-states_1850-2100.csv
 
-spei_command="${python} /home/599/dbi599/treasury/spei.py ${spei_path} --dist fisk --pr_files ${pr_hist_files[@]} ${pr_ssp_files[@]} --evspsblpot_files ${evspsblpot_files[@]}"
-csv_command="${python} /home/599/dbi599/treasury/nc_to_csv.py ${spei_path} SPEI ${csv_path}"
+spei_command="${python} /home/599/dbi599/treasury/spei.py ${spei_path} --dist fisk --pr_files ${pr_hist_files[@]} ${pr_ssp_files[@]} --tasmin_files ${tasmin_files[@]} --tasmax_files ${tasmax_files[@]} --params_file ${params_path} --region aus --cache_dir ${cache_dir}"
+csv_command="${python} /home/599/dbi599/treasury/nc_to_csv.py ${spei_path} SPEI ${csv_path} --cache_dir ${cache_dir}"
 if [[ "${flags}" == "-e" ]] ; then
+    mkdir -p ${spei_dir}
     echo ${spei_command}
     ${spei_command}
     echo ${csv_command}
@@ -71,7 +60,6 @@ else
 fi
 
 if [[ "${flags}" == "-c" ]] ; then
-    rm ${evspsblpot_files[@]}
     rm ${spei_path}
 fi
 
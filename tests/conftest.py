@@ -0,0 +1,53 @@
+"""Shared test fixtures
+
+The programs are modules in the top directory of the repository,
+so that directory is added to the module search path.
+"""
+
+import os
+import sys
+
+import dask.callbacks
+import pytest
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import pr_climatology
+
+
+@pytest.fixture(autouse=True)
+def no_progress_bar():
+    """Remove the dask progress bar that the programs register on import.
+
+    It slows down the many small computes in the tests.
+    """
+
+    dask.callbacks.Callback.active.clear()
+
+
+@pytest.fixture(scope='session')
+def synthetic_files(tmp_path_factory):
+    """Small synthetic CMIP6-like daily input files (3 x 4 grid, 2006-2016).
+
+    Returns
+    -------
+    dict
+        Input files (in time order) for each variable
+    """
+
+    data_dir = tmp_path_factory.mktemp('data')
+
+    return benchmark.make_data(str(data_dir), 3, 4, 2006, 2016, 'ssp370', years_per_file=4)
+
+
+@pytest.fixture(scope='session')
+def pr_annual_clim_file(synthetic_files, tmp_path_factory):
+    """Annual precipitation climatology file for the synthetic data."""
+
+    outfile = str(tmp_path_factory.mktemp('clim') / 'pr-annual-clim.nc')
+    with xr.open_mfdataset(synthetic_files['pr']) as ds:
+        pr_climatology.calc_climatology(ds, '2006-01-01', '2016-12-31').to_netcdf(outfile)
+
+    return outfile
@@ -0,0 +1,46 @@
+"""Tests for cache_utils.py"""
+
+import os
+
+import cache_utils
+
+
+def write_file(path, nbytes=10):
+    """Write a file of a given size."""
+
+    with open(path, 'wb') as outfile:
+        outfile.write(b'x' * nbytes)
+
+
+def test_read_hit_leaves_linked_output_unchanged(tmp_path):
+    """Marking a cache file as used doesn't change the modification time of an output file linked to it."""
+
+    outfile = str(tmp_path / 'output.nc')
+    write_file(outfile)
+    os.utime(outfile, (1000, 1000))
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    path = cache_utils.cache_path(str(cache_dir), 'kbdi', 'abc')
+    os.link(outfile, path)
+
+    assert cache_utils.read_hit(path)
+    assert os.stat(outfile).st_mtime == 1000
+    assert not cache_utils.read_hit(cache_utils.cache_path(str(cache_dir), 'kbdi', 'def'))
+
+
+def test_evict_least_recently_used(tmp_path):
+    """The least recently used files (by last use, not last write) are removed first."""
+
+    paths = [cache_utils.cache_path(str(tmp_path), 'product', key) for key in ['a', 'b', 'c']]
+    for path in paths:
+        write_file(path, nbytes=400)
+        os.utime(path, (1000, 1000))
+    cache_utils.read_hit(paths[0])
+    cache_utils.read_hit(paths[2])
+    os.utime(cache_utils.used_path(paths[2]), (2000, 2000))
+    write_file(cache_utils.used_path(str(tmp_path / 'removed.nc')), nbytes=0)
+
+    cache_utils.evict(str(tmp_path), max_gb=5e-7)
+
+    remaining = [paths[0], cache_utils.used_path(paths[0])]
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(path) for path in remaining)
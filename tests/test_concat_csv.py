@@ -0,0 +1,39 @@
+"""Tests for concat_csv.py"""
+
+import pandas as pd
+
+import concat_csv
+
+
+def write_run_csv(outdir, model, ssp, run, scale):
+    """Write a CSV file for one run (in the format written by nc_to_csv.py)."""
+
+    df = pd.DataFrame({
+        'year': [2014, 2015],
+        'model': model,
+        'run': run,
+        'experiment': ['historical', ssp],
+        'NSW': [1.0 * scale, 2.0 * scale],
+    })
+    outfile = outdir / f'FFDIx_yr_{model}_{ssp}_{run}_aus-states_2014-2015.csv'
+    df.to_csv(outfile, index=False)
+
+    return str(outfile)
+
+
+def test_dataset_to_csv_keeps_ssp(tmp_path):
+    """The CSV file written from the Parquet dataset has an ssp column (but no metric column)."""
+
+    parquet_dir = str(tmp_path / 'treasury.parquet')
+    for ssp, scale in [('ssp370', 1), ('ssp126', 10)]:
+        concat_csv.append_to_dataset(write_run_csv(tmp_path, 'ACCESS-CM2', ssp, 'r1i1p1f1', scale), parquet_dir)
+    outfile = str(tmp_path / 'FFDIx.csv')
+    concat_csv.dataset_to_csv(parquet_dir, outfile, 'FFDIx')
+
+    df = pd.read_csv(outfile)
+    assert list(df.columns) == ['year', 'model', 'run', 'ssp', 'experiment', 'NSW']
+    assert df['ssp'].tolist() == ['ssp126', 'ssp370', 'ssp126', 'ssp370']
+    assert df['NSW'].tolist() == [10.0, 1.0, 20.0, 2.0]
+
+    concat_csv.dataset_to_csv(parquet_dir, outfile, 'FFDIx', ssps=['ssp370'])
+    assert pd.read_csv(outfile)['ssp'].tolist() == ['ssp370', 'ssp370']
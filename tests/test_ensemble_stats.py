@@ -0,0 +1,47 @@
+"""Tests for ensemble_stats.py"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('xesmf')
+import ensemble_stats
+
+
+QUANTILES = [0.0, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 1.0]
+
+
+def test_equal_weights_match_numpy():
+    """With equal weights the weighted quantiles are numpy's (hazen) percentiles."""
+
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(7, 20))
+    result = ensemble_stats.weighted_quantiles(values, np.full(7, 0.3), QUANTILES)
+    expected = np.percentile(values, np.array(QUANTILES) * 100, axis=0, method='hazen')
+
+    np.testing.assert_allclose(result, expected)
+
+
+def test_missing_values_skipped():
+    """Missing values are skipped (as by nanpercentile)."""
+
+    rng = np.random.default_rng(1)
+    values = rng.normal(size=(9, 5))
+    values[[0, 3], 2] = np.nan
+    values[:, 4] = np.nan
+    result = ensemble_stats.weighted_quantiles(values, np.ones(9), QUANTILES)
+    with np.errstate(invalid='ignore'), pytest.warns(RuntimeWarning):
+        expected = np.nanpercentile(values, np.array(QUANTILES) * 100, axis=0, method='hazen')
+
+    np.testing.assert_allclose(result, expected)
+
+
+def test_unequal_weights_symmetric():
+    """Reversing the values mirrors the quantiles, however unequal the weights."""
+
+    rng = np.random.default_rng(2)
+    values = rng.normal(size=(12, 8))
+    weights = rng.uniform(0.01, 1.0, size=12)
+    result = ensemble_stats.weighted_quantiles(values, weights, QUANTILES)
+    mirrored = ensemble_stats.weighted_quantiles(-values, weights, [1 - q for q in QUANTILES])
+
+    np.testing.assert_allclose(result, -mirrored)
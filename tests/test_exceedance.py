@@ -0,0 +1,117 @@
+"""Tests for exceedance.py"""
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+import exceedance
+
+
+BASE_PERIOD = ('2002-01-01', '2006-12-31')
+
+
+@pytest.fixture
+def daily_da():
+    """Daily FFDI-like data on a 3 x 4 grid for 2000-2009, with some missing values."""
+
+    rng = np.random.default_rng(0)
+    time = pd.date_range('2000-01-01', '2009-12-31', freq='D')
+    values = rng.gamma(2.0, 8.0, size=(len(time), 3, 4)).astype(np.float32)
+    values[rng.random(values.shape) < 0.01] = np.nan
+
+    return xr.DataArray(
+        values,
+        dims=('time', 'lat', 'lon'),
+        coords={'time': time, 'lat': [-30.0, -29.0, -28.0], 'lon': [140.0, 141.0, 142.0, 143.0]},
+    )
+
+
+def xarray_metrics(da, q=0.99):
+    """Calculate the annual maximum and exceedances with xarray (reading the data twice)."""
+
+    annual_max = da.resample({'time': 'YE'}).max('time')
+    threshold = da.sel(time=slice(*BASE_PERIOD)).quantile(q, dim='time')
+    exceedances = (da > threshold).resample({'time': 'YE'}).sum('time')
+
+    return annual_max, exceedances
+
+
+def test_histogram_quantile_error_bounded():
+    """The sketch quantile is within a bin width of the exact quantile (or of the gap it falls in)."""
+
+    rng = np.random.default_rng(1)
+    values = rng.gamma(2.0, 8.0, size=(5000, 20))
+    nbins, max_value, q = 512, 200.0, 0.99
+    counts = np.zeros((nbins, values.shape[1]), dtype=np.int64)
+    exceedance.update_histogram(counts, values, nbins, max_value)
+
+    approx = exceedance.histogram_quantile(counts, q, max_value)
+    exact = np.quantile(values, q, axis=0)
+    ordered = np.sort(values, axis=0)
+    lower = int(np.floor(q * (len(values) - 1)))
+    gap = ordered[lower + 1] - ordered[lower]
+    assert np.all(np.abs(approx - exact) <= max_value / nbins + gap)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_largest_values_quantile(dtype):
+    """The quantile from the largest values kept equals the quantile of all the values."""
+
+    rng = np.random.default_rng(2)
+    values = rng.gamma(2.0, 8.0, size=(10, 365, 6)).astype(dtype)
+    values[rng.random(values.shape) < 0.05] = np.nan
+    values[:, :, 0] = np.round(values[:, :, 0])
+    largest = exceedance.LargestValues(6, size=exceedance.tail_size(10 * 365, 0.99))
+    for year, year_values in enumerate(values):
+        largest.add(year_values, 2000 + year)
+
+    expected = exceedance.exact_quantile(values.reshape(-1, 6), 0.99)
+    np.testing.assert_array_equal(largest.quantile(0.99), expected)
+
+
+@pytest.mark.parametrize('chunk_years', [1, 3, 10])
+def test_annual_metrics_exact_matches_xarray(daily_da, chunk_years):
+    """The exact method gives the same metrics as the xarray quantile."""
+
+    annual_max, exceedances = exceedance.annual_metrics(
+        daily_da, base_period=BASE_PERIOD, method='exact', chunk_years=chunk_years
+    )
+    expected_max, expected_exceedances = xarray_metrics(daily_da)
+
+    np.testing.assert_array_equal(annual_max['time'].values, expected_max['time'].values)
+    np.testing.assert_array_equal(annual_max.values, expected_max.values)
+    np.testing.assert_array_equal(exceedances.values, expected_exceedances.values)
+
+
+def test_annual_metrics_sketch(daily_da):
+    """The sketch method counts about the same exceedances as the xarray quantile."""
+
+    annual_max, exceedances = exceedance.annual_metrics(daily_da, base_period=BASE_PERIOD, method='sketch')
+    expected_max, expected_exceedances = xarray_metrics(daily_da)
+
+    np.testing.assert_array_equal(annual_max.values, expected_max.values)
+    assert np.abs(exceedances.values - expected_exceedances.values).max() <= 2
+
+
+@pytest.mark.parametrize('method', ['exact', 'sketch'])
+def test_baseline_years_added_once(daily_da, method):
+    """Only the years before the baseline have to be added again once the threshold is known."""
+
+    ncell = 12
+    dates = daily_da['time'].dt.strftime('%Y-%m-%d').values
+    years = daily_da['time'].dt.year.values
+    counter = exceedance.AnnualExceedances(
+        ncell,
+        base_period=BASE_PERIOD,
+        method=method,
+        base_size=int(((dates >= BASE_PERIOD[0]) & (dates <= BASE_PERIOD[1])).sum()),
+    )
+    results = []
+    for year in np.unique(years):
+        year_index = years == year
+        results += counter.add(year, dates[year_index], daily_da.values[year_index].reshape(-1, ncell))
+    results += counter.finish()
+
+    assert counter.pop_recount_years() == [2000, 2001]
+    assert [result[0] for result in results] == list(range(2002, 2010))
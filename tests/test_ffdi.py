@@ -0,0 +1,146 @@
+"""Tests for ffdi.py"""
+
+import argparse
+import os
+
+import numpy as np
+import pytest
+import xarray as xr
+import xclim as xc
+
+import benchmark
+import ffdi
+import kbdi
+
+
+def program_args(outdir, **options):
+    """Define the command line arguments for ffdi.main (with the defaults from the command line parser)."""
+
+    args = {
+        'FFDIx_outfile': str(outdir / 'FFDIx.nc'),
+        'FFDIgt99p_outfile': str(outdir / 'FFDIgt99p.nc'),
+        'pr_zarr': None,
+        'tasmax_zarr': None,
+        'hursmin_zarr': None,
+        'sfcWindmax_zarr': None,
+        'kbdi_files': None,
+        'pr_files': None,
+        'tasmax_files': None,
+        'hursmin_files': None,
+        'sfcWindmax_files': None,
+        'pr_annual_clim_file': None,
+        'tile_size': None,
+        'max_mem': '8GB',
+        'workers': None,
+        'scheduler': 'threads',
+        'threshold_method': None,
+        'sketch_bins': 512,
+        'sketch_max': 200.0,
+        'partition_dir': None,
+        'bbox': None,
+        'region': None,
+        'profile': None,
+    }
+    args.update(options)
+
+    return argparse.Namespace(**args)
+
+
+def fused_args(outdir, synthetic_files, pr_annual_clim_file, **options):
+    """Define the command line arguments for fused mode."""
+
+    input_files = {f'{var}_files': synthetic_files[var] for var in ffdi.ZARR_VARS}
+
+    return program_args(outdir, pr_annual_clim_file=pr_annual_clim_file, **input_files, **options)
+
+
+@pytest.fixture(scope='module')
+def whole_series_ffdi(synthetic_files, pr_annual_clim_file):
+    """Calculate the daily FFDI from the whole time series at once, like the original unfused program.
+
+    (i.e. kbdi.py followed by ffdi.py)
+    """
+
+    input_ds = {var: xr.open_mfdataset(synthetic_files[var]).load() for var in ffdi.ZARR_VARS}
+    pr_annual_clim_da = xr.open_dataset(pr_annual_clim_file)['pr']
+    pr_da = xc.core.units.convert_units_to(input_ds['pr']['pr'], 'mm/day')
+    kbdi_da, _ = kbdi.calc_kbdi(pr_da, input_ds['tasmax']['tasmax'], pr_annual_clim_da)
+    ffdi_da = ffdi.calc_ffdi(
+        input_ds['pr']['pr'],
+        input_ds['tasmax']['tasmax'],
+        input_ds['hursmin']['hursmin'],
+        input_ds['sfcWindmax']['sfcWindmax'],
+        kbdi_da,
+    )
+
+    return ffdi.fix_metadata(ffdi_da.to_dataset(name='FFDI'), input_ds['tasmax']).compute()
+
+
+@pytest.mark.parametrize('base_period', [
+    ('2009-01-01', '2013-12-31'),
+    ('2009-07-01', '2016-12-31'),
+])
+@pytest.mark.parametrize('tile_size', [None, [2, 3]])
+def test_fused_matches_whole_series(
+    tmp_path, monkeypatch, synthetic_files, pr_annual_clim_file, whole_series_ffdi, base_period, tile_size
+):
+    """Fused mode (one year and tile at a time) gives the same metrics as the whole series at once."""
+
+    monkeypatch.setattr(ffdi, 'BASE_START', base_period[0])
+    monkeypatch.setattr(ffdi, 'BASE_END', base_period[1])
+    FFDIx_ds, FFDIgt99p_ds = ffdi.calc_metrics(whole_series_ffdi, method='xarray')
+    args = fused_args(tmp_path, synthetic_files, pr_annual_clim_file, tile_size=tile_size)
+    ffdi.main(args)
+
+    with xr.open_dataset(args.FFDIx_outfile) as ds:
+        np.testing.assert_array_equal(ds['time'].values, FFDIx_ds['time'].values)
+        expected = FFDIx_ds['FFDIx'].transpose(*ds['FFDIx'].dims).astype(np.float32)
+        np.testing.assert_array_equal(ds['FFDIx'].values, expected.values)
+    with xr.open_dataset(args.FFDIgt99p_outfile) as ds:
+        expected = FFDIgt99p_ds['FFDIgt99p'].transpose(*ds['FFDIgt99p'].dims)
+        np.testing.assert_array_equal(ds['FFDIgt99p'].values, expected.values)
+        assert ds['FFDIgt99p'].values.sum() > 0
+
+
+def test_partitions_recalculate_changed_years(tmp_path, monkeypatch, pr_annual_clim_file):
+    """Changing the inputs for one year only recalculates that year and the years after it."""
+
+    monkeypatch.setattr(ffdi, 'BASE_START', '2007-01-01')
+    monkeypatch.setattr(ffdi, 'BASE_END', '2010-12-31')
+    files = benchmark.make_data(str(tmp_path / 'data'), 3, 4, 2006, 2013, 'ssp370', years_per_file=1)
+    read_years = []
+    read_year = ffdi.read_year
+
+    def record_read_year(input_ds, year):
+        read_years.append(year)
+        return read_year(input_ds, year)
+
+    monkeypatch.setattr(ffdi, 'read_year', record_read_year)
+    partition_args = fused_args(
+        tmp_path / 'partitioned', files, pr_annual_clim_file, partition_dir=str(tmp_path / 'partitions')
+    )
+    (tmp_path / 'partitioned').mkdir()
+    ffdi.main(partition_args)
+    assert sorted(set(read_years)) == list(range(2006, 2014))
+
+    changed_file = files['tasmax'][5]
+    with xr.open_dataset(changed_file) as ds:
+        changed_ds = ds.load()
+    assert changed_ds['time'].dt.year.values[0] == 2011
+    changed_ds['tasmax'] = changed_ds['tasmax'] + 2.0
+    changed_ds.to_netcdf(changed_file)
+    # Make sure the fingerprint changes even if the file is rewritten within a second
+    mtime = os.stat(changed_file).st_mtime + 10
+    os.utime(changed_file, (mtime, mtime))
+
+    read_years.clear()
+    ffdi.main(partition_args)
+    assert read_years == [2011, 2012, 2013]
+
+    full_args = fused_args(tmp_path / 'full', files, pr_annual_clim_file)
+    (tmp_path / 'full').mkdir()
+    ffdi.main(full_args)
+    for var in ['FFDIx', 'FFDIgt99p']:
+        with xr.open_dataset(getattr(partition_args, f'{var}_outfile')) as ds, \
+                xr.open_dataset(getattr(full_args, f'{var}_outfile')) as expected_ds:
+            xr.testing.assert_identical(ds[var], expected_ds[var])
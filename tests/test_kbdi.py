@@ -0,0 +1,78 @@
+"""Tests for kbdi.py"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+import numpy as np
+import xarray as xr
+import xclim as xc
+
+import kbdi
+
+
+def program_args(pr_annual_clim_file, pr_files, tasmax_files, outfiles, **options):
+    """Define the command line arguments for kbdi.main (with the defaults from the command line parser)."""
+
+    args = {
+        'pr_annual_clim_file': pr_annual_clim_file,
+        'pr_files': pr_files,
+        'tasmax_files': tasmax_files,
+        'outfiles': outfiles,
+        'time_chunk': 3650,
+        'restart_file': None,
+        'checkpoint_file': None,
+        'bbox': None,
+        'region': None,
+        'profile': None,
+        'cache_dir': None,
+    }
+    args.update(options)
+
+    return argparse.Namespace(**args)
+
+
+def test_chunked_restart_matches_xclim(tmp_path, synthetic_files, pr_annual_clim_file):
+    """KBDI calculated in time chunks and restarted part way through equals a single xclim calculation."""
+
+    pr_files = synthetic_files['pr']
+    tasmax_files = synthetic_files['tasmax']
+    outfiles = [str(tmp_path / f'KBDI_{index}.nc') for index in range(len(pr_files))]
+    checkpoint_file = str(tmp_path / 'state.nc')
+    kbdi.main(program_args(
+        pr_annual_clim_file, pr_files[:1], tasmax_files[:1], outfiles[:1],
+        time_chunk=100, checkpoint_file=checkpoint_file,
+    ))
+    kbdi.main(program_args(
+        pr_annual_clim_file, pr_files, tasmax_files, outfiles,
+        time_chunk=100, restart_file=checkpoint_file,
+    ))
+
+    with xr.open_mfdataset(pr_files).load() as pr_ds, xr.open_mfdataset(tasmax_files).load() as tasmax_ds:
+        expected = xc.indices.keetch_byram_drought_index(
+            xc.core.units.convert_units_to(pr_ds['pr'], 'mm/day'),
+            xc.core.units.convert_units_to(tasmax_ds['tasmax'], 'degC'),
+            xr.open_dataset(pr_annual_clim_file)['pr'],
+        )
+    with xr.open_mfdataset(outfiles) as ds:
+        result = ds['KBDI'].transpose(*expected.dims).compute()
+
+    np.testing.assert_array_equal(result['time'].values, expected['time'].values)
+    # The KBDI files are written as float32
+    np.testing.assert_allclose(result.values, expected.values.astype(np.float32), rtol=1e-6, atol=1e-4)
+
+
+def test_deprecated_arguments(tmp_path, synthetic_files, pr_annual_clim_file):
+    """The original pr_file tasmax_file pr_annual_clim_file outfile form still works."""
+
+    pr_file = synthetic_files['pr'][0]
+    tasmax_file = synthetic_files['tasmax'][0]
+    outfile = str(tmp_path / 'KBDI_old.nc')
+    script = os.path.join(os.path.dirname(kbdi.__file__), 'kbdi.py')
+    subprocess.run([sys.executable, script, pr_file, tasmax_file, pr_annual_clim_file, outfile], check=True)
+    expected_file = str(tmp_path / 'KBDI_new.nc')
+    kbdi.main(program_args(pr_annual_clim_file, [pr_file], [tasmax_file], [expected_file]))
+
+    with xr.open_dataset(outfile) as ds, xr.open_dataset(expected_file) as expected_ds:
+        xr.testing.assert_equal(ds['KBDI'], expected_ds['KBDI'])
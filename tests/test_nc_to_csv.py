@@ -0,0 +1,68 @@
+"""Tests for nc_to_csv.py"""
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import geopandas as gp
+import shapely.geometry
+
+pytest.importorskip('xesmf')
+import nc_to_csv
+
+
+@pytest.fixture
+def region_spec(tmp_path):
+    """Regions covering the west and east of the test grid, and one off the grid."""
+
+    regions_gp = gp.GeoDataFrame(
+        {
+            'name': ['West', 'East', 'Elsewhere'],
+            'abbrev': ['W', 'E', 'X'],
+        },
+        geometry=[
+            shapely.geometry.box(139.5, -40.5, 144.5, -29.5),
+            shapely.geometry.box(144.5, -40.5, 150.5, -29.5),
+            shapely.geometry.box(0.0, 0.0, 10.0, 10.0),
+        ],
+        crs='EPSG:4326',
+    )
+    shapefile = str(tmp_path / 'regions.shp')
+    regions_gp.to_file(shapefile)
+
+    return {'file': shapefile, 'names': 'name', 'abbrevs': 'abbrev'}
+
+
+@pytest.fixture
+def annual_ds():
+    """Annual data on a 1 degree grid with some missing values."""
+
+    rng = np.random.default_rng(0)
+    lats = np.arange(-40.0, -29.0)
+    lons = np.arange(140.0, 151.0)
+    values = rng.random((3, len(lats), len(lons))) * 100
+    values[0, 0, :4] = np.nan
+    time = pd.date_range('2014-01-01', periods=3, freq='YS')
+
+    return xr.Dataset(
+        {'FFDIx': (('time', 'lat', 'lon'), values)},
+        coords={'time': time, 'lat': lats, 'lon': lons},
+    )
+
+
+@pytest.mark.parametrize('arid_mask', [False, True])
+def test_sparse_matches_dense(monkeypatch, annual_ds, region_spec, arid_mask):
+    """The sparse matrix gives the same regional means as the dense weights (including all-arid regions)."""
+
+    def east_arid(ds_grid, cache_dir=None):
+        return (ds_grid['lon'] > 144.5) & (ds_grid['lat'] < 100)
+
+    monkeypatch.setattr(nc_to_csv, 'get_arid_mask', east_arid)
+    region_weights = nc_to_csv.calc_region_weights(annual_ds, arid_mask=arid_mask, region_spec=region_spec)
+    dense = annual_ds['FFDIx'].weighted(region_weights).mean(dim=('lat', 'lon'))
+    matrix, abbrevs = nc_to_csv.calc_region_matrix(annual_ds, arid_mask=arid_mask, region_spec=region_spec, batch_size=2)
+    sparse = nc_to_csv.sparse_spatial_mean(annual_ds['FFDIx'], matrix, abbrevs)
+
+    assert list(abbrevs) == list(dense['abbrevs'].values) == ['W', 'E']
+    np.testing.assert_allclose(sparse.values, dense.transpose('time', 'region').values)
+    assert np.isnan(sparse.values[:, 1]).all() == arid_mask
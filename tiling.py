@@ -0,0 +1,188 @@
+"""Utilities for processing gridded data one spatial tile at a time"""
+
+import math
+
+import numpy as np
+
+
+def spatial_tiles(ds, tile_size, lat_dim='lat', lon_dim='lon'):
+    """Generate index selections that cover the horizontal grid in tiles.
+
+    Parameters
+    ----------
+    ds : Union[xarray.DataArray, xarray.Dataset]
+        Input data
+    tile_size : list
+        Number of grid points in each tile: [lat size, lon size]
+    lat_dim: str, default 'lat'
+        Name of the latitude dimension in ds
+    lon_dim: str, default 'lon'
+        Name of the longitude dimension in ds
+
+    Yields
+    ------
+    dict
+        Index selection (for use with isel) for each tile
+    """
+
+    nlat = len(ds[lat_dim])
+    nlon = len(ds[lon_dim])
+    lat_size, lon_size = tile_size
+    assert lat_size > 0 and lon_size > 0, "Tile size must be positive"
+
+    for lat_start in range(0, nlat, lat_size):
+        for lon_start in range(0, nlon, lon_size):
+            yield {
+                lat_dim: slice(lat_start, min(lat_start + lat_size, nlat)),
+                lon_dim: slice(lon_start, min(lon_start + lon_size, nlon)),
+            }
+
+
+def tile_size_for_memory(ntime, nlat, nlon, max_bytes, bytes_per_value=8, copies=1):
+    """Choose a tile size so the data for each tile fits in a memory budget.
+
+    Parameters
+    ----------
+    ntime : int
+        Number of time steps loaded for each tile
+    nlat : int
+        Number of latitudes in the full grid
+    nlon : int
+        Number of longitudes in the full grid
+    max_bytes : float
+        Memory budget for each tile (in bytes)
+    bytes_per_value : int, default 8
+        Size of each data value (in bytes)
+    copies : float, default 1
+        Number of copies of the tile data held in memory at once
+        (i.e. the input plus any intermediate arrays)
+
+    Returns
+    -------
+    list
+        Number of grid points in each tile: [lat size, lon size]
+    """
+
+    ncells = max(1, int(max_bytes // (ntime * bytes_per_value * copies)))
+    lat_size = min(max(1, int(math.sqrt(ncells))), nlat)
+    lon_size = min(max(1, ncells // lat_size), nlon)
+    lat_size = min(max(1, ncells // lon_size), nlat)
+
+    return [lat_size, lon_size]
+
+
+def storage_chunks(da):
+    """Get the size of the storage chunks (in the file or Zarr collection) along each dimension of a variable.
+
+    Returns
+    -------
+    dict
+        Chunk size for each dimension (empty if the variable isn't chunked)
+    """
+
+    chunks = da.encoding.get('preferred_chunks')
+    if chunks:
+        return dict(chunks)
+    chunks = da.encoding.get('chunks') or da.encoding.get('chunksizes')
+    if not chunks:
+        return {}
+
+    return dict(zip(da.dims, chunks))
+
+
+def chunk_starts(original_index, chunk_size):
+    """Find the positions along a (possibly subset) grid axis where storage chunks start.
+
+    Parameters
+    ----------
+    original_index : numpy.ndarray
+        Index of each grid point along the stored axis
+        (e.g. before subsetting to a region of interest)
+    chunk_size : int
+        Size of the storage chunks along the stored axis
+
+    Returns
+    -------
+    set
+        Positions (along the subset axis) of the first grid point in each chunk
+    """
+
+    original_index = np.asarray(original_index)
+    starts = original_index % chunk_size == 0
+    starts[1:] |= np.diff(original_index) != 1
+    starts[0] = True
+
+    return set(np.flatnonzero(starts).tolist())
+
+
+def aligned_splits(size, max_size, chunk_sizes, starts):
+    """Split a grid axis into blocks that start where the storage chunks of several inputs start.
+
+    Only the inputs with chunks no larger than max_size are taken into
+    account (a tile can't line up with a larger chunk anyway). Where the
+    chunks of those inputs have no start in common within max_size of
+    the start of a block, the block is max_size long.
+
+    Parameters
+    ----------
+    size : int
+        Number of grid points along the axis
+    max_size : int
+        Largest number of grid points in a block
+    chunk_sizes : list
+        Storage chunk size of each input
+    starts : list
+        Chunk start positions of each input (see chunk_starts)
+
+    Returns
+    -------
+    list
+        Slice for each block
+    """
+
+    common_starts = set(range(size))
+    for chunk_size, input_starts in zip(chunk_sizes, starts):
+        if chunk_size <= max_size:
+            common_starts &= input_starts
+    ends = sorted(start for start in common_starts if start > 0) + [size]
+
+    splits = []
+    start = 0
+    while start < size:
+        fitting_ends = [end for end in ends if start < end <= start + max_size]
+        end = fitting_ends[-1] if fitting_ends else min(start + max_size, size)
+        splits.append(slice(start, end))
+        start = end
+
+    return splits
+
+
+def aligned_tiles(sizes, tile_size, chunk_sizes, starts, lat_dim='lat', lon_dim='lon'):
+    """Generate index selections for tiles that line up with the storage chunks of several inputs.
+
+    Parameters
+    ----------
+    sizes : dict
+        Number of grid points along each horizontal dimension
+    tile_size : list
+        Largest number of grid points in each tile: [lat size, lon size]
+    chunk_sizes : dict
+        Storage chunk size of each input along each horizontal dimension
+    starts : dict
+        Chunk start positions of each input along each horizontal dimension
+    lat_dim: str, default 'lat'
+        Name of the latitude dimension
+    lon_dim: str, default 'lon'
+        Name of the longitude dimension
+
+    Yields
+    ------
+    dict
+        Index selection (for use with isel) for each tile
+    """
+
+    lat_splits = aligned_splits(sizes[lat_dim], tile_size[0], chunk_sizes[lat_dim], starts[lat_dim])
+    lon_splits = aligned_splits(sizes[lon_dim], tile_size[1], chunk_sizes[lon_dim], starts[lon_dim])
+    for lat_split in lat_splits:
+        for lon_split in lon_splits:
+            yield {lat_dim: lat_split, lon_dim: lon_split}
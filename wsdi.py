@@ -1,41 +1,175 @@
 """Command line program for calculating the Warm Spell Duration Index (WSDI)"""
 
 import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import xarray as xr
 import xclim as xc
+import dask
 import dask.diagnostics
 import cmdline_provenance as cmdprov
+
+import roi
+import profiling
+import intermediates
+import tiling
+import catalogue
+import output_encoding
+import partitions
+import cache_utils
     
 
 dask.diagnostics.ProgressBar().register()
+# force=True because importing xclim has already configured the root logger
+logging.basicConfig(level=logging.INFO, force=True)
+
+BASE_START = '1950-01-01'
+BASE_END = '2014-12-31'
+
+
+def calc_tx90_tile(tasmax_da):
+    """Calculate the day-of-year 90th percentile of tasmax for in-memory data (e.g. one tile)."""
+
+    tx90 = xc.core.calendar.percentile_doy(tasmax_da, window=5, per=90)
+
+    return tx90.sel(percentiles=90).rename('tasmax_per')
+
+
+def calc_tx90(tasmax_da, max_mem='8GB', workers=1):
+    """Calculate the day-of-year 90th percentile of tasmax one spatial tile at a time.
+
+    Parameters
+    ----------
+    tasmax_da : xarray.DataArray
+        Daily maximum temperature for the baseline period
+    max_mem : str, default '8GB'
+        Memory ceiling for the calculation (shared between workers)
+    workers : int, default 1
+        Number of tiles to process at once (in separate threads)
+
+    Returns
+    -------
+    xarray.DataArray
+        Day-of-year 90th percentile (5-day window)
+    """
+
+    # percentile_doy holds the 5-day window stack and its sorted copy
+    # alongside the input, so allow for about ten copies of each tile
+    tile_size = tiling.tile_size_for_memory(
+        len(tasmax_da['time']),
+        len(tasmax_da['lat']),
+        len(tasmax_da['lon']),
+        dask.utils.parse_bytes(max_mem) / workers,
+        bytes_per_value=8,
+        copies=10,
+    )
+
+    def calc_tile(tile):
+        """Calculate the percentiles for one tile."""
+        tile_da = tasmax_da.isel(tile).compute(scheduler='synchronous')
+        return calc_tx90_tile(tile_da).to_dataset()
+
+    tiles = list(tiling.spatial_tiles(tasmax_da, tile_size))
+    logging.info(f'Calculating tx90 for {len(tiles)} tiles of size {tile_size}')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        tile_results = list(executor.map(calc_tile, tiles))
+    tx90 = xr.combine_by_coords(tile_results, combine_attrs='override')['tasmax_per']
+
+    return tx90
+
+
+def main_partitioned(args, profile, ds, bbox):
+    """Run the program with an annual partition directory (see partitions.py).
+
+    Only the years whose input files have changed since the last run are
+    recalculated, using the tx90 baseline saved in the partition directory
+    (which is only recalculated if the baseline years change).
+    """
+
+    with profile.stage('fingerprint'):
+        fingerprints = partitions.year_fingerprints({'tasmax': args.infiles})
+        base_years = [year for year in fingerprints if int(BASE_START[:4]) <= year <= int(BASE_END[:4])]
+        base_fingerprints = [fingerprints[year] for year in base_years]
+        baseline_key = cache_utils.hash_items('wsdi-tx90', *base_fingerprints, BASE_START, BASE_END, bbox)
+        keys = {year: cache_utils.hash_items('wsdi', fingerprints[year], baseline_key) for year in fingerprints}
+        manifest = partitions.read_manifest(args.partition_dir)
+
+    with profile.stage('tx90'):
+        if partitions.baseline_is_current(args.partition_dir, manifest, baseline_key):
+            tx90 = partitions.read_baseline(args.partition_dir)['tasmax_per']
+        else:
+            tx90 = calc_tx90(
+                ds['tasmax'].sel(time=slice(BASE_START, BASE_END)),
+                max_mem=args.max_mem,
+                workers=args.workers,
+            )
+            partitions.write_baseline(tx90.to_dataset(), args.partition_dir, manifest, baseline_key)
+
+    stale_years = partitions.stale_years(args.partition_dir, manifest, keys)
+    logging.info(f'Calculating WSDI for {len(stale_years)} of {len(keys)} years')
+    for first_year, last_year in partitions.year_runs(stale_years):
+        with profile.stage('index', years=[first_year, last_year]):
+            wsdi_da = xc.indicators.icclim.WSDI(
+                tasmax=ds['tasmax'].sel(time=slice(f'{first_year}-01-01', f'{last_year}-12-31')),
+                tasmax_per=tx90,
+                freq='YS',
+            ).compute()
+        for year in range(first_year, last_year + 1):
+            wsdi_year_ds = wsdi_da.sel(time=str(year)).to_dataset()
+            partitions.write_partition(wsdi_year_ds, args.partition_dir, manifest, year, keys[year])
+
+    with profile.stage('write'):
+        wsdi_ds = partitions.stitch(args.partition_dir, list(keys), ['WSDI'])
+        wsdi_ds.attrs = ds.attrs
+        wsdi_ds.attrs['history'] = cmdprov.new_log()
+        output_encoding.write(wsdi_ds, args.outfile)
 
 
 def main(args):
     """Run the program."""
 
-    ds = xr.open_mfdataset(args.infiles, attrs_file=args.infiles[-1])
-    ds['tasmax'] = xc.core.units.convert_units_to(ds['tasmax'], 'degC')
+    profile = profiling.Profile(args.profile)
+    bbox = roi.get_bbox(args)
+    with profile.stage('open'):
+        ds = catalogue.open_mfdataset(args.infiles, attrs_file=args.infiles[-1], preprocess=roi.get_preprocess(bbox))
+        ds['tasmax'] = xc.core.units.convert_units_to(ds['tasmax'], 'degC')
+    if args.partition_dir:
+        main_partitioned(args, profile, ds, bbox)
+        return
     
-    tx90 = xc.core.calendar.percentile_doy(
-        ds['tasmax'].sel(time=slice('1950-01-01', '2014-12-31')),
-        window=5,
-        per=90
-    )
-    tx90 = tx90.compute()
-    tx90 = tx90.sel(percentiles=90)
+    with profile.stage('tx90'):
+        if args.cache_dir:
+            base_files = intermediates.files_before(args.infiles, BASE_END)
+            key = intermediates.product_key('wsdi-tx90', base_files, BASE_START, BASE_END, bbox)
+            tx90_ds = intermediates.read(args.cache_dir, 'wsdi-tx90', key)
+        else:
+            tx90_ds = None
 
-    wsdi_da = xc.indicators.icclim.WSDI(
-        tasmax=ds['tasmax'],
-        tasmax_per=tx90,
-        freq='YS',
-    )
+        if tx90_ds is None:
+            tx90 = calc_tx90(
+                ds['tasmax'].sel(time=slice(BASE_START, BASE_END)),
+                max_mem=args.max_mem,
+                workers=args.workers,
+            )
+            if args.cache_dir:
+                intermediates.write(tx90.to_dataset(), args.cache_dir, 'wsdi-tx90', key)
+        else:
+            tx90 = tx90_ds['tasmax_per']
+
+    with profile.stage('index'):
+        wsdi_da = xc.indicators.icclim.WSDI(
+            tasmax=ds['tasmax'],
+            tasmax_per=tx90,
+            freq='YS',
+        )
 
-    wsdi_ds = wsdi_da.to_dataset()
-    wsdi_ds.attrs = ds.attrs
-    wsdi_ds.attrs['history'] = cmdprov.new_log()
-    wsdi_ds.to_netcdf(args.outfile)
+    with profile.stage('write'):
+        wsdi_ds = wsdi_da.to_dataset()
+        wsdi_ds.attrs = ds.attrs
+        wsdi_ds.attrs['history'] = cmdprov.new_log()
+        output_encoding.write(wsdi_ds, args.outfile)
 
 
 if __name__ == '__main__':
@@ -44,6 +178,14 @@ if __name__ == '__main__':
         formatter_class=argparse.RawDescriptionHelpFormatter
     )     
     parser.add_argument("infiles", type=str, nargs='*', help="input tasmax files")
-    parser.add_argument("outfile", type=str, help="output file name")
+    parser.add_argument("outfile", type=str, help="output file name (.nc or .zarr)")
+    parser.add_argument("--max_mem", type=str, default='8GB', help="memory ceiling for the tx90 baseline calculation [default=8GB]")
+    parser.add_argument("--workers", type=int, default=1, help="number of tiles to process in parallel [default=1]")
+    roi.add_arguments(parser)
+    profiling.add_arguments(parser)
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="share the tx90 baseline between runs via this cache directory")
+    parser.add_argument("--partition_dir", type=str, default=None,
+                        help="keep the WSDI for each year in this directory and only recalculate years whose inputs have changed")
     args = parser.parse_args()
     main(args)